@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark xnat_download.py against the local mock XNAT server
+
+Every configuration gets a fresh mock server and output directory, and
+xnat_download.py runs as a child process so its peak RSS can be measured.
+Results are printed as a table and appended as JSON lines to --results,
+so runs before and after a change can be compared, e.g.
+
+    python3 benchmark_xnat_download.py --subjects 50 --workers 1,4,8 --latency 0.02 --bandwidth 20
+"""
+
+import argparse
+import datetime
+import itertools
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from mock_xnat_server import MockXnat, SyntheticProject
+
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'xnat_download.py')
+
+
+def parse_list(value, kind=float):
+    return [kind(v) for v in str(value).split(',') if v.strip()]
+
+
+def peak_rss_mb(rusage):
+    # ru_maxrss is in KB on Linux, bytes on macOS
+    scale = 1 if sys.platform == 'darwin' else 1024
+    return rusage.ru_maxrss * scale / 1e6
+
+
+def run_config(config, extra_args=(), keep_output=False, log=None):
+    """Download one synthetic project with one configuration and return its measurements"""
+    project = SyntheticProject('BENCH', config['subjects'], config['experiments'], config['scans'],
+                               config['assessors'], config['files'], config['file_size'], config['size_jitter'])
+    output = tempfile.mkdtemp(prefix='xnat_bench_')
+    mock = MockXnat(project, 'bench', 'bench', latency=config['latency'],
+                    bandwidth=config['bandwidth'] * 1e6 if config['bandwidth'] else None,
+                    fault_rate=config['fault_rate'], expire_every=config['expire_every'])
+    command = [sys.executable, SCRIPT, '--output', output, '--user', 'bench', '--pass', 'bench',
+               '--host', mock.url, '--project', 'BENCH', '--workers', str(config['workers'])] + list(extra_args)
+    try:
+        with mock:
+            started = time.time()
+            process = subprocess.Popen(command, stdout=log or subprocess.DEVNULL, stderr=subprocess.STDOUT)
+            # wait4 gives the resource usage of this child alone
+            _, status, rusage = os.wait4(process.pid, 0)
+            process.returncode = os.waitstatus_to_exitcode(status)
+            elapsed = time.time() - started
+        stats = dict(mock.stats)
+
+        objects = 0
+        volume = 0
+        for root, dirs, files in os.walk(os.path.join(output, 'BENCH')):
+            dirs[:] = [d for d in dirs if not d.startswith('.')]
+            for name in files:
+                if name.endswith('.zip'):
+                    objects += 1
+                    volume += os.path.getsize(os.path.join(root, name))
+    finally:
+        if not keep_output:
+            shutil.rmtree(output, ignore_errors=True)
+
+    expected = len(project.experiments) + len(project.assessors)
+    return {
+        'time': datetime.datetime.now().isoformat(timespec='seconds'),
+        **config,
+        'exit_code': process.returncode,
+        'objects': objects,
+        'expected_objects': expected,
+        'bytes': volume,
+        'elapsed_s': round(elapsed, 2),
+        'objects_per_s': round(objects / elapsed, 2),
+        'mb_per_s': round(volume / elapsed / 1e6, 2),
+        'api_calls': mock.api_calls(),
+        'calls': {k: v for k, v in stats.items() if k not in ('bytes_sent',)},
+        'peak_rss_mb': round(peak_rss_mb(rusage), 1),
+        'cpu_s': round(rusage.ru_utime + rusage.ru_stime, 2),
+    }
+
+
+def print_table(results):
+    header = (f"{'workers':>7} {'latency':>7} {'bw MB/s':>7} {'faults':>6} {'objects':>9} {'MB':>8} "
+              f"{'secs':>7} {'obj/s':>7} {'MB/s':>7} {'API':>6} {'RSS MB':>7}")
+    print(header)
+    print('-' * len(header))
+    for r in results:
+        print(f"{r['workers']:>7} {r['latency']:>7} {r['bandwidth'] or '-':>7} {r['fault_rate']:>6} "
+              f"{str(r['objects']) + '/' + str(r['expected_objects']):>9} {r['bytes'] / 1e6:>8.1f} "
+              f"{r['elapsed_s']:>7} {r['objects_per_s']:>7} {r['mb_per_s']:>7} {r['api_calls']:>6} "
+              f"{r['peak_rss_mb']:>7}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark xnat_download.py against a mock XNAT server. '
+                                                 'Comma-separated values run every combination.')
+    parser.add_argument('--subjects', type=int, default=20)
+    parser.add_argument('--experiments', type=int, default=2, help='Sessions per subject')
+    parser.add_argument('--scans', type=int, default=2, help='Scans per session')
+    parser.add_argument('--assessors', type=int, default=1, help='Assessors per session')
+    parser.add_argument('--files', type=int, default=5, help='Files per scan')
+    parser.add_argument('--file-size', type=int, default=200000, help='Bytes per file')
+    parser.add_argument('--size-jitter', type=float, default=0.5, help='Random +/- fraction of --file-size')
+    parser.add_argument('--workers', default='1,4', help='Worker counts to compare')
+    parser.add_argument('--latency', default='0.0', help='Seconds added to every response')
+    parser.add_argument('--bandwidth', default='0', help='MB/s per download connection, 0 for unlimited')
+    parser.add_argument('--fault-rate', default='0.0', help='Fraction of downloads answered with 503')
+    parser.add_argument('--expire-every', type=int, default=None, help='Drop the JSESSION after this many requests')
+    parser.add_argument('--repeat', type=int, default=1, help='Runs per configuration')
+    parser.add_argument('--results', default='bench_results.jsonl', help='JSON lines file results are appended to')
+    parser.add_argument('--log', default=None, help='Write the downloader output of all runs to this file')
+    parser.add_argument('--keep-output', action='store_true', help="Don't delete the downloaded trees")
+    parser.add_argument('extra', nargs=argparse.REMAINDER,
+                        help='Further xnat_download.py options after --, e.g. -- --adaptive')
+    args = parser.parse_args(argv)
+    extra = [a for a in args.extra if a != '--']
+
+    configs = []
+    for workers, latency, bandwidth, fault_rate in itertools.product(
+            parse_list(args.workers, int), parse_list(args.latency), parse_list(args.bandwidth),
+            parse_list(args.fault_rate)):
+        configs.append({'subjects': args.subjects, 'experiments': args.experiments, 'scans': args.scans,
+                        'assessors': args.assessors, 'files': args.files, 'file_size': args.file_size,
+                        'size_jitter': args.size_jitter, 'workers': workers, 'latency': latency,
+                        'bandwidth': bandwidth or None, 'fault_rate': fault_rate,
+                        'expire_every': args.expire_every, 'options': ' '.join(extra)})
+
+    log = open(args.log, 'w') if args.log else None
+    results = []
+    try:
+        for config in configs:
+            for run in range(args.repeat):
+                result = run_config(config, extra, args.keep_output, log)
+                results.append(result)
+                print(f"workers={config['workers']} latency={config['latency']} bandwidth={config['bandwidth']} "
+                      f"faults={config['fault_rate']}: {result['objects_per_s']} objects/s, "
+                      f"{result['mb_per_s']} MB/s, {result['peak_rss_mb']} MB RSS")
+                with open(args.results, 'a') as f:
+                    f.write(json.dumps(result) + '\n')
+    finally:
+        if log is not None:
+            log.close()
+    print()
+    print_table(results)
+    return results
+
+
+if __name__ == '__main__':
+    main()
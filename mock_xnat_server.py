@@ -0,0 +1,671 @@
+# -*- coding: utf-8 -*-
+"""
+Local stand-in for the XNAT REST endpoints used by xnat_download.py
+
+Serves a synthetic project over HTTP so downloads can be tested and
+benchmarked offline:
+
+    /data/JSESSION                                   login (basic auth) / logout
+    /data/experiments?project=&xsiType=              paged session and assessor listings
+    /data/experiments/{ID}/scans                     scan listing
+    /data/experiments/{ID}/scans/{scans}[/resources/{labels}]/files
+    /data/experiments/{ID}/assessors/{ID}[/resources/{labels}]/files
+                                                     file catalog (format=json) or zip (format=zip)
+
+Latency, per-connection bandwidth and 401/5xx faults can be injected.
+MockS3 is a stand-in for an S3-compatible store (SigV4, ListObjectsV2,
+multipart uploads) to test the s3:// output against.
+Run it standalone with e.g.
+
+    python3 mock_xnat_server.py --port 8080 --subjects 100 --file-size 2000000
+"""
+
+import argparse
+import base64
+import datetime
+import hashlib
+import hmac
+import io
+import json
+import random
+import re
+import threading
+import time
+import uuid
+import zipfile
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs, parse_qsl, quote, unquote
+from xml.sax.saxutils import escape
+
+
+SCAN_TYPES = ('T1w', 'T2w', 'FLAIR', 'DWI')
+BLOCK_SIZE = 64 * 1024
+
+
+class SyntheticProject:
+    """Deterministic project layout: subjects, sessions, scans, assessors and files.
+
+    File contents are generated from the file path, so every run serves the
+    same bytes without keeping them in memory.
+    """
+
+    def __init__(self, project='BENCH', subjects=10, experiments_per_subject=2, scans_per_experiment=2,
+                 assessors_per_experiment=1, files_per_resource=3, file_size=100000, size_jitter=0.0, seed=0):
+        self.project = project
+        self.file_size = file_size
+        self.experiments = []
+        self.assessors = []
+        self.objects = {}
+        self._shape = (scans_per_experiment, assessors_per_experiment, files_per_resource, size_jitter)
+        self._rng = random.Random(seed)
+        for s in range(subjects):
+            for e in range(experiments_per_subject):
+                self.add_session(s, e, f'2024-01-{1 + (s + e) % 28:02d} 10:00:00.0')
+        self._md5 = {}
+        self._md5_lock = threading.Lock()
+
+    def add_session(self, subject, number, when=None):
+        """Add session number of subject (an index) with its scans and assessors, as an upload would"""
+        scans_per_experiment, assessors_per_experiment, files_per_resource, size_jitter = self._shape
+        when = when or datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S.0')
+        subject_label = f'{self.project}_S{subject:04d}'
+        label = f'{subject_label}_MR{number}'
+        experiment = {'ID': f'{self.project}_E{subject:04d}{number}', 'label': label, 'xsiType': 'xnat:mrSessionData',
+                      'subject_ID': f'{self.project}_S{subject:04d}', 'subject_label': subject_label,
+                      'insert_date': when, 'last_modified': when, 'scans': [], 'assessors': []}
+        for n in range(scans_per_experiment):
+            scan_type = SCAN_TYPES[n % len(SCAN_TYPES)]
+            experiment['scans'].append({
+                'ID': str(n + 1), 'type': scan_type, 'series_description': scan_type + '_series',
+                'files': self._files(self._rng, files_per_resource, size_jitter)})
+        for a in range(assessors_per_experiment):
+            assessor = {'ID': f'{self.project}_A{subject:04d}{number}{a}', 'label': f'{label}_ROI{a}',
+                        'xsiType': 'icr:roiCollectionData', 'session_ID': experiment['ID'],
+                        'insert_date': when, 'last_modified': when, 'session': experiment,
+                        'files': self._files(self._rng, 1, size_jitter)}
+            experiment['assessors'].append(assessor)
+            self.assessors.append(assessor)
+            self.objects[assessor['ID']] = assessor
+        self.experiments.append(experiment)
+        self.objects[experiment['ID']] = experiment
+        return experiment
+
+    def _files(self, rng, count, size_jitter):
+        sizes = []
+        for i in range(count):
+            jitter = 1 + rng.uniform(-size_jitter, size_jitter) if size_jitter else 1
+            sizes.append(max(1, int(self.file_size * jitter)))
+        return sizes
+
+    def total_bytes(self):
+        total = sum(sum(sum(scan['files']) for scan in e['scans']) for e in self.experiments)
+        return total + sum(sum(a['files']) for a in self.assessors)
+
+    def touch(self, object_id, when=None):
+        """Give an object a new last-modified date, as if it was edited on XNAT"""
+        self.objects[object_id]['last_modified'] = when or datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S.0')
+
+    def file_list(self, object_id, scan_ids=None, resources=None):
+        """[(zip member path, catalog name, size)] for an object, optionally restricted"""
+        obj = self.objects[object_id]
+        files = []
+        if 'scans' in obj:
+            if resources and 'DICOM' not in resources:
+                return files
+            for scan in obj['scans']:
+                if scan_ids and scan['ID'] not in scan_ids:
+                    continue
+                folder = f"{obj['label']}/scans/{scan['ID']}-{scan['type']}/resources/DICOM/files"
+                for i, size in enumerate(scan['files']):
+                    name = f"{scan['ID']}_{i:04d}.dcm"
+                    files.append((f'{folder}/{name}', name, size))
+        else:
+            if resources and 'RTSTRUCT' not in resources:
+                return files
+            folder = f"{obj['session']['label']}/assessors/{obj['label']}/resources/RTSTRUCT/files"
+            for i, size in enumerate(obj['files']):
+                name = f"{obj['label']}_{i}.dcm"
+                files.append((f'{folder}/{name}', name, size))
+        return files
+
+    def content(self, path, size):
+        """Yield the bytes of a file in blocks"""
+        block = random.Random(path).randbytes(min(size, BLOCK_SIZE))
+        left = size
+        while left > 0:
+            piece = block[:left]
+            left -= len(piece)
+            yield piece
+
+    def md5(self, path, size):
+        with self._md5_lock:
+            digest = self._md5.get(path)
+        if digest is None:
+            md5 = hashlib.md5()
+            for piece in self.content(path, size):
+                md5.update(piece)
+            digest = md5.hexdigest()
+            with self._md5_lock:
+                self._md5[path] = digest
+        return digest
+
+
+class _ChunkedWriter(io.RawIOBase):
+    """Unseekable sink that sends everything written as HTTP chunks.
+
+    zipfile writes data descriptors to unseekable files, like XNAT's
+    streamed zips. Bandwidth is throttled here per connection.
+    """
+
+    def __init__(self, wfile, bandwidth=None, counter=None):
+        self.wfile = wfile
+        self.bandwidth = bandwidth
+        self.counter = counter
+        self.started = time.time()
+        self.sent = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        if not data:
+            return 0
+        self.wfile.write(b'%x\r\n' % len(data) + bytes(data) + b'\r\n')
+        self.sent += len(data)
+        if self.counter is not None:
+            self.counter(len(data))
+        if self.bandwidth:
+            ahead = self.sent / self.bandwidth - (time.time() - self.started)
+            if ahead > 0:
+                time.sleep(ahead)
+        return len(data)
+
+    def finish(self):
+        self.wfile.write(b'0\r\n\r\n')
+
+
+class MockXnat:
+    """Threaded HTTP server answering like XNAT for one SyntheticProject.
+
+    latency      seconds added before every response
+    bandwidth    bytes/s per download connection (None: unlimited)
+    fault_rate   fraction of downloads answered with fault_status
+    expire_every invalidate the JSESSION after this many requests (401 on the next one)
+    truncate     number of upcoming downloads cut off halfway, after a full Content-Length
+    session_ttl  JSESSION lifetime reported in SESSION_EXPIRATION_TIME, seconds
+
+    Like a servlet container it takes the first JSESSIONID of a Cookie
+    header; requests carrying several are counted in stats['duplicate_cookie'].
+    A logout ends the session of its cookie. Zips are always deflated with data descriptors, as XNAT streams them.
+    """
+
+    def __init__(self, project=None, username='admin', password='admin', host='127.0.0.1', port=0,
+                 latency=0.0, bandwidth=None, fault_rate=0.0, fault_status=503, retry_after=None,
+                 expire_every=None, session_ttl=900, compress_level=1, seed=0):
+        self.project = project or SyntheticProject()
+        self.username = username
+        self.password = password
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.fault_rate = fault_rate
+        self.fault_status = fault_status
+        self.retry_after = retry_after
+        self.expire_every = expire_every
+        self.session_ttl = session_ttl
+        self.compress_level = compress_level
+        self.truncate = 0
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._sessions = set()
+        self._requests_since_login = 0
+        self.stats = {'login': 0, 'logout': 0, 'listing': 0, 'scan_listing': 0, 'file_listing': 0,
+                      'download': 0, 'unauthorized': 0, 'faults': 0, 'truncated': 0, 'bytes_sent': 0, 'rows_listed': 0,
+                      'duplicate_cookie': 0}
+        self._server = ThreadingHTTPServer((host, port), self._handler_class())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def count(self, key, n=1):
+        with self._lock:
+            self.stats[key] += n
+
+    def api_calls(self):
+        with self._lock:
+            return sum(self.stats[k] for k in ('login', 'logout', 'listing', 'scan_listing', 'file_listing', 'download'))
+
+    def expire_sessions(self):
+        """Invalidate every JSESSION, as a server restart or timeout would"""
+        with self._lock:
+            self._sessions.clear()
+
+    def _check_session(self, token):
+        with self._lock:
+            if token not in self._sessions:
+                return False
+            self._requests_since_login += 1
+            if self.expire_every and self._requests_since_login > self.expire_every:
+                self._sessions.discard(token)
+                self._requests_since_login = 0
+                return False
+            return True
+
+    def _truncate(self):
+        with self._lock:
+            if self.truncate <= 0:
+                return False
+            self.truncate -= 1
+            self.stats['truncated'] += 1
+            return True
+
+    def _fault(self):
+        with self._lock:
+            return self.fault_rate > 0 and self._rng.random() < self.fault_rate
+
+    def _handler_class(self):
+        mock = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                mock._handle(self, 'GET')
+
+            def do_POST(self):
+                mock._handle(self, 'POST')
+
+            def do_DELETE(self):
+                mock._handle(self, 'DELETE')
+
+        return Handler
+
+    def _send(self, handler, status, body=b'', content_type='application/json', headers=None):
+        if isinstance(body, (dict, list)):
+            body = json.dumps(body).encode('utf-8')
+        handler.send_response(status)
+        handler.send_header('Content-Type', content_type)
+        handler.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or []):
+            handler.send_header(name, value)
+        handler.end_headers()
+        if handler.command != 'HEAD':
+            handler.wfile.write(body)
+
+    def _result_set(self, rows, total=None):
+        return {'ResultSet': {'Result': rows, 'totalRecords': str(len(rows) if total is None else total)}}
+
+    def _handle(self, handler, method):
+        if self.latency:
+            time.sleep(self.latency)
+        parts = urlsplit(handler.path)
+        path = parts.path.rstrip('/')
+        query = {k: v[-1] for k, v in parse_qs(parts.query).items()}
+
+        tokens = []
+        for item in (handler.headers.get('Cookie') or '').split(';'):
+            name, _, value = item.strip().partition('=')
+            if name == 'JSESSIONID':
+                tokens.append(value)
+        if len(tokens) > 1:
+            self.count('duplicate_cookie')
+        token = tokens[0] if tokens else None
+        if path == '/data/JSESSION':
+            return self._jsession(handler, method, token)
+
+        if not self._check_session(token):
+            self.count('unauthorized')
+            return self._send(handler, 401, b'Unauthorized', 'text/plain')
+
+        if path == '/data/experiments':
+            self.count('listing')
+            return self._listing(handler, query)
+        match = re.fullmatch(r'/data/experiments/([^/]+)/scans', path)
+        if match:
+            self.count('scan_listing')
+            experiment = self.project.objects.get(match.group(1))
+            if experiment is None or 'scans' not in experiment:
+                return self._send(handler, 404, b'Not found', 'text/plain')
+            rows = [{'ID': s['ID'], 'type': s['type'], 'series_description': s['series_description']}
+                    for s in experiment['scans']]
+            return self._send(handler, 200, self._result_set(rows))
+        match = (re.fullmatch(r'/data/experiments/([^/]+)/scans/([^/]+)(?:/resources/([^/]+))?/files', path)
+                 or re.fullmatch(r'/data/experiments/[^/]+/assessors/([^/]+)()(?:/resources/([^/]+))?/files', path))
+        if match:
+            object_id, scans, resources = match.groups()
+            if object_id not in self.project.objects:
+                return self._send(handler, 404, b'Not found', 'text/plain')
+            scan_ids = None if scans in (None, '', 'ALL') else scans.split(',')
+            files = self.project.file_list(object_id, scan_ids, resources.split(',') if resources else None)
+            if query.get('format') == 'zip':
+                return self._zip(handler, files)
+            self.count('file_listing')
+            rows = [{'Name': name, 'Size': str(size), 'URI': '/data/' + member,
+                     'digest': self.project.md5(member, size)} for member, name, size in files]
+            return self._send(handler, 200, self._result_set(rows))
+        return self._send(handler, 404, b'Not found', 'text/plain')
+
+    def _jsession(self, handler, method, token=None):
+        if method == 'DELETE':
+            self.count('logout')
+            with self._lock:
+                self._sessions.discard(token)
+            return self._send(handler, 200, b'', 'text/plain')
+        self.count('login')
+        expected = base64.b64encode(f'{self.username}:{self.password}'.encode('utf-8')).decode('ascii')
+        if handler.headers.get('Authorization') != 'Basic ' + expected:
+            return self._send(handler, 401, b'Unauthorized', 'text/plain')
+        token = uuid.uuid4().hex.upper()
+        with self._lock:
+            self._sessions.add(token)
+            self._requests_since_login = 0
+        now_ms = int(time.time() * 1000)
+        headers = [('Set-Cookie', f'JSESSIONID={token}; Path=/'),
+                   ('Set-Cookie', f'SESSION_EXPIRATION_TIME="{now_ms},{self.session_ttl * 1000}"; Path=/')]
+        return self._send(handler, 200, token.encode('ascii'), 'text/plain', headers)
+
+    def _listing(self, handler, query):
+        if query.get('project') != self.project.project:
+            return self._send(handler, 200, self._result_set([]))
+        if query.get('xsiType') == 'xnat:imageAssessorData':
+            rows = [{'ID': a['ID'], 'label': a['label'], 'xsiType': a['xsiType'],
+                     'xnat:imageassessordata/imagesession_id': a['session_ID'], 'insert_date': a['insert_date'],
+                     'xnat:experimentdata/meta/last_modified': a['last_modified']} for a in self.project.assessors]
+        else:
+            rows = [{'ID': e['ID'], 'label': e['label'], 'xsiType': e['xsiType'], 'subject_ID': e['subject_ID'],
+                     'subject_label': e['subject_label'], 'insert_date': e['insert_date'],
+                     'xnat:experimentdata/meta/last_modified': e['last_modified']} for e in self.project.experiments]
+        # Date filter as used by --watch: "<column>=>date"
+        since = query.get('xnat:experimentData/meta/last_modified', '')
+        if since.startswith('>'):
+            rows = [r for r in rows if r['xnat:experimentdata/meta/last_modified'] > since[1:]]
+        total = len(rows)
+        offset = int(query.get('offset', 0))
+        limit = int(query.get('limit', total or 1))
+        self.count('rows_listed', len(rows[offset:offset + limit]))
+        return self._send(handler, 200, self._result_set(rows[offset:offset + limit], total))
+
+    def _zip(self, handler, files):
+        self.count('download')
+        if self._fault():
+            self.count('faults')
+            headers = [('Retry-After', str(self.retry_after))] if self.retry_after is not None else None
+            return self._send(handler, self.fault_status, b'Injected fault', 'text/plain', headers)
+        if self._truncate():
+            # Announce the whole zip, send half of it and drop the connection
+            buffer = io.BytesIO()
+            self._write_zip(buffer, files)
+            body = buffer.getvalue()
+            handler.send_response(200)
+            handler.send_header('Content-Type', 'application/zip')
+            handler.send_header('Content-Length', str(len(body)))
+            handler.end_headers()
+            handler.wfile.write(body[:len(body) // 2])
+            handler.wfile.flush()
+            handler.close_connection = True
+            return
+        # Built on the fly like XNAT's: no Content-Length, no Range support
+        handler.send_response(200)
+        handler.send_header('Content-Type', 'application/zip')
+        handler.send_header('Transfer-Encoding', 'chunked')
+        handler.end_headers()
+        sink = _ChunkedWriter(handler.wfile, self.bandwidth, lambda n: self.count('bytes_sent', n))
+        self._write_zip(sink, files)
+        sink.finish()
+
+    def _write_zip(self, sink, files):
+        with zipfile.ZipFile(sink, 'w', zipfile.ZIP_DEFLATED, compresslevel=self.compress_level) as zf:
+            for member, name, size in files:
+                with zf.open(member, 'w', force_zip64=size > 2**31) as f:
+                    for piece in self.project.content(member, size):
+                        f.write(piece)
+
+
+class MockS3:
+    """Threaded HTTP server answering like an S3-compatible store (MinIO style) for one bucket.
+
+    Path-style requests only. Every request must carry a valid SigV4
+    signature for access_key/secret_key; the payload hash is checked too.
+    Supports ListObjectsV2 (paged by max_keys), PUT/GET/HEAD/DELETE of
+    objects and multipart uploads, whose parts other than the last must be
+    at least min_part_size bytes, as on S3.
+    """
+
+    NS = 'http://s3.amazonaws.com/doc/2006-03-01/'
+
+    def __init__(self, access_key='minio', secret_key='minio-secret', bucket='archive', region='us-east-1',
+                 host='127.0.0.1', port=0, max_keys=1000, min_part_size=5 * 1024 * 1024):
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.bucket = bucket
+        self.region = region
+        self.max_keys = max_keys
+        self.min_part_size = min_part_size
+        self.objects = {}
+        self.uploads = {}
+        self._lock = threading.Lock()
+        self.stats = {'list': 0, 'put': 0, 'get': 0, 'create_multipart': 0, 'upload_part': 0, 'complete': 0,
+                      'abort': 0, 'rejected': 0, 'bytes_received': 0}
+        self._server = ThreadingHTTPServer((host, port), self._handler_class())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    url = MockXnat.url
+    start = MockXnat.start
+    stop = MockXnat.stop
+    __enter__ = MockXnat.__enter__
+    __exit__ = MockXnat.__exit__
+    count = MockXnat.count
+    _send = MockXnat._send
+
+    def _handler_class(self):
+        mock = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, format, *args):
+                pass
+
+        for method in ('GET', 'HEAD', 'PUT', 'POST', 'DELETE'):
+            setattr(Handler, 'do_' + method, lambda handler, method=method: mock._handle(handler, method))
+        return Handler
+
+    def _error(self, handler, status, code):
+        body = f'<?xml version="1.0" encoding="UTF-8"?><Error><Code>{code}</Code></Error>'.encode()
+        return self._send(handler, status, body, 'application/xml')
+
+    def _signature_ok(self, handler, body):
+        """Recompute the SigV4 signature from the request as received"""
+        auth = handler.headers.get('Authorization', '')
+        match = re.fullmatch(r'AWS4-HMAC-SHA256 Credential=([^/]+)/(\d{8})/([^/]+)/s3/aws4_request, '
+                             r'SignedHeaders=([^,]+), Signature=([0-9a-f]{64})', auth)
+        if not match or match.group(1) != self.access_key or match.group(3) != self.region:
+            return False
+        date, signed_headers, signature = match.group(2), match.group(4).split(';'), match.group(5)
+        payload_hash = handler.headers.get('x-amz-content-sha256', '')
+        if payload_hash != hashlib.sha256(body).hexdigest():
+            return False
+        amz_date = handler.headers.get('x-amz-date', '')
+        parts = urlsplit(handler.path)
+        query = sorted(parse_qsl(parts.query, keep_blank_values=True))
+        canonical = '\n'.join([
+            handler.command, parts.path,
+            '&'.join(f"{quote(k, safe='-_.~')}={quote(v, safe='-_.~')}" for k, v in query),
+            ''.join(f"{name}:{(handler.headers.get(name) or '').strip()}\n" for name in signed_headers),
+            ';'.join(signed_headers), payload_hash])
+        scope = f'{date}/{self.region}/s3/aws4_request'
+        to_sign = f'AWS4-HMAC-SHA256\n{amz_date}\n{scope}\n' + hashlib.sha256(canonical.encode()).hexdigest()
+        key = ('AWS4' + self.secret_key).encode()
+        for part in (date, self.region, 's3', 'aws4_request'):
+            key = hmac.new(key, part.encode(), hashlib.sha256).digest()
+        return hmac.compare_digest(hmac.new(key, to_sign.encode(), hashlib.sha256).hexdigest(), signature)
+
+    def _handle(self, handler, method):
+        length = int(handler.headers.get('Content-Length') or 0)
+        body = handler.rfile.read(length) if length else b''
+        if not self._signature_ok(handler, body):
+            self.count('rejected')
+            return self._error(handler, 403, 'SignatureDoesNotMatch')
+        parts = urlsplit(handler.path)
+        query = dict(parse_qsl(parts.query, keep_blank_values=True))
+        bucket, _, key = unquote(parts.path).lstrip('/').partition('/')
+        if bucket != self.bucket:
+            return self._error(handler, 404, 'NoSuchBucket')
+        self.count('bytes_received', len(body))
+
+        if not key:
+            if method == 'GET' and query.get('list-type') == '2':
+                return self._list(handler, query)
+            return self._error(handler, 400, 'InvalidRequest')
+        if method == 'POST' and 'uploads' in query:
+            self.count('create_multipart')
+            upload_id = uuid.uuid4().hex
+            with self._lock:
+                self.uploads[upload_id] = {'key': key, 'parts': {}}
+            return self._send(handler, 200, (f'<InitiateMultipartUploadResult xmlns="{self.NS}"><Bucket>{bucket}'
+                                             f'</Bucket><Key>{key}</Key><UploadId>{upload_id}</UploadId>'
+                                             f'</InitiateMultipartUploadResult>').encode(), 'application/xml')
+        if 'uploadId' in query:
+            with self._lock:
+                upload = self.uploads.get(query['uploadId'])
+            if upload is None or upload['key'] != key:
+                return self._error(handler, 404, 'NoSuchUpload')
+            if method == 'PUT':
+                self.count('upload_part')
+                etag = '"' + hashlib.md5(body).hexdigest() + '"'
+                with self._lock:
+                    upload['parts'][int(query['partNumber'])] = (etag, body)
+                return self._send(handler, 200, headers=[('ETag', etag)])
+            if method == 'DELETE':
+                self.count('abort')
+                with self._lock:
+                    self.uploads.pop(query['uploadId'], None)
+                return self._send(handler, 204)
+            if method == 'POST':
+                self.count('complete')
+                requested = [(int(n), etag) for n, etag in re.findall(
+                    r'<PartNumber>(\d+)</PartNumber>\s*<ETag>([^<]+)</ETag>', body.decode())]
+                data = []
+                for i, (number, etag) in enumerate(requested):
+                    stored = upload['parts'].get(number)
+                    if stored is None or stored[0] != etag:
+                        return self._error(handler, 400, 'InvalidPart')
+                    if i < len(requested) - 1 and len(stored[1]) < self.min_part_size:
+                        return self._error(handler, 400, 'EntityTooSmall')
+                    data.append(stored[1])
+                with self._lock:
+                    self.objects[key] = b''.join(data)
+                    del self.uploads[query['uploadId']]
+                etag = f'"{hashlib.md5(b"".join(etag.encode() for n, etag in requested)).hexdigest()}-{len(requested)}"'
+                return self._send(handler, 200, (f'<CompleteMultipartUploadResult xmlns="{self.NS}"><Key>{key}</Key>'
+                                                 f'<ETag>{etag}</ETag></CompleteMultipartUploadResult>').encode(),
+                                  'application/xml')
+        if method == 'PUT':
+            self.count('put')
+            with self._lock:
+                self.objects[key] = body
+            return self._send(handler, 200, headers=[('ETag', '"' + hashlib.md5(body).hexdigest() + '"')])
+        if method in ('GET', 'HEAD'):
+            with self._lock:
+                data = self.objects.get(key)
+            if data is None:
+                return self._error(handler, 404, 'NoSuchKey')
+            if method == 'GET':
+                self.count('get')
+            return self._send(handler, 200, data, 'application/zip')
+        if method == 'DELETE':
+            with self._lock:
+                self.objects.pop(key, None)
+            return self._send(handler, 204)
+        return self._error(handler, 400, 'InvalidRequest')
+
+    def _list(self, handler, query):
+        self.count('list')
+        prefix = query.get('prefix', '')
+        with self._lock:
+            keys = sorted(k for k in self.objects if k.startswith(prefix))
+            sizes = {k: len(self.objects[k]) for k in keys}
+        start = int(query.get('continuation-token') or 0)
+        limit = min(int(query.get('max-keys') or self.max_keys), self.max_keys)
+        page = keys[start:start + limit]
+        truncated = start + limit < len(keys)
+        contents = ''.join(f'<Contents><Key>{escape(k)}</Key><Size>{sizes[k]}</Size></Contents>' for k in page)
+        token = f'<NextContinuationToken>{start + limit}</NextContinuationToken>' if truncated else ''
+        body = (f'<?xml version="1.0" encoding="UTF-8"?><ListBucketResult xmlns="{self.NS}">'
+                f'<Name>{self.bucket}</Name><Prefix>{escape(prefix)}</Prefix><KeyCount>{len(page)}</KeyCount>'
+                f'<IsTruncated>{"true" if truncated else "false"}</IsTruncated>{token}{contents}</ListBucketResult>')
+        return self._send(handler, 200, body.encode(), 'application/xml')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Serve a synthetic XNAT project for offline testing')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--user', default='admin')
+    parser.add_argument('--pass', dest='password', default='admin')
+    parser.add_argument('--project', default='BENCH')
+    parser.add_argument('--subjects', type=int, default=10)
+    parser.add_argument('--experiments', type=int, default=2, help='Sessions per subject')
+    parser.add_argument('--scans', type=int, default=2, help='Scans per session')
+    parser.add_argument('--assessors', type=int, default=1, help='Assessors per session')
+    parser.add_argument('--files', type=int, default=3, help='Files per scan')
+    parser.add_argument('--file-size', type=int, default=100000, help='Bytes per file')
+    parser.add_argument('--size-jitter', type=float, default=0.0, help='Random +/- fraction of --file-size')
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds added to every response')
+    parser.add_argument('--bandwidth', type=float, default=None, help='MB/s per download connection')
+    parser.add_argument('--fault-rate', type=float, default=0.0, help='Fraction of downloads failing with --fault-status')
+    parser.add_argument('--fault-status', type=int, default=503)
+    parser.add_argument('--expire-every', type=int, default=None, help='Drop the JSESSION after this many requests')
+    parser.add_argument('--compress-level', type=int, default=1, help='Deflate level of the zips (0-9)')
+    parser.add_argument('--s3-port', type=int, default=None,
+                        help='Also serve an S3 stand-in (access key minio, secret minio-secret, bucket archive)')
+    args = parser.parse_args(argv)
+
+    project = SyntheticProject(args.project, args.subjects, args.experiments, args.scans, args.assessors,
+                               args.files, args.file_size, args.size_jitter)
+    mock = MockXnat(project, args.user, args.password, port=args.port, latency=args.latency,
+                    bandwidth=args.bandwidth * 1e6 if args.bandwidth else None, fault_rate=args.fault_rate,
+                    fault_status=args.fault_status, expire_every=args.expire_every,
+                    compress_level=args.compress_level)
+    print(f'Mock XNAT at {mock.url} (user {args.user}, project {args.project}, '
+          f'{len(project.experiments)} sessions, {len(project.assessors)} assessors, '
+          f'{project.total_bytes() / 1e6:.1f} MB)')
+    s3 = None
+    if args.s3_port is not None:
+        s3 = MockS3(port=args.s3_port).start()
+        print(f'Mock S3 at {s3.url} (bucket {s3.bucket}, access key {s3.access_key}, secret {s3.secret_key})')
+    try:
+        mock._server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        mock._server.server_close()
+        print(json.dumps(mock.stats))
+        if s3 is not None:
+            s3.stop()
+            print(json.dumps(s3.stats))
+
+
+if __name__ == '__main__':
+    main()
@@ -4,68 +4,335 @@
 """
 
 
-#this needs the xnat package installed i.e.
-#pip install xnat
-import xnat
+#this needs the requests package installed i.e.
+#pip install requests
+#requests and the CLI-only modules are imported on first use, so importing
+#this module as a library stays cheap
 import os
+import shutil
+import signal
+import socket
 import subprocess
-import argparse
+import sys
+import csv
 import os.path
-import getpass
-import requests
 import json
-from contextlib import contextmanager
+import random
+import sqlite3
+import tempfile
+import threading
+import time
+import datetime
+import email.utils
+import fnmatch
+import glob
+import hashlib
+import hmac
+import struct
+import urllib.parse
+import zipfile
+import zlib
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from http.cookiejar import DefaultCookiePolicy
 
-from requests.auth import HTTPBasicAuth
-
-parser = argparse.ArgumentParser()
-parser.add_argument('--output',required = False,dest='output',help='Path to the output directory')
-parser.add_argument('--user', required=True,type=str,dest='xnat_user', help='XNAT username')
-parser.add_argument('--pass',type=str,dest='xnat_pass', help='XNAT password')
-parser.add_argument('--host',  required=True,type=str,dest='xnat_host', help='XNAT hostname')
-parser.add_argument('--project', required=True, type=str,dest='xnat_project', help='XNAT project ID')
-parser.add_argument('--session', required=False, type=str,dest='xnat_session', help='XNAT session/experiment label to download')
-parser.add_argument('--download', required=False, type=str, default='both', choices=['experiments', 'assessors', 'both'], dest='download_mode', help='What to download: experiments, assessors, or both (default: both)')
-parser.add_argument('--experiment-type', required=False, type=str,dest='xnat_experiment_type', help='XNAT experiment type filter (e.g., xnat:mrSessionData, xnat:petSessionData)')
-parser.add_argument('--assessor-type', required=False, type=str,dest='xnat_assessor_type', help='XNAT assessor type filter (e.g., icr:RoiCollection)')
-parser.add_argument('--list-types', required=False, action='store_true', dest='list_types', help='List all experiment and assessor types found in the project and exit')
-
-args = parser.parse_args()
+# Download orders accepted by --order
+SCHEDULING_ORDERS = ('catalog', 'smallest', 'largest', 'subjects', 'oldest')
+# Cached catalogs younger than this are reused by --list-types (--dry-run only with --catalog-max-age)
+CATALOG_MAX_AGE = 60 * 60
+# Bounds of the --watch poll interval, seconds
+WATCH_POLL_MIN = 60
+WATCH_POLL_MAX = 10 * 60
 
 VERSION='xnat_download_v1.1.3'
 
-myWorkingDirectory = args.output 
-collectionURL = args.xnat_host 
-myProjectID = args.xnat_project 
-xnat_session=args.xnat_session 
-username=args.xnat_user
-password=args.xnat_pass
 
-if password is None:
-    password = getpass.getpass("Enter your password: ")
 
+# XNAT's default idle timeout, used when the server sends no SESSION_EXPIRATION_TIME
+SESSION_TTL = 15 * 60
+# Renew the JSESSION this many seconds before it would expire
+SESSION_RENEW_MARGIN = 60
 
 
-def login(host,username,password):
+def login(host,username,password,http=None):
+    import requests
+    from requests.auth import HTTPBasicAuth
 
     basic = HTTPBasicAuth(username, password)
-    response=requests.get(host+'/data/JSESSION', auth=basic)
-    print(response.content)
+    url = host.rstrip('/') + '/data/JSESSION'
+    response=(http or requests).get(url, auth=basic, timeout=DOWNLOAD_TIMEOUT)
+    if response.status_code != 200:
+        raise HttpStatusError(url, response)
     return response.content.decode("utf-8")
 
 
-@contextmanager
-def xnat_session_safe(collectionURL, jsession):
-    """Context manager that safely handles XNAT session disconnect errors"""
-    session = xnat.connect(collectionURL, jsession=jsession)
+def session_expiry(expiration_cookie):
+    """Epoch seconds from XNAT's SESSION_EXPIRATION_TIME cookie ("<start ms>,<timeout ms>")"""
     try:
-        yield session
-    finally:
+        start, timeout = expiration_cookie.strip('"').split(',')[:2]
+        return (int(start) + int(timeout)) / 1000.0
+    except (AttributeError, ValueError):
+        return time.time() + SESSION_TTL
+
+
+# Upper bounds (seconds) of the API latency histogram buckets
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def api_call_type(url, params=None):
+    """Classify a REST url as login, listing, scan_listing, file_listing or download"""
+    path = url.split('?')[0].rstrip('/')
+    if path.endswith('/data/JSESSION'):
+        return 'login'
+    if path.endswith('/data/experiments'):
+        return 'listing'
+    if path.endswith('/scans'):
+        return 'scan_listing'
+    if path.endswith('/files'):
+        zipped = 'format=zip' in url or (params or {}).get('format') == 'zip'
+        return 'download' if zipped else 'file_listing'
+    return 'other'
+
+
+class Metrics:
+    """Counters, gauges and latency histograms of a run, plus a JSON-lines event log.
+
+    Rendered in the Prometheus text format to a file (for the node_exporter
+    textfile collector) and/or served on /metrics. Recording is always on
+    and cheap; the event log is only written when a path is configured.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.phases = {}
+        self.event_log = None
+        self._server = None
+        self._writer = None
+        self._stop = threading.Event()
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        with self._lock:
+            key = self._key(name, labels)
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self._lock:
+            self.gauges[self._key(name, labels)] = value
+
+    def observe(self, name, seconds, **labels):
+        with self._lock:
+            key = self._key(name, labels)
+            hist = self.histograms.get(key)
+            if hist is None:
+                hist = self.histograms[key] = {'buckets': [0] * len(LATENCY_BUCKETS), 'sum': 0.0, 'count': 0}
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if seconds <= bound:
+                    hist['buckets'][i] += 1
+            hist['sum'] += seconds
+            hist['count'] += 1
+
+    def api_call(self, call, seconds, status):
+        self.observe('xnat_api_latency_seconds', seconds, call=call)
+        self.inc('xnat_api_requests_total', call=call, status=str(status))
+
+    def add_bytes(self, count):
+        self.inc('xnat_download_bytes_total', count)
+        # Alert on stalled transfers: time() - this stops moving
+        self.set('xnat_last_progress_timestamp_seconds', round(time.time(), 3))
+
+    def event(self, event, /, **fields):
+        """Append one event to the JSON-lines log"""
+        if self.event_log is None:
+            return
+        record = {'ts': round(time.time(), 3), 'event': event, **fields}
+        line = json.dumps(record, default=str) + '\n'
+        with self._lock:
+            with open(self.event_log, 'a') as f:
+                f.write(line)
+
+    def phase(self, name):
+        """Context manager timing one phase of the run (listing, planning, download, ...)"""
+        metrics = self
+
+        class Phase:
+            def __enter__(self):
+                self.started = time.time()
+                metrics.event('phase_start', phase=name)
+                return self
+
+            def __exit__(self, *exc):
+                elapsed = time.time() - self.started
+                with metrics._lock:
+                    metrics.phases[name] = metrics.phases.get(name, 0.0) + elapsed
+                metrics.inc('xnat_phase_seconds_total', elapsed, phase=name)
+                metrics.event('phase_end', phase=name, seconds=round(elapsed, 3))
+                return False
+
+        return Phase()
+
+    def render(self):
+        """Prometheus text exposition of everything recorded so far"""
+
+        def labels_text(labels, extra=()):
+            items = list(labels) + list(extra)
+            if not items:
+                return ''
+            return '{' + ','.join(f'{k}="{v}"' for k, v in items) + '}'
+
+        lines = []
+        with self._lock:
+            for kind, series in (('counter', self.counters), ('gauge', self.gauges)):
+                for name in sorted({n for n, _ in series}):
+                    lines.append(f'# TYPE {name} {kind}')
+                    for (n, labels), value in sorted(series.items()):
+                        if n == name:
+                            lines.append(f'{name}{labels_text(labels)} {value}')
+            for name in sorted({n for n, _ in self.histograms}):
+                lines.append(f'# TYPE {name} histogram')
+                for (n, labels), hist in sorted(self.histograms.items()):
+                    if n != name:
+                        continue
+                    for bound, count in zip(LATENCY_BUCKETS, hist['buckets']):
+                        lines.append(f'{name}_bucket{labels_text(labels, [("le", bound)])} {count}')
+                    lines.append(f'{name}_bucket{labels_text(labels, [("le", "+Inf")])} {hist["count"]}')
+                    lines.append(f'{name}_sum{labels_text(labels)} {round(hist["sum"], 6)}')
+                    lines.append(f'{name}_count{labels_text(labels)} {hist["count"]}')
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path):
+        # Written aside and renamed so a scraper never reads half a file
+        with open(path + '.tmp', 'w') as f:
+            f.write(self.render())
+        os.replace(path + '.tmp', path)
+
+    def start(self, event_log=None, metrics_file=None, port=None, interval=15, bind='127.0.0.1'):
+        """Enable the event log, a periodically rewritten metrics file and/or a /metrics endpoint.
+
+        The endpoint listens on bind, the loopback interface unless a
+        scraper on another host needs it (e.g. '0.0.0.0').
+        """
+        self.event_log = event_log
+        self._stop = threading.Event()
+        if metrics_file:
+            def rewrite():
+                while not self._stop.wait(interval):
+                    self.write(metrics_file)
+            self._writer = threading.Thread(target=rewrite, daemon=True)
+            self._writer.start()
+        if port is not None:
+            from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+            metrics = self
+
+            class Handler(BaseHTTPRequestHandler):
+                def do_GET(self):
+                    body = metrics.render().encode('utf-8')
+                    self.send_response(200 if self.path.startswith('/metrics') else 404)
+                    self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                    self.send_header('Content-Length', str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+
+                def log_message(self, format, *args):
+                    pass
+
+            self._server = ThreadingHTTPServer((bind, port), Handler)
+            self._server.daemon_threads = True
+            threading.Thread(target=self._server.serve_forever, daemon=True).start()
+            host, port = self._server.server_address[:2]
+            print(f'Serving metrics on http://{host}:{port}/metrics')
+
+    def stop(self, metrics_file=None):
+        self._stop.set()
+        self.event_log = None
+        if metrics_file:
+            self.write(metrics_file)
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+
+# Metrics of this process, recorded by the session, transfer and scheduling code
+METRICS = Metrics()
+
+
+class TokenCookiePolicy(DefaultCookiePolicy):
+    """Keeps JSESSIONID out of the pooled cookie jar.
+
+    The token goes with each request instead (see RestSession.get); a copy
+    in the jar would be sent along with it, so a request could carry the
+    old and the new token at once.
+    """
+
+    def set_ok(self, cookie, request):
+        return cookie.name != 'JSESSIONID' and super().set_ok(cookie, request)
+
+
+class RestSession:
+    """One XNAT JSESSION used over a shared, pooled requests.Session.
+
+    Each login gets its own RestSession, so a refresh can tell a stale
+    session from the current one, while all of them reuse one connection
+    pool. Talks to the REST endpoints directly; no schemas are fetched.
+    """
+
+    def __init__(self, host, http, jsession, expires_at):
+        self.host = host.rstrip('/')
+        self.http = http
+        self.jsession = jsession
+        self.expires_at = expires_at
+
+    @classmethod
+    def login(cls, host, username, password, http):
+        # Read SESSION_EXPIRATION_TIME of this login, not an older one
+        http.cookies.clear()
+        started = time.time()
         try:
-            session.disconnect()
-        except Exception as e:
-            # Ignore disconnect errors - session is ending anyway
-            print(f"Note: Session disconnect error (ignoring): {e}")
+            jsession = login(host, username, password, http)
+        except HttpStatusError as e:
+            METRICS.api_call('login', time.time() - started, e.status)
+            raise
+        METRICS.api_call('login', time.time() - started, 200)
+        return cls(host, http, jsession, session_expiry(http.cookies.get('SESSION_EXPIRATION_TIME')))
+
+    def expiring(self):
+        return time.time() > self.expires_at - SESSION_RENEW_MARGIN
+
+    def get(self, url, **kwargs):
+        # The token is sent per request so older sessions keep working for in-flight transfers
+        call = api_call_type(url, kwargs.get('params'))
+        started = time.time()
+        try:
+            response = self.http.get(url, cookies={'JSESSIONID': self.jsession}, **kwargs)
+        except Exception:
+            METRICS.api_call(call, time.time() - started, 'error')
+            raise
+        # Downloads stream, so this is the time to the response headers
+        METRICS.api_call(call, time.time() - started, response.status_code)
+        # XNAT restarts the idle timeout on every request and says so in this cookie
+        expiration = response.cookies.get('SESSION_EXPIRATION_TIME')
+        if expiration and response.status_code == 200:
+            self.expires_at = max(self.expires_at, session_expiry(expiration))
+        return response
+
+    def get_json(self, path, query=None):
+        params = dict(query or {})
+        params['format'] = 'json'
+        url = self.host + path
+        response = self.get(url, params=params, timeout=DOWNLOAD_TIMEOUT)
+        if response.status_code != 200:
+            raise HttpStatusError(url, response)
+        return response.json()
+
+    def disconnect(self):
+        self.http.delete(self.host + '/data/JSESSION', cookies={'JSESSIONID': self.jsession},
+                         timeout=DOWNLOAD_TIMEOUT)
 
 
 def download_with_retry(download_func, filepath, max_retries=3):
@@ -89,273 +356,3936 @@ def download_with_retry(download_func, filepath, max_retries=3):
     return False
 
 
-# List all types in project
-def list_types(collectionURL,myProjectID):
+def row_value(row, *keys):
+    """Return the first non-empty column from a REST result row (keys are case-insensitive)"""
+    lowered = {k.lower(): v for k, v in row.items()}
+    for key in keys:
+        value = lowered.get(key.lower())
+        if value not in (None, ''):
+            return value
+    return None
+
+
+class CatalogEntry:
+    """One experiment or assessor as listed by the bulk catalog queries"""
+
+    def __init__(self, kind, id, label, xsi_type, subject, experiment, experiment_id,
+                 uri, last_modified=None, size=None):
+        self.kind = kind
+        self.id = id
+        self.label = label
+        self.xsi_type = xsi_type
+        self.subject = subject
+        self.experiment = experiment
+        self.experiment_id = experiment_id
+        self.uri = uri
+        self.last_modified = last_modified
+        self.size = size
+        # XNAT file listing of uri, kept when it was fetched for the size
+        self.file_catalog = None
+
+
+class ProjectCatalog:
+    """All experiments and assessors of a project, fetched with a few paged REST calls.
+
+    Replaces walking project -> subject -> experiment -> assessor objects,
+    which costs several requests per subject before any data moves.
+    """
+
+    EXPERIMENT_COLUMNS = ('ID,label,xsiType,subject_ID,subject_label,insert_date,'
+                          'xnat:experimentData/meta/last_modified')
+    ASSESSOR_COLUMNS = ('ID,label,xsiType,xnat:imageAssessorData/imageSession_ID,insert_date,'
+                        'xnat:experimentData/meta/last_modified')
+    # Column the listing is date-filtered on by fetch(since=...)
+    MODIFIED_COLUMN = 'xnat:experimentData/meta/last_modified'
+
+    def __init__(self, myProjectID, page_size=5000):
+        self.project = myProjectID
+        self.page_size = page_size
+        self.api_calls = 0
+        self.experiments = []
+        self.assessors = []
+
+    def _fetch_rows(self, get_json, xsi_type, columns, filters=None):
+        rows = []
+        seen = set()
+        offset = 0
+        while True:
+            query = {'project': self.project, 'xsiType': xsi_type, 'columns': columns,
+                     'offset': str(offset), 'limit': str(self.page_size)}
+            query.update(filters or {})
+            result = get_json('/data/experiments', query=query)
+            self.api_calls += 1
+            result_set = result.get('ResultSet', {})
+            page = result_set.get('Result', [])
+            new_rows = [r for r in page if row_value(r, 'ID') not in seen]
+            seen.update(row_value(r, 'ID') for r in new_rows)
+            rows.extend(new_rows)
+            total = result_set.get('totalRecords')
+            # Servers that ignore offset/limit return everything (or the same page again)
+            if len(page) != self.page_size or not new_rows:
+                break
+            if total is not None and len(rows) >= int(total):
+                break
+            offset += self.page_size
+        return rows
+
+    def fetch(self, get_json, since=None, known=None):
+        """Populate the catalog using get_json(path, query=...) and return self.
+
+        With since, only objects modified after that date are listed (rows
+        the server returns anyway are dropped here); known maps session IDs
+        to entries of an earlier listing, for assessors of unlisted sessions.
+        """
+        filters = {self.MODIFIED_COLUMN: '>' + since} if since else None
+        experiment_rows = self._fetch_rows(get_json, 'xnat:subjectAssessorData', self.EXPERIMENT_COLUMNS, filters)
+        assessor_rows = self._fetch_rows(get_json, 'xnat:imageAssessorData', self.ASSESSOR_COLUMNS, filters)
+        if since:
+            modified = lambda row: row_value(row, 'xnat:experimentData/meta/last_modified', 'last_modified',
+                                             'insert_date')
+            experiment_rows = [r for r in experiment_rows if not modified(r) or modified(r) > since]
+            assessor_rows = [r for r in assessor_rows if not modified(r) or modified(r) > since]
+
+        by_id = dict(known or {})
+        self.experiments = []
+        for row in experiment_rows:
+            myExperimentID = row_value(row, 'ID')
+            entry = CatalogEntry(
+                'experiment', myExperimentID, row_value(row, 'label'), row_value(row, 'xsiType', 'xsi:type'),
+                row_value(row, 'subject_label'), row_value(row, 'label'), myExperimentID,
+                '/data/experiments/' + myExperimentID + '/scans/ALL/files',
+                last_modified=row_value(row, 'xnat:experimentData/meta/last_modified', 'last_modified', 'insert_date'),
+                size=int(row_value(row, 'size')) if row_value(row, 'size') else None)
+            by_id[myExperimentID] = entry
+            self.experiments.append(entry)
+
+        self.assessors = []
+        for row in assessor_rows:
+            session_id = row_value(row, 'xnat:imageAssessorData/imageSession_ID', 'session_ID', 'imageSession_ID')
+            parent = by_id.get(session_id)
+            if parent is None:
+                # Session not visible in this project
+                continue
+            myAssessorID = row_value(row, 'ID')
+            self.assessors.append(CatalogEntry(
+                'assessor', myAssessorID, row_value(row, 'label'), row_value(row, 'xsiType', 'xsi:type'),
+                parent.subject, parent.label, parent.id,
+                '/data/experiments/' + parent.id + '/assessors/' + myAssessorID + '/files',
+                last_modified=row_value(row, 'xnat:experimentData/meta/last_modified', 'last_modified', 'insert_date'),
+                size=int(row_value(row, 'size')) if row_value(row, 'size') else None))
+
+        self.experiments.sort(key=lambda x: (x.subject or '', x.label or ''))
+        return self
+
+    FIELDS = ('kind', 'id', 'label', 'xsi_type', 'subject', 'experiment', 'experiment_id', 'uri',
+              'last_modified', 'size')
+
+    def to_dict(self):
+        return {'project': self.project,
+                'experiments': [{f: getattr(e, f) for f in self.FIELDS} for e in self.experiments],
+                'assessors': [{f: getattr(a, f) for f in self.FIELDS} for a in self.assessors]}
+
+    @classmethod
+    def from_dict(cls, data):
+        catalog = cls(data['project'])
+        catalog.experiments = [CatalogEntry(*(e[f] for f in cls.FIELDS)) for e in data['experiments']]
+        catalog.assessors = [CatalogEntry(*(a[f] for f in cls.FIELDS)) for a in data['assessors']]
+        return catalog
+
+    def entries(self):
+        return self.experiments + self.assessors
+
+    def latest_modified(self):
+        dates = [e.last_modified for e in self.entries() if e.last_modified]
+        return max(dates) if dates else None
+
+    def changes(self, listed):
+        """Catalog of the objects in listed that are new or modified compared with self.
+
+        Sessions of changed assessors are included as well, since entries are
+        planned per session; unchanged ones are skipped via the sync index.
+        """
+        known = {(e.id, e.last_modified) for e in self.entries()}
+        delta = ProjectCatalog(self.project)
+        delta.assessors = [a for a in listed.assessors if (a.id, a.last_modified) not in known]
+        changed = {e.id for e in listed.experiments if (e.id, e.last_modified) not in known}
+        parents = {a.experiment_id for a in delta.assessors}
+        sessions = {e.id: e for e in self.experiments}
+        sessions.update((e.id, e) for e in listed.experiments)
+        delta.experiments = [sessions[i] for i in sorted(changed | parents) if i in sessions]
+        delta.experiments.sort(key=lambda x: (x.subject or '', x.label or ''))
+        return delta
+
+    def merge(self, delta):
+        """Add or replace the entries of delta"""
+        for name in ('experiments', 'assessors'):
+            updated = {e.id: e for e in getattr(delta, name)}
+            entries = [updated.pop(e.id, e) for e in getattr(self, name)] + list(updated.values())
+            setattr(self, name, entries)
+        self.experiments.sort(key=lambda x: (x.subject or '', x.label or ''))
+
+    def assessors_by_experiment(self):
+        grouped = {}
+        for a in self.assessors:
+            grouped.setdefault(a.experiment_id, []).append(a)
+        return grouped
+
+    def subjects(self):
+        """Yield (subject label, experiments) in subject order"""
+        grouped = {}
+        for e in self.experiments:
+            grouped.setdefault(e.subject, []).append(e)
+        for subject in sorted(grouped):
+            yield subject, grouped[subject]
+
+
+def fetch_catalog(shared, myProjectID, since=None, known=None):
+    """Fetch the project catalog, logging in again once on 401 (since/known: see ProjectCatalog.fetch)"""
+    started = time.time()
+    mySession = shared.session
+    for attempt in range(2):
+        try:
+            catalog = ProjectCatalog(myProjectID).fetch(mySession.get_json, since, known)
+            break
+        except Exception as e:
+            if attempt == 0 and session_expired(e):
+                print('✗ Session expired while listing, refreshing and retrying...')
+                mySession = shared.refresh(mySession)
+            else:
+                raise
+    print(('Modified since ' + since + ': ' if since else 'Catalog: ')
+          + f'{len(catalog.experiments)} experiments, {len(catalog.assessors)} assessors '
+          f'from {catalog.api_calls} API calls in {time.time() - started:.1f}s')
+    return catalog
+
+
+def catalog_cache_path(collectionURL, myProjectID, projDir=None):
+    """Catalog cache file: in the project output directory, else in the user cache dir"""
+    if projDir is not None and os.path.isdir(projDir):
+        return os.path.join(projDir, '.catalog_cache.json')
+    root = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    host = ''.join(c if c.isalnum() or c in '.-' else '_' for c in collectionURL.split('://')[-1].rstrip('/'))
+    return os.path.join(root, 'xnat_download', f'{host}_{myProjectID}.json')
+
+
+def load_cached_catalog(path, collectionURL):
+    """(catalog, age in seconds) from a catalog cache file, or (None, None)"""
+    try:
+        with open(path) as f:
+            data = json.load(f)
+        if data.get('host') != collectionURL.rstrip('/'):
+            return None, None
+        return ProjectCatalog.from_dict(data['catalog']), time.time() - data['fetched']
+    except (OSError, ValueError, KeyError, TypeError):
+        return None, None
+
+
+def save_cached_catalog(path, collectionURL, catalog, fetched=None):
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    # Nodes of a sharded run share the cache file; each writes its own temporary file, the last rename wins
+    fd, tmp = tempfile.mkstemp(prefix='.catalog_cache.', suffix='.tmp', dir=directory)
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'host': collectionURL.rstrip('/'), 'fetched': fetched or time.time(),
+                       'catalog': catalog.to_dict()}, f)
+        os.replace(tmp, path)
+    except BaseException:
+        os.remove(tmp)
+        raise
+
+
+def project_catalog(shared, myProjectID, projDir=None, max_age=None):
+    """Catalog of a project, from the cache when younger than max_age seconds.
+
+    Without max_age the catalog is always listed again (downloads must see
+    new and modified objects); sizes learned earlier are carried over for
+    objects whose last-modified date hasn't changed, and the result is
+    written back to the cache.
+    """
+    path = catalog_cache_path(shared.collectionURL, myProjectID, projDir)
+    cached, age = load_cached_catalog(path, shared.collectionURL)
+    if cached is not None and max_age is not None and age <= max_age:
+        print(f'Catalog: {len(cached.experiments)} experiments, {len(cached.assessors)} assessors '
+              f'from cache ({format_duration(age)} old)')
+        cached.cache_path = path
+        return cached
+    catalog = fetch_catalog(shared, myProjectID)
+    if cached is not None:
+        known = {(e.id, e.last_modified): e.size for e in cached.entries() if e.size is not None}
+        for e in catalog.entries():
+            if e.size is None:
+                e.size = known.get((e.id, e.last_modified))
+    try:
+        save_cached_catalog(path, shared.collectionURL, catalog)
+    except OSError as e:
+        print(f'Note: could not cache the catalog: {e}')
+    catalog.cache_path = path
+    return catalog
+
+
+def update_cached_catalog(shared, catalog):
+    """Write sizes learned during the run back to the catalog cache"""
+    path = getattr(catalog, 'cache_path', None)
+    if path is None:
+        return
+    _, age = load_cached_catalog(path, shared.collectionURL)
+    try:
+        save_cached_catalog(path, shared.collectionURL, catalog,
+                            fetched=time.time() - age if age is not None else None)
+    except OSError:
+        pass
+
+
+def format_bytes(count):
+    if count is None:
+        return '?'
+    for unit, scale in (('TB', 1e12), ('GB', 1e9), ('MB', 1e6), ('kB', 1e3)):
+        if count >= scale:
+            return f'{count / scale:.1f} {unit}'
+    return f'{count} B'
+
+
+def local_size(path):
+    """Bytes of a downloaded zip or extracted directory, None when absent"""
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    if os.path.isdir(path):
+        return sum(os.path.getsize(os.path.join(root, name))
+                   for root, dirs, files in os.walk(path) for name in files)
+    return None
+
+
+# Inventory of the types in a project
+def list_types(collectionURL,myProjectID,myWorkingDirectory=None,workers=1,sizes=False,max_age=CATALOG_MAX_AGE,
+               username=None,password=None):
+    """Per-type counts and sizes of a project, and how much of it is already in myWorkingDirectory.
+
+    With sizes, sizes unknown to the catalog cache cost one file listing
+    per object (spread over workers) the first time and are cached
+    afterwards; otherwise they are reported as unknown.
+    """
     print('Scanning project ... ' + myProjectID)
-    jsession=login(collectionURL,username,password)
-
-    experiment_types = set()
-    assessor_types = set()
-
-    with xnat_session_safe(collectionURL, jsession) as mySession:
-        myProject= mySession.projects[myProjectID]
-        mySubjectsList = myProject.subjects.values()
-        for s in mySubjectsList:
-            mySubjectID = s.label
-            mySubject = myProject.subjects[mySubjectID]
-            myExperimentsList = mySubject.experiments.values()
-
-            for e in myExperimentsList:
-                myExperimentType = type(e).__name__ if not hasattr(e, 'xsi_type') else e.xsi_type
-                experiment_types.add(myExperimentType)
-
-                myExperiment = mySubject.experiments[e.label]
-                myAssessorsList = myExperiment.assessors.values()
-                for a in myAssessorsList:
-                    myAssessorType = type(a).__name__ if not hasattr(a, 'xsi_type') else a.xsi_type
-                    assessor_types.add(myAssessorType)
-
-    print('\nExperiment types found:')
-    for exp_type in sorted(experiment_types):
-        print(f'  {exp_type}')
-
-    print('\nAssessor types found:')
-    if assessor_types:
-        for ass_type in sorted(assessor_types):
-            print(f'  {ass_type}')
-    else:
-        print('  (none)')
+    projDir = os.path.join(os.path.abspath(myWorkingDirectory), myProjectID) if myWorkingDirectory else None
 
-    return
+    shared = SharedSession(collectionURL, username, password, pool_size=workers)
+    index = None
+    try:
+        catalog = project_catalog(shared, myProjectID, projDir, max_age)
+        unknown = [DownloadTask(e, None) for e in catalog.entries() if e.size is None]
+        if sizes and unknown:
+            if projDir is not None and os.path.exists(os.path.join(projDir, '.sync_index.sqlite')):
+                index = SyncIndex(os.path.join(projDir, '.sync_index.sqlite'))
+            fetch_sizes(shared, unknown, workers, index)
+            update_cached_catalog(shared, catalog)
+    finally:
+        shared.close()
+        if index is not None:
+            index.close()
 
-# Download data from XNAT in .zip format
-def xnat_collection(myWorkingDirectory,collectionURL,myProjectID):
-    # Create output directory if it doesn't exist
-    if not os.path.exists(myWorkingDirectory):
-        os.makedirs(myWorkingDirectory)
-        print(f'Created output directory: {myWorkingDirectory}')
-    os.chdir(myWorkingDirectory)
-    projDir=myWorkingDirectory + '/' + myProjectID
-    if os.path.exists(projDir) == False:
-        os.makedirs(projDir)
-    print('Downloading project ... ' + myProjectID)
+    for title, entries in (('Experiment types', catalog.experiments), ('Assessor types', catalog.assessors)):
+        print(f'\n{title}:')
+        if not entries:
+            print('  (none)')
+            continue
+        by_type = {}
+        for e in entries:
+            by_type.setdefault(e.xsi_type, []).append(e)
+        print(f"  {'Type':<32} {'Count':>7} {'Total':>10} {'Average':>10}"
+              + (f" {'Local':>7} {'Local size':>11}" if projDir else ''))
+        for xsi_type in sorted(by_type, key=str):
+            group = by_type[xsi_type]
+            known = [e.size for e in group if e.size is not None]
+            total = sum(known) if len(known) == len(group) else None
+            average = sum(known) / len(known) if known else None
+            line = (f'  {str(xsi_type):<32} {len(group):>7} {format_bytes(total):>10} '
+                    f'{format_bytes(int(average)) if average is not None else "?":>10}')
+            if projDir:
+                present = [s for s in (local_size(os.path.join(projDir, e.subject or '', e.label + '.zip'))
+                                       or local_size(os.path.join(projDir, e.subject or '', e.label))
+                                       for e in group) if s is not None]
+                line += f' {len(present):>7} {format_bytes(sum(present)):>11}'
+            print(line)
+    return catalog
+
+
+class SharedSession:
+    """JSESSION manager shared by the catalog listing and all download workers.
+
+    Keeps one pooled requests.Session for the whole run and renews the
+    JSESSION shortly before it expires. When several workers hit a 401 at
+    once only the first one logs in again, the others pick up its session.
+    The first login happens on first use, so runs answered from local
+    caches never log in.
+    """
+
+    def __init__(self, collectionURL, username, password, pool_size=1):
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        if username is None or password is None:
+            raise ValueError('an XNAT username and password are required')
+        self.collectionURL = collectionURL
+        self.pool_size = pool_size
+        self.username = username
+        self.password = password
+        self.refresh_count = 0
+        self._lock = threading.Lock()
+        self._retired = []
+        self.http = requests.Session()
+        self.http.cookies.set_policy(TokenCookiePolicy())
+        # One keep-alive connection per worker instead of the requests default of 10
+        adapter = HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size)
+        self.http.mount('http://', adapter)
+        self.http.mount('https://', adapter)
+        self._session = None
+
+    def _connect(self):
+        return RestSession.login(self.collectionURL, self.username, self.password, self.http)
+
+    @property
+    def session(self):
+        current = self._session
+        if current is None:
+            with self._lock:
+                if self._session is None:
+                    self._session = self._connect()
+                current = self._session
+        if current.expiring():
+            print('[Session] Renewing JSESSION before it expires')
+            current = self.refresh(current, reason='expiring')
+        return current
+
+    def refresh(self, stale_session=None, reason='unauthorized'):
+        """Log in again unless another thread already replaced stale_session"""
+        with self._lock:
+            if stale_session is not None and stale_session is not self._session:
+                return self._session
+            # Workers may still be streaming with the old token, end it at close()
+            if self._session is not None:
+                self._retired.append(self._session)
+            self._session = self._connect()
+            self.refresh_count += 1
+            METRICS.inc('xnat_session_refresh_total', reason=reason)
+            METRICS.event('session_refresh', reason=reason)
+            return self._session
+
+    def close(self):
+        with self._lock:
+            sessions = self._retired + ([self._session] if self._session is not None else [])
+            self._retired = []
+        for session in sessions:
+            try:
+                session.disconnect()
+            except Exception as e:
+                # Ignore disconnect errors - session is ending anyway
+                print(f"Note: Session disconnect error (ignoring): {e}")
+        self.http.close()
+
+
+class DownloadStats:
+    """Progress counters updated from the walker and the download workers"""
+
+    def __init__(self, initial=None, parent=None):
+        self._lock = threading.Lock()
+        # Batch-wide stats that downloads and failures are also counted in
+        self.parent = parent
+        self.counters = {'subjects_processed': 0, 'files_downloaded': 0, 'files_skipped': 0, 'last_subject': None}
+        if initial:
+            self.counters.update(initial)
+        self.run_files = 0
+        self.run_bytes = 0
+        self.run_failed = 0
+        self.planned_files = 0
+        self.planned_bytes = None
+        self.started = time.time()
+
+    def add(self, key, count=1):
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + count
+
+    def set(self, key, value):
+        with self._lock:
+            self.counters[key] = value
+
+    def record_download(self, size):
+        with self._lock:
+            self.counters['files_downloaded'] += 1
+            self.run_files += 1
+            self.run_bytes += size
+        if self.parent is not None:
+            self.parent.record_download(size)
+
+    def record_failure(self):
+        with self._lock:
+            self.run_failed += 1
+        if self.parent is not None:
+            self.parent.record_failure()
+
+    def record_retry(self):
+        """Take back a failure whose transfer is queued to be tried again"""
+        with self._lock:
+            self.run_failed -= 1
+        if self.parent is not None:
+            self.parent.record_retry()
 
-    # Track progress
-    progress_file = os.path.join(projDir, '.download_progress.json')
-    download_stats = {'subjects_processed': 0, 'files_downloaded': 0, 'files_skipped': 0, 'last_subject': None}
+    def snapshot(self):
+        with self._lock:
+            return dict(self.counters)
 
-    if os.path.exists(progress_file):
+    def plan(self, files, total_bytes=None):
+        """Record the queued work; total_bytes only when every size is known"""
+        with self._lock:
+            self.planned_files = files
+            self.planned_bytes = total_bytes
+
+    def unplan(self, size=None):
+        """Drop a queued object another node took care of"""
+        with self._lock:
+            self.planned_files -= 1
+            if self.planned_bytes is not None and size:
+                self.planned_bytes -= size
+
+    def done_count(self):
+        with self._lock:
+            return self.run_files + self.run_failed
+
+    def eta(self):
+        """Progress line with the estimated time to completion"""
+        with self._lock:
+            elapsed = max(time.time() - self.started, 1e-6)
+            done = self.run_files + self.run_failed
+            remaining = self.planned_files - done
+            line = f'[ETA] {done}/{self.planned_files} done'
+            if self.planned_bytes and self.run_bytes:
+                rate = self.run_bytes / elapsed
+                left = max(0, self.planned_bytes - self.run_bytes)
+                line += f', {left / 1e9:.1f} GB left at {rate / 1e6:.1f} MB/s'
+                seconds = left / rate
+            elif done:
+                seconds = remaining * elapsed / done
+            else:
+                return line
+        return line + f', ~{format_duration(seconds)} remaining'
+
+    def save(self, progress_file):
+        # Hold the lock while writing so two checkpoints never interleave
+        with self._lock:
+            with open(progress_file, 'w') as f:
+                json.dump(self.counters, f)
+
+    def throughput(self, workers):
+        with self._lock:
+            elapsed = max(time.time() - self.started, 1e-6)
+            return {
+                'finished': datetime.datetime.now().isoformat(timespec='seconds'),
+                'workers': workers,
+                'elapsed_s': round(elapsed, 1),
+                'files': self.run_files,
+                'failed': self.run_failed,
+                'bytes': self.run_bytes,
+                'files_per_s': round(self.run_files / elapsed, 3),
+                'mb_per_s': round(self.run_bytes / elapsed / 1e6, 3),
+            }
+
+
+class SyncIndex:
+    """SQLite record of every object synced into a project directory.
+
+    Keyed by XNAT ID; a re-run compares the catalog's last-modified value
+    with the stored one and only transfers new or changed objects.
+    """
+
+    SCHEMA = '''CREATE TABLE IF NOT EXISTS objects (
+        xnat_id TEXT PRIMARY KEY,
+        kind TEXT,
+        label TEXT,
+        subject TEXT,
+        experiment TEXT,
+        xsi_type TEXT,
+        last_modified TEXT,
+        size INTEGER,
+        local_path TEXT,
+        status TEXT,
+        updated TEXT,
+        md5 TEXT,
+        verified TEXT,
+        selection TEXT
+    )'''
+    COLUMNS = ('xnat_id', 'kind', 'label', 'subject', 'experiment', 'xsi_type', 'last_modified',
+               'size', 'local_path', 'status', 'updated', 'md5', 'verified', 'selection')
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._create()
+
+    def _create(self):
+        self._conn.execute(self.SCHEMA)
+        # Indexes created by older versions lack the later columns
+        existing = set(row[1] for row in self._conn.execute('PRAGMA table_info(objects)'))
+        for column in self.COLUMNS:
+            if column not in existing:
+                self._conn.execute(f'ALTER TABLE objects ADD COLUMN {column} TEXT')
+        self._conn.commit()
+
+    @classmethod
+    def snapshot(cls, path):
+        """In-memory copy of the index at path (empty when there is none), for dry runs.
+
+        SQLite leaves -wal and -shm files next to a WAL database even when
+        it is opened read-only, so the copy is read from a temporary
+        directory and nothing is written to the tree.
+        """
+        index = cls(':memory:')
+        if os.path.exists(path):
+            scratch = tempfile.mkdtemp(prefix='xnat_index_')
+            try:
+                copy = os.path.join(scratch, 'index.sqlite')
+                # Changes a running download hasn't checkpointed yet are in the -wal file
+                for suffix in ('', '-wal'):
+                    if os.path.exists(path + suffix):
+                        shutil.copyfile(path + suffix, copy + suffix)
+                source = sqlite3.connect(copy)
+                try:
+                    source.backup(index._conn)
+                finally:
+                    source.close()
+            finally:
+                shutil.rmtree(scratch, ignore_errors=True)
+            index._create()
+        return index
+
+    def get(self, xnat_id):
+        with self._lock:
+            cursor = self._conn.execute(
+                'SELECT ' + ', '.join(self.COLUMNS) + ' FROM objects WHERE xnat_id = ?', (xnat_id,))
+            row = cursor.fetchone()
+        if row is None:
+            return None
+        return dict(zip(self.COLUMNS, row))
+
+    def mark(self, entry, local_path, status, size=None, md5=None, verified=None, selection=None):
+        values = (entry.id, entry.kind, entry.label, entry.subject, entry.experiment, entry.xsi_type,
+                  entry.last_modified, size, local_path, status,
+                  datetime.datetime.now().isoformat(timespec='seconds'), md5, verified, selection)
+        with self._lock:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO objects (' + ', '.join(self.COLUMNS) + ') VALUES ('
+                + ', '.join('?' * len(self.COLUMNS)) + ')', values)
+            self._conn.commit()
+
+    def recorded_size(self, local_path):
+        with self._lock:
+            row = self._conn.execute('SELECT size FROM objects WHERE local_path = ? AND status = ?',
+                                     (local_path, 'complete')).fetchone()
+        return int(row[0]) if row and row[0] is not None else None
+
+    def set_verified(self, local_path, verified, status=None):
+        with self._lock:
+            if status is None:
+                self._conn.execute('UPDATE objects SET verified = ? WHERE local_path = ?', (verified, local_path))
+            else:
+                self._conn.execute('UPDATE objects SET verified = ?, status = ? WHERE local_path = ?',
+                                   (verified, status, local_path))
+            self._conn.commit()
+
+    def state(self, entry, local_path, on_disk, selection=None, record=True, adopt=True):
+        """Classify entry as 'new', 'changed' or 'unchanged' against the index.
+
+        Files already on disk but missing from the index (trees downloaded
+        before the index existed) are adopted as unchanged, unless record
+        is False (dry runs). With adopt False their version is unknown (e.g.
+        another node downloaded them) and they count as new. A different
+        scan/resource selection than last time counts as changed.
+        """
+        row = self.get(entry.id)
+        if row is None:
+            if on_disk and adopt:
+                if record:
+                    size = os.path.getsize(local_path) if os.path.isfile(local_path) else None
+                    self.mark(entry, local_path, 'complete', size=size, selection=selection)
+                return 'unchanged'
+            return 'new'
+        modified = bool(entry.last_modified) and row['last_modified'] != entry.last_modified
+        if row['status'] == 'empty' and not on_disk:
+            # Nothing matched the selection last time
+            return 'changed' if modified or row['selection'] != selection else 'unchanged'
+        if row['status'] != 'complete' or not on_disk:
+            return 'new'
+        if modified or row['selection'] != selection:
+            return 'changed'
+        return 'unchanged'
+
+    def counts(self):
+        with self._lock:
+            return dict(self._conn.execute('SELECT status, COUNT(*) FROM objects GROUP BY status').fetchall())
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+# ioctl number of FICLONE (Linux reflink: btrfs, XFS, bcachefs, ...)
+FICLONE = 0x40049409
+
+
+def clone_file(source, target, method='auto'):
+    """Make target a reflink, hardlink or copy of source; returns the method used.
+
+    auto tries a reflink first (copy-on-write, no shared inode), then a
+    hardlink (same filesystem only), then a plain copy.
+    """
+    if method in ('auto', 'reflink'):
         try:
-            with open(progress_file, 'r') as f:
-                download_stats = json.load(f)
-            print(f"Resuming from subject: {download_stats['last_subject']}")
-            print(f"Previously: {download_stats['subjects_processed']} subjects, {download_stats['files_downloaded']} downloaded, {download_stats['files_skipped']} skipped")
-        except:
-            pass
+            import fcntl
+            with open(source, 'rb') as src, open(target, 'wb') as dst:
+                fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+            return 'reflink'
+        except (ImportError, OSError):
+            if os.path.exists(target):
+                os.remove(target)
+            if method == 'reflink':
+                raise
+    if method in ('auto', 'hardlink'):
+        try:
+            os.link(source, target)
+            return 'hardlink'
+        except OSError:
+            if method == 'hardlink':
+                raise
+    shutil.copyfile(source, target)
+    return 'copy'
+
+
+class ObjectCache:
+    """Content-addressed store of downloaded zips shared by several outputs and projects.
+
+    Blobs are stored once per MD5 under objects/; keys map an XNAT object
+    (host, ID, last-modified and scan/resource selection) to its blob, so a
+    session shared into several projects, or re-pulled into another
+    --output, is materialized from disk instead of downloaded again. When
+    the blobs exceed max_bytes the least recently used ones are evicted.
+    """
+
+    SCHEMA = ('CREATE TABLE IF NOT EXISTS blobs (md5 TEXT PRIMARY KEY, size INTEGER, last_used REAL)',
+              'CREATE TABLE IF NOT EXISTS keys (key TEXT PRIMARY KEY, md5 TEXT)',
+              'CREATE INDEX IF NOT EXISTS keys_md5 ON keys (md5)')
+
+    def __init__(self, root, max_bytes=None, link='auto'):
+        self.root = os.path.abspath(root)
+        self.max_bytes = max_bytes
+        self.link = link
+        self.hits = 0
+        self.saved_bytes = 0
+        self.stored = 0
+        self.evicted = 0
+        os.makedirs(os.path.join(self.root, 'objects'), exist_ok=True)
+        self._lock = threading.Lock()
+        # Several runs may share the cache, so wait for their writes
+        self._conn = sqlite3.connect(os.path.join(self.root, 'cache.sqlite'), timeout=60, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        for statement in self.SCHEMA:
+            self._conn.execute(statement)
+        self._conn.commit()
+
+    @staticmethod
+    def key(host, entry, selection_key=None):
+        """Cache key of entry, None when XNAT gives no last-modified date to validate it with"""
+        if not entry.last_modified:
+            return None
+        return '|'.join((host.rstrip('/'), entry.id, entry.last_modified, selection_key or ''))
+
+    def blob_path(self, md5):
+        return os.path.join(self.root, 'objects', md5[:2], md5 + '.zip')
 
-    # Process in batches with session refresh every 100 subjects
-    batch_size = 100
-    session_refresh_count = 0
+    def lookup(self, key):
+        """(blob path, md5, size) cached for key, or None"""
+        with self._lock:
+            row = self._conn.execute('SELECT b.md5, b.size FROM keys k JOIN blobs b ON b.md5 = k.md5 '
+                                     'WHERE k.key = ?', (key,)).fetchone()
+            if row is None:
+                return None
+            md5, size = row
+            path = self.blob_path(md5)
+            if not os.path.isfile(path) or os.path.getsize(path) != size:
+                # Removed or damaged behind our back
+                self._conn.execute('DELETE FROM keys WHERE md5 = ?', (md5,))
+                self._conn.execute('DELETE FROM blobs WHERE md5 = ?', (md5,))
+                self._conn.commit()
+                return None
+            self._conn.execute('UPDATE blobs SET last_used = ? WHERE md5 = ?', (time.time(), md5))
+            self._conn.commit()
+            self.hits += 1
+            self.saved_bytes += size
+        METRICS.inc('xnat_cache_hits_total')
+        METRICS.inc('xnat_cache_saved_bytes_total', size)
+        return path, md5, size
 
-    jsession = login(collectionURL, username, password)
+    def materialize(self, key, target):
+        """Place the cached object for key at target; returns (md5, size, method) or None on a miss"""
+        hit = self.lookup(key)
+        if hit is None:
+            return None
+        path, md5, size = hit
+        part = target + '.part'
+        if os.path.exists(part):
+            os.remove(part)
+        method = clone_file(path, part, self.link)
+        os.replace(part, target)
+        return md5, size, method
 
-    with xnat_session_safe(collectionURL, jsession) as mySession:
-        myProject= mySession.projects[myProjectID]
-        mySubjectsList = myProject.subjects.values()
-        for subject_idx, s in enumerate(mySubjectsList):
-            mySubjectID = s.label
+    def store(self, key, source, md5, size):
+        """Add a finished download to the cache under key"""
+        blob = self.blob_path(md5)
+        if not os.path.exists(blob):
+            os.makedirs(os.path.dirname(blob), exist_ok=True)
+            tmp = f'{blob}.{os.getpid()}.{threading.get_ident()}.tmp'
+            clone_file(source, tmp, 'auto' if self.link == 'auto' else 'copy')
+            os.replace(tmp, blob)
+        with self._lock:
+            self._conn.execute('INSERT OR REPLACE INTO blobs (md5, size, last_used) VALUES (?, ?, ?)',
+                               (md5, size, time.time()))
+            self._conn.execute('INSERT OR REPLACE INTO keys (key, md5) VALUES (?, ?)', (key, md5))
+            self._conn.commit()
+            self.stored += 1
+        self.evict()
 
-            # Refresh session every batch_size subjects to prevent timeout
-            if subject_idx > 0 and subject_idx % batch_size == 0:
-                session_refresh_count += 1
-                print(f"\n[Session Refresh {session_refresh_count}] Refreshing login after {subject_idx} subjects...")
-                # Close current session and reconnect
+    def total_bytes(self):
+        with self._lock:
+            return self._conn.execute('SELECT COALESCE(SUM(size), 0) FROM blobs').fetchone()[0]
+
+    def evict(self):
+        """Drop least recently used blobs until the cache fits in max_bytes"""
+        if self.max_bytes is None:
+            return
+        with self._lock:
+            total = self._conn.execute('SELECT COALESCE(SUM(size), 0) FROM blobs').fetchone()[0]
+            if total <= self.max_bytes:
+                return
+            for md5, size in self._conn.execute('SELECT md5, size FROM blobs ORDER BY last_used').fetchall():
+                if total <= self.max_bytes:
+                    break
                 try:
-                    mySession.disconnect()
-                except:
+                    os.remove(self.blob_path(md5))
+                except OSError:
                     pass
-                jsession = login(collectionURL, username, password)
-                mySession = xnat.connect(collectionURL, jsession=jsession)
-                myProject = mySession.projects[myProjectID]
-                print("[Session Refresh] Reconnected successfully")
-
-            print('\nEntering subject ...' + mySubjectID)
-
-            # Build list of experiments/assessors to check before making API calls
-            subject_dir = os.path.join(myWorkingDirectory, myProjectID, mySubjectID)
-            existing_files = set()
-            if os.path.exists(subject_dir):
-                existing_files = set(os.listdir(subject_dir))
-
-            mySubject = myProject.subjects[mySubjectID]
-            myExperimentsList = mySubject.experiments.values()
-
-            subject_has_data = False
-            subject_downloaded = 0
-            subject_skipped = 0
-
-            # Process experiments
-            for e in myExperimentsList:
-              try:
-                myExperimentID = e.label
-                myExperimentType = type(e).__name__ if not hasattr(e, 'xsi_type') else e.xsi_type
-
-                # Filter by session label if specified
-                if args.xnat_session and myExperimentID != args.xnat_session:
-                    continue
+                self._conn.execute('DELETE FROM keys WHERE md5 = ?', (md5,))
+                self._conn.execute('DELETE FROM blobs WHERE md5 = ?', (md5,))
+                total -= size
+                self.evicted += 1
+            self._conn.commit()
 
-                # Download experiments if mode allows
-                if args.download_mode in ['experiments', 'both']:
-                    # Filter by experiment type if specified
-                    if args.xnat_experiment_type and myExperimentType != args.xnat_experiment_type:
-                        continue
+    def close(self):
+        with self._lock:
+            self._conn.close()
 
-                    # Check if already downloaded before accessing XNAT API
-                    experiment_filename = myExperimentID + '.zip'
-                    if experiment_filename in existing_files:
-                        subject_skipped += 1
-                        print(f'(skip) {myExperimentID} - already downloaded')
-                        subject_has_data = True
-                    else:
-                        if args.xnat_experiment_type:
-                            print(f'✓ Match found: {myExperimentID} - type {myExperimentType} matches filter {args.xnat_experiment_type}')
-                        print('Downloading experiment: ' + myExperimentID + ' (type: ' + myExperimentType + ')')
-
-                        # Create subject directory only when we have data to download
-                        if not subject_has_data:
-                            if not os.path.exists(subject_dir):
-                                os.makedirs(subject_dir)
-                            subject_has_data = True
-
-                        myExperiment = mySubject.experiments[myExperimentID]
-                        myzip = os.path.join(subject_dir, experiment_filename)
-
-                        # Retry download with session refresh on 401
-                        download_success = False
-                        for retry_attempt in range(3):
-                            try:
-                                myExperiment.download(myzip)
-                                subject_downloaded += 1
-                                print(f'✓ Downloaded: {experiment_filename}')
-                                download_success = True
-                                break
-                            except Exception as e:
-                                if '401' in str(e) or 'Unauthorized' in str(e):
-                                    print(f'✗ Session expired, refreshing and retrying (attempt {retry_attempt + 1}/3)...')
-                                    # Refresh session
-                                    try:
-                                        mySession.disconnect()
-                                    except:
-                                        pass
-                                    jsession = login(collectionURL, username, password)
-                                    mySession = xnat.connect(collectionURL, jsession=jsession)
-                                    myProject = mySession.projects[myProjectID]
-                                    mySubject = myProject.subjects[mySubjectID]
-                                    myExperiment = mySubject.experiments[myExperimentID]
-                                    # Retry download on next loop iteration
-                                else:
-                                    # Log the failed experiment and continue to next
-                                    print(f'✗ Failed to download experiment "{myExperimentID}": {e}')
-                                    print(f'  Continuing with remaining downloads...')
-                                    break  # Don't retry non-auth errors
-
-                # Process assessors for this experiment if mode allows
-                if args.download_mode in ['assessors', 'both']:
-                    myExperiment = mySubject.experiments[myExperimentID]
-                    myAssessorsList = myExperiment.assessors.values()
-                    for a in myAssessorsList:
-                        myAssessorID = a.label
-                        myAssessorType = type(a).__name__ if not hasattr(a, 'xsi_type') else a.xsi_type
-
-                        # Filter by assessor type if specified
-                        if args.xnat_assessor_type and myAssessorType != args.xnat_assessor_type:
-                            continue
-
-                        # Check if already downloaded before accessing XNAT API
-                        assessor_filename = myAssessorID + '.zip'
-                        if assessor_filename in existing_files:
-                            subject_skipped += 1
-                            print(f'(skip) {myAssessorID} - already downloaded')
-                            subject_has_data = True
-                        else:
-                            if args.xnat_assessor_type:
-                                print(f'✓ Match found: {myAssessorID} - type {myAssessorType} matches filter {args.xnat_assessor_type}')
-                            print('Downloading assessor: ' + myAssessorID + ' (type: ' + myAssessorType + ')')
-
-                            # Create subject directory only when we have data to download
-                            if not subject_has_data:
-                                if not os.path.exists(subject_dir):
-                                    os.makedirs(subject_dir)
-                                subject_has_data = True
-
-                            myAssessor = myExperiment.assessors[myAssessorID]
-                            myzip = os.path.join(subject_dir, assessor_filename)
-
-                            # Retry download with session refresh on 401
-                            download_success = False
-                            for retry_attempt in range(3):
-                                try:
-                                    myAssessor.download(myzip)
-                                    subject_downloaded += 1
-                                    print(f'✓ Downloaded: {assessor_filename}')
-                                    download_success = True
-                                    break
-                                except Exception as e:
-                                    if '401' in str(e) or 'Unauthorized' in str(e):
-                                        print(f'✗ Session expired, refreshing and retrying (attempt {retry_attempt + 1}/3)...')
-                                        # Refresh session
-                                        try:
-                                            mySession.disconnect()
-                                        except:
-                                            pass
-                                        jsession = login(collectionURL, username, password)
-                                        mySession = xnat.connect(collectionURL, jsession=jsession)
-                                        myProject = mySession.projects[myProjectID]
-                                        mySubject = myProject.subjects[mySubjectID]
-                                        myExperiment = mySubject.experiments[myExperimentID]
-                                        myAssessor = myExperiment.assessors[myAssessorID]
-                                        # Retry download on next loop iteration
-                                    else:
-                                        # Log the failed assessor and continue to next
-                                        print(f'✗ Failed to download assessor "{myAssessorID}": {e}')
-                                        print(f'  Continuing with remaining downloads...')
-                                        break  # Don't retry non-auth errors
-
-              except Exception as exp_error:
-                # Catch any unexpected error for this experiment and continue to next
-                try:
-                    exp_label = myExperimentID
-                except NameError:
-                    exp_label = getattr(e, 'label', 'unknown')
-                print(f'✗ Failed to process experiment "{exp_label}": {exp_error}')
-                print(f'  Continuing with remaining downloads...')
+
+class IncompleteDownload(ConnectionError):
+    """The body ended before its Content-Length: the connection dropped mid-transfer"""
+
+    def __init__(self, url, received, expected):
+        super().__init__(f'Incomplete download for url {url}: got {received} of {expected} bytes')
+
+
+class HttpStatusError(Exception):
+    """Unexpected HTTP status from XNAT; keeps the status and any Retry-After delay"""
+
+    def __init__(self, url, response):
+        self.status = response.status_code
+        self.retry_after = parse_retry_after(response.headers.get('Retry-After'))
+        reason = ' Unauthorized' if self.status == 401 else ''
+        super().__init__(f'Invalid response for url {url} (status {self.status}{reason})')
+
+
+def session_expired(error):
+    """Whether a request failed because the JSESSION is no longer valid.
+
+    Only the status counts for an HTTP error; its message holds the URL,
+    whose port may well contain 401.
+    """
+    if isinstance(error, HttpStatusError):
+        return error.status == 401
+    return 'Unauthorized' in str(error)
+
+
+def parse_retry_after(value):
+    """Seconds to wait from a Retry-After header (delta-seconds or HTTP date)"""
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, when.timestamp() - time.time())
+
+
+def transfer_outcome(error):
+    """Map a failed transfer to the server-health signal the controller uses"""
+    if isinstance(error, HttpStatusError):
+        if error.status in (429, 503):
+            return 'throttled'
+        if error.status >= 500:
+            return 'error'
+        return None
+    import requests
+    if isinstance(error, (requests.exceptions.Timeout, requests.exceptions.ConnectionError)):
+        return 'timeout'
+    return None
+
+
+class AdaptiveLimiter:
+    """AIMD limit on the number of concurrent transfers.
+
+    Every successful transfer adds 1/limit to the limit (about +1 per
+    round of transfers). A 429/5xx, a timeout, or a time-to-first-byte
+    trend above latency_factor times the best seen halves it, at most
+    once per cooldown seconds. Decisions are printed and, with log_path,
+    appended there as JSON lines.
+    """
+
+    def __init__(self, max_limit, min_limit=1, latency_factor=3.0, cooldown=5.0, log_path=None):
+        self.max_limit = max_limit
+        self.min_limit = min_limit
+        self.limit = float(max(min_limit, max_limit // 2))
+        self.latency_factor = latency_factor
+        self.cooldown = cooldown
+        self.log_path = log_path
+        self.in_flight = 0
+        self.best_latency = None
+        self.latency_trend = None
+        self._last_decrease = 0.0
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        with self._cond:
+            while self.in_flight >= int(self.limit):
+                self._cond.wait()
+            self.in_flight += 1
+
+    def release(self):
+        with self._cond:
+            self.in_flight -= 1
+            self._cond.notify_all()
+
+    def record(self, outcome, latency=None):
+        """Feed one transfer result ('ok', 'throttled', 'error' or 'timeout')"""
+        with self._cond:
+            if outcome == 'ok' and latency is not None:
+                self.best_latency = latency if self.best_latency is None else min(self.best_latency, latency)
+                self.latency_trend = latency if self.latency_trend is None else 0.8 * self.latency_trend + 0.2 * latency
+                # Ignore sub-second noise, a slow server shows up in whole seconds
+                if self.latency_trend > max(1.0, self.latency_factor * self.best_latency):
+                    outcome = 'slow'
+            if outcome == 'ok':
+                old = int(self.limit)
+                self.limit = min(float(self.max_limit), self.limit + 1.0 / max(self.limit, 1.0))
+                if int(self.limit) != old:
+                    self._log(old, int(self.limit), 'healthy responses')
+                self._cond.notify_all()
+                return
+            now = time.time()
+            if now - self._last_decrease < self.cooldown:
+                return
+            self._last_decrease = now
+            old = int(self.limit)
+            self.limit = max(float(self.min_limit), self.limit / 2.0)
+            if outcome == 'slow':
+                reason = f'time to first byte {self.latency_trend:.1f}s'
+            else:
+                reason = {'throttled': 'server throttling (429/503)', 'error': 'server error (5xx)',
+                          'timeout': 'timeout or connection error'}[outcome]
+            self._log(old, int(self.limit), reason)
+
+    def _log(self, old, new, reason):
+        print(f'[Controller] concurrency {old} -> {new}: {reason}')
+        METRICS.set('xnat_concurrency_limit', new)
+        METRICS.event('concurrency', old=old, new=new, reason=reason)
+        if self.log_path:
+            with open(self.log_path, 'a') as f:
+                f.write(json.dumps({'time': datetime.datetime.now().isoformat(timespec='seconds'),
+                                    'old': old, 'new': new, 'reason': reason}) + '\n')
+
+
+class TokenBucket:
+    """Caps the combined download rate of all workers at rate bytes/s"""
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.capacity = float(burst or rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def consume(self, count):
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            # Go into debt and sleep it off, so chunks larger than the burst still pass
+            self.tokens -= count
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        if wait > 0:
+            time.sleep(wait)
+
+
+# Connect and read timeouts (seconds) for streamed downloads
+DOWNLOAD_TIMEOUT = (30, 300)
+
+
+class ZipStreamReader:
+    """Incremental parser for a zip archive that is still arriving.
+
+    feed() accepts the download chunk by chunk and decodes each member from
+    its local header, so sizes, CRCs and MD5s of the member files are known
+    without reading the archive back from disk. Stored members need their
+    sizes in the local header; deflated members may use a data descriptor,
+    as the zips XNAT streams do. The optional handler receives
+    start(name), data(bytes) and end(member) calls.
+    """
+
+    LOCAL_HEADER = b'PK\x03\x04'
+    MAX_OUTPUT = 1024 * 1024
+    DATA_DESCRIPTOR = b'PK\x07\x08'
+
+    def __init__(self, handler=None):
+        self.handler = handler
+        self.members = []
+        self.done = False
+        self._buf = bytearray()
+        self._member = None
+        self._state = 'header'
+
+    def feed(self, data):
+        self._buf += data
+        while not self.done and self._step():
+            pass
+
+    def close(self):
+        """Raise if the stream ended part-way through a member"""
+        if self._state != 'header' or (self._buf and not self.done):
+            raise ValueError('Zip stream ended inside a member')
+
+    def _step(self):
+        if self._state == 'header':
+            return self._read_header()
+        if self._state == 'data':
+            return self._read_data()
+        return self._read_descriptor()
+
+    def _read_header(self):
+        buf = self._buf
+        if len(buf) < 4:
+            return False
+        if bytes(buf[:4]) != self.LOCAL_HEADER:
+            # Central directory (or anything else) ends the member list
+            self.done = True
+            return False
+        if len(buf) < 30:
+            return False
+        flags, method = struct.unpack('<HH', buf[6:10])
+        crc, csize, usize, name_len, extra_len = struct.unpack('<IIIHH', buf[14:30])
+        header_len = 30 + name_len + extra_len
+        if len(buf) < header_len:
+            return False
+        raw_name = bytes(buf[30:30 + name_len])
+        name = raw_name.decode('utf-8' if flags & 0x800 else 'cp437')
+        extra = bytes(buf[30 + name_len:header_len])
+        zip64 = False
+        pos = 0
+        while pos + 4 <= len(extra):
+            tag, size = struct.unpack('<HH', extra[pos:pos + 4])
+            if tag == 0x0001:
+                zip64 = True
+                fields = extra[pos + 4:pos + 4 + size]
+                if usize == 0xFFFFFFFF and len(fields) >= 8:
+                    usize = struct.unpack('<Q', fields[:8])[0]
+                    fields = fields[8:]
+                if csize == 0xFFFFFFFF and len(fields) >= 8:
+                    csize = struct.unpack('<Q', fields[:8])[0]
+            pos += 4 + size
+        del buf[:header_len]
+
+        descriptor = bool(flags & 0x08)
+        if descriptor and method != 8:
+            raise ValueError(f'Cannot stream-decode {name}: size only known from the data descriptor')
+        self._member = {
+            'name': name, 'method': method, 'descriptor': descriptor, 'zip64': zip64,
+            'expected_crc': None if descriptor else crc,
+            'remaining': None if descriptor else csize,
+            'size': 0, 'crc': 0, 'md5': hashlib.md5(),
+            'inflater': zlib.decompressobj(-15) if method == 8 else None,
+        }
+        if self.handler is not None:
+            self.handler.start(name)
+        self._state = 'data'
+        return True
+
+    def _emit(self, data):
+        if not data:
+            return
+        member = self._member
+        member['size'] += len(data)
+        member['crc'] = zlib.crc32(data, member['crc'])
+        member['md5'].update(data)
+        if self.handler is not None:
+            self.handler.data(data)
+
+    def _read_data(self):
+        buf = self._buf
+        member = self._member
+        inflater = member['inflater']
+        if inflater is None:
+            if member['method'] != 0:
+                raise ValueError(f'Unsupported compression method {member["method"]} for {member["name"]}')
+            if member['remaining'] == 0:
+                self._finish_member()
+                return True
+            if not buf:
+                return False
+            take = min(len(buf), member['remaining'])
+            self._emit(bytes(buf[:take]))
+            del buf[:take]
+            member['remaining'] -= take
+            return True
+
+        take = len(buf) if member['remaining'] is None else min(len(buf), member['remaining'])
+        # Cap the output per call so a highly compressed member can't blow up memory;
+        # an empty chunk drains output zlib is still holding back
+        out = inflater.decompress(bytes(buf[:take]), self.MAX_OUTPUT)
+        if inflater.eof:
+            consumed = take - len(inflater.unused_data)
+        else:
+            consumed = take - len(inflater.unconsumed_tail)
+        del buf[:consumed]
+        if member['remaining'] is not None:
+            member['remaining'] -= consumed
+        self._emit(out)
+        if inflater.eof:
+            if member['descriptor']:
+                self._state = 'descriptor'
+            else:
+                self._finish_member()
+            return True
+        if out or consumed:
+            return True
+        if member['remaining'] == 0:
+            raise ValueError(f'Deflate stream of {member["name"]} is truncated')
+        return False
+
+    def _read_descriptor(self):
+        buf = self._buf
+        member = self._member
+        size_len = 16 if member['zip64'] else 8
+        if len(buf) < 4:
+            return False
+        start = 4 if bytes(buf[:4]) == self.DATA_DESCRIPTOR else 0
+        if len(buf) < start + 4 + size_len:
+            return False
+        member['expected_crc'] = struct.unpack('<I', buf[start:start + 4])[0]
+        del buf[:start + 4 + size_len]
+        self._finish_member()
+        return True
+
+    def _finish_member(self):
+        member = self._member
+        result = {
+            'name': member['name'],
+            'size': member['size'],
+            'md5': member['md5'].hexdigest(),
+            'crc_ok': member['expected_crc'] is None or member['expected_crc'] == member['crc'],
+        }
+        self.members.append(result)
+        if self.handler is not None:
+            self.handler.end(result)
+        self._member = None
+        self._state = 'header'
+
+
+def compare_with_file_catalog(members, catalog_rows):
+    """Compare decoded zip members with XNAT's file listing for the same URI.
+
+    Files are matched on (file name, size), plus MD5 when the catalog has a
+    digest. Returns (status, detail) with status 'ok' or 'mismatch'.
+    """
+    bad_crc = [m['name'] for m in members if not m['crc_ok']]
+    if bad_crc:
+        return 'mismatch', f'CRC error in {bad_crc[0]}'
+    zipped = {}
+    for m in members:
+        if m['name'].endswith('/'):
+            continue
+        zipped.setdefault((os.path.basename(m['name']), m['size']), []).append(m['md5'])
+    for row in catalog_rows:
+        name = os.path.basename(row_value(row, 'Name') or '')
+        size = row_value(row, 'Size')
+        key = (name, int(size) if size is not None else None)
+        digests = zipped.get(key)
+        if not digests:
+            return 'mismatch', f'{name} ({size} bytes) missing from zip'
+        digest = row_value(row, 'digest')
+        if digest and digest.lower() in digests:
+            digests.remove(digest.lower())
+        elif digest:
+            return 'mismatch', f'MD5 of {name} does not match the catalog'
+        else:
+            digests.pop()
+    extra = sum(len(d) for d in zipped.values())
+    if extra:
+        return 'mismatch', f'{extra} file(s) in zip not in the XNAT catalog'
+    return 'ok', f'{len(catalog_rows)} files match the XNAT catalog'
+
+
+def check_download(mySession, uri, members, catalog_rows=None):
+    """Check a finished download against the XNAT file catalog of the same files uri"""
+    if members is None:
+        return 'unverified', 'zip stream could not be decoded'
+    if catalog_rows is None:
+        try:
+            catalog_rows = mySession.get_json(uri).get('ResultSet', {}).get('Result', [])
+        except Exception as e:
+            return 'unverified', f'file catalog unavailable: {e}'
+    return compare_with_file_catalog(members, catalog_rows)
+
+
+def verify_zip(path, expected_size=None):
+    """Cheap structural check of a zip on disk: size and central directory.
+
+    Only the central directory is read, not the member data. Returns
+    (path, problem) where problem is None for a good file.
+    """
+    try:
+        actual_size = os.path.getsize(path)
+        if expected_size is not None and actual_size != expected_size:
+            return path, f'size {actual_size} != recorded {expected_size}'
+        with zipfile.ZipFile(path) as zf:
+            infos = zf.infolist()
+            if not infos:
+                return path, 'empty archive'
+            for info in infos:
+                # Local header + data must fit before the central directory
+                if info.header_offset + 30 + len(info.filename) + info.compress_size > zf.start_dir:
+                    return path, f'member {info.filename} extends past the data area'
+    except zipfile.BadZipFile as e:
+        return path, f'bad zip: {e}'
+    except OSError as e:
+        return path, str(e)
+    return path, None
+
+
+def process_pool(workers=None):
+    """ProcessPoolExecutor whose workers aren't forked from this (threaded) process.
+
+    Forking while download, metrics or lease threads hold locks can leave
+    the child deadlocked, so workers come from a forkserver, or are
+    spawned where there is none.
+    """
+    import multiprocessing
+    method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+    return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context(method))
+
+
+def verify_tree(myWorkingDirectory, myProjectID, workers=None):
+    """Verify every output/project/subject/*.zip in parallel across cores.
+
+    Bad files are renamed to <name>.zip.corrupt and marked in the sync
+    index, so the next download run fetches them again.
+    """
+    projDir = os.path.join(os.path.abspath(myWorkingDirectory), myProjectID)
+    if not os.path.isdir(projDir):
+        print(f'Error: {projDir} does not exist')
+        return []
+    print('Verifying project ... ' + projDir)
+    started = time.time()
+
+    index = SyncIndex(os.path.join(projDir, '.sync_index.sqlite'))
+    zips = sorted(glob.glob(os.path.join(projDir, '*', '*.zip')))
+    expected = [index.recorded_size(p) for p in zips]
+
+    bad = []
+    with process_pool(workers) as pool:
+        for path, problem in pool.map(verify_zip, zips, expected, chunksize=16):
+            if problem is None:
+                index.set_verified(path, 'ok')
                 continue
+            print(f'✗ {os.path.relpath(path, projDir)}: {problem}')
+            os.replace(path, path + '.corrupt')
+            index.set_verified(path, 'corrupt', status='corrupt')
+            bad.append({'path': path, 'problem': problem})
+    index.close()
 
-            # Update progress after each subject
-            download_stats['subjects_processed'] += 1
-            download_stats['files_downloaded'] += subject_downloaded
-            download_stats['files_skipped'] += subject_skipped
-            download_stats['last_subject'] = mySubjectID
-
-            # Save progress checkpoint every 10 subjects
-            if download_stats['subjects_processed'] % 10 == 0:
-                with open(progress_file, 'w') as f:
-                    json.dump(download_stats, f)
-                print(f"\n[Progress] Subjects: {download_stats['subjects_processed']}, Downloaded: {download_stats['files_downloaded']}, Skipped: {download_stats['files_skipped']}")
-
-    # Final progress save
-    with open(progress_file, 'w') as f:
-        json.dump(download_stats, f)
-    print(f"\n[Complete] Total subjects: {download_stats['subjects_processed']}, Downloaded: {download_stats['files_downloaded']}, Skipped: {download_stats['files_skipped']}")
-    return
-#
-print(VERSION)
-#
-#
-if args.list_types:
-    list_types(collectionURL,myProjectID)
-else:
-    if not args.output:
-        print("Error: --output is required when downloading data")
-        exit(1)
-    xnat_collection(myWorkingDirectory,collectionURL,myProjectID)
\ No newline at end of file
+    with open(os.path.join(projDir, '.verify_report.json'), 'w') as f:
+        json.dump({'checked': len(zips), 'bad': bad, 'finished': datetime.datetime.now().isoformat(timespec='seconds')}, f, indent=1)
+    print(f'\n[Verify] Checked: {len(zips)}, Bad: {len(bad)} in {time.time() - started:.1f}s')
+    if bad:
+        print('Bad files were renamed to *.zip.corrupt and will be downloaded again on the next run')
+    return bad
+
+
+# Header fields kept in the DICOM index: column, (group, element), VR used when the file doesn't say
+DICOM_TAGS = (
+    ('sop_class_uid', (0x0008, 0x0016), 'UI'),
+    ('sop_instance_uid', (0x0008, 0x0018), 'UI'),
+    ('study_date', (0x0008, 0x0020), 'DA'),
+    ('series_date', (0x0008, 0x0021), 'DA'),
+    ('modality', (0x0008, 0x0060), 'CS'),
+    ('manufacturer', (0x0008, 0x0070), 'LO'),
+    ('study_description', (0x0008, 0x1030), 'LO'),
+    ('series_description', (0x0008, 0x103E), 'LO'),
+    ('image_type', (0x0008, 0x0008), 'CS'),
+    ('patient_id', (0x0010, 0x0020), 'LO'),
+    ('slice_thickness', (0x0018, 0x0050), 'DS'),
+    ('repetition_time', (0x0018, 0x0080), 'DS'),
+    ('echo_time', (0x0018, 0x0081), 'DS'),
+    ('protocol_name', (0x0018, 0x1030), 'LO'),
+    ('study_instance_uid', (0x0020, 0x000D), 'UI'),
+    ('series_instance_uid', (0x0020, 0x000E), 'UI'),
+    ('series_number', (0x0020, 0x0011), 'IS'),
+    ('instance_number', (0x0020, 0x0013), 'IS'),
+    ('rows', (0x0028, 0x0010), 'US'),
+    ('columns', (0x0028, 0x0011), 'US'),
+)
+DICOM_COLUMNS = tuple(name for name, tag, vr in DICOM_TAGS)
+_DICOM_BY_TAG = {tag: (name, vr) for name, tag, vr in DICOM_TAGS}
+# Reading stops after this tag, well before the pixel data (7FE0,0010)
+_DICOM_LAST_TAG = max(tag for name, tag, vr in DICOM_TAGS)
+# Explicit VRs with a 2-byte reserved field and a 4-byte length
+_DICOM_LONG_VRS = {b'OB', b'OD', b'OF', b'OL', b'OV', b'OW', b'SQ', b'SV', b'UC', b'UN', b'UR', b'UT', b'UV'}
+# Never read more than this much of a file looking for the header
+DICOM_HEADER_LIMIT = 4 * 1024 * 1024
+
+
+class _DicomStream:
+    """Exact-length reads from a file object, within DICOM_HEADER_LIMIT"""
+
+    def __init__(self, f, data=b''):
+        self.f = f
+        self.buffer = data
+        self.position = 0
+
+    def read(self, size):
+        if self.position + size > DICOM_HEADER_LIMIT:
+            raise ValueError('header too long')
+        while len(self.buffer) < size:
+            chunk = self.f.read(max(size - len(self.buffer), 8192))
+            if not chunk:
+                raise EOFError
+            self.buffer += chunk
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        self.position += size
+        return data
+
+
+class _DeflatedStream:
+    """Raw-deflate decoder for the deflated explicit VR transfer syntax"""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.inflater = zlib.decompressobj(-zlib.MAX_WBITS)
+
+    def read(self, size):
+        data = b''
+        while len(data) < size:
+            try:
+                raw = self.stream.read(8192)
+            except EOFError:
+                raw = self.stream.buffer
+                self.stream.buffer = b''
+                if not raw:
+                    break
+            data += self.inflater.decompress(raw)
+        return data
+
+
+def _dicom_value(raw, vr, little):
+    if vr in ('US', 'SS', 'UL', 'SL'):
+        code = {'US': 'H', 'SS': 'h', 'UL': 'I', 'SL': 'i'}[vr]
+        count = len(raw) // struct.calcsize(code)
+        values = struct.unpack(('<' if little else '>') + code * count, raw[:count * struct.calcsize(code)])
+        return values[0] if len(values) == 1 else '\\'.join(str(v) for v in values)
+    value = raw.decode('latin-1').strip('\x00 ')
+    if vr == 'IS':
+        try:
+            return int(value)
+        except ValueError:
+            return value or None
+    return value or None
+
+
+def _skip_undefined(stream, little, explicit):
+    """Skip an undefined-length sequence or item up to its delimiter"""
+    order = '<' if little else '>'
+    while True:
+        group, element = struct.unpack(order + 'HH', stream.read(4))
+        if group == 0xFFFE:
+            length = struct.unpack(order + 'I', stream.read(4))[0]
+            if element in (0xE0DD, 0xE00D):
+                return
+            if length == 0xFFFFFFFF:
+                _skip_undefined(stream, little, explicit)
+            else:
+                stream.read(length)
+            continue
+        _read_element_value(stream, little, explicit, skip=True)
+
+
+def _read_element_value(stream, little, explicit, skip=False):
+    """VR and value bytes of the element whose tag was just read"""
+    order = '<' if little else '>'
+    vr = None
+    if explicit:
+        vr = stream.read(2)
+        if vr in _DICOM_LONG_VRS:
+            stream.read(2)
+            length = struct.unpack(order + 'I', stream.read(4))[0]
+        else:
+            length = struct.unpack(order + 'H', stream.read(2))[0]
+        vr = vr.decode('latin-1')
+    else:
+        length = struct.unpack(order + 'I', stream.read(4))[0]
+    if length == 0xFFFFFFFF:
+        _skip_undefined(stream, little, explicit)
+        return vr, None
+    raw = stream.read(length)
+    return vr, None if skip else raw
+
+
+def read_dicom_header(f):
+    """The DICOM_TAGS values of a DICOM file, read from f up to the last tag needed.
+
+    Handles Part 10 files (preamble, DICM and group 0002) in implicit or
+    explicit VR little endian, explicit big endian and deflated transfer
+    syntaxes, as well as bare implicit VR datasets. Pixel data is never
+    read. Returns None when f isn't DICOM.
+    """
+    stream = _DicomStream(f)
+    try:
+        head = stream.read(132)
+    except (EOFError, ValueError):
+        return None
+    header = {}
+    if head[128:132] == b'DICM':
+        # File meta information, always explicit VR little endian
+        transfer_syntax = '1.2.840.10008.1.2.1'
+        meta_end = None
+        while True:
+            group, element = struct.unpack('<HH', stream.read(4))
+            if group != 0x0002:
+                stream.buffer = struct.pack('<HH', group, element) + stream.buffer
+                stream.position -= 4
+                break
+            vr, raw = _read_element_value(stream, True, True)
+            if element == 0x0000 and raw is not None:
+                meta_end = stream.position + struct.unpack('<I', raw)[0]
+            elif element == 0x0010 and raw is not None:
+                transfer_syntax = raw.decode('latin-1').strip('\x00 ')
+            if meta_end is not None and stream.position >= meta_end:
+                break
+        little = transfer_syntax != '1.2.840.10008.1.2.2'
+        explicit = transfer_syntax != '1.2.840.10008.1.2'
+        if transfer_syntax == '1.2.840.10008.1.2.1.99':
+            stream = _DicomStream(_DeflatedStream(stream))
+        header['transfer_syntax'] = transfer_syntax
+    else:
+        # No preamble: accept a bare implicit VR little endian dataset
+        group = struct.unpack('<H', head[:2])[0]
+        if group not in (0x0008, 0x0010) or head[4:6] in (b'UI', b'CS', b'SH', b'LO', b'DA'):
+            return None
+        stream = _DicomStream(f, head)
+        little, explicit = True, False
+    order = '<' if little else '>'
+
+    try:
+        while True:
+            tag = struct.unpack(order + 'HH', stream.read(4))
+            if tag > _DICOM_LAST_TAG or tag[0] == 0x7FE0:
+                break
+            vr, raw = _read_element_value(stream, little, explicit, skip=tag not in _DICOM_BY_TAG)
+            if raw is not None:
+                name, default_vr = _DICOM_BY_TAG[tag]
+                header[name] = _dicom_value(raw, vr if vr and vr != 'UN' else default_vr, little)
+    except (EOFError, ValueError):
+        # Header without any of the later tags, keep what was read
+        pass
+    return header if any(header.get(name) is not None for name in DICOM_COLUMNS) else None
+
+
+def _scan_of(member):
+    """Scan ID from an XNAT zip member path like EXP/scans/3-T1w/resources/DICOM/files/x.dcm"""
+    parts = member.replace('\\', '/').split('/')
+    if 'scans' in parts[:-1]:
+        return parts[parts.index('scans') + 1].split('-', 1)[0]
+    return None
+
+
+def dicom_headers(source):
+    """Read the DICOM headers of every member of a zip (or file of a directory).
+
+    Runs in the indexing process pool. Only the start of each member is
+    decompressed. Returns a dict with the source path, instance rows and
+    counts of members and unreadable members.
+    """
+    result = {'source': source, 'rows': [], 'members': 0, 'errors': 0}
+    try:
+        if os.path.isdir(source):
+            members = []
+            for root, dirs, files in os.walk(source):
+                members.extend(os.path.relpath(os.path.join(root, name), source) for name in files)
+            opener = lambda member: open(os.path.join(source, member), 'rb')
+            archive = None
+        else:
+            archive = zipfile.ZipFile(source)
+            members = [info.filename for info in archive.infolist() if not info.is_dir()]
+            opener = archive.open
+        try:
+            for member in sorted(members):
+                result['members'] += 1
+                try:
+                    with opener(member) as f:
+                        header = read_dicom_header(f)
+                except Exception:
+                    result['errors'] += 1
+                    continue
+                if header is not None:
+                    header['member'] = member
+                    header['scan'] = _scan_of(member)
+                    result['rows'].append(header)
+        finally:
+            if archive is not None:
+                archive.close()
+    except (OSError, zipfile.BadZipFile) as e:
+        result['error'] = str(e)
+    return result
+
+
+def source_signature(path):
+    """Size and modification time of a zip, or totals of an extracted directory"""
+    if os.path.isdir(path):
+        size, mtime = 0, 0
+        for root, dirs, files in os.walk(path):
+            for name in files:
+                info = os.stat(os.path.join(root, name))
+                size += info.st_size
+                mtime = max(mtime, info.st_mtime_ns)
+        return f'{size}:{mtime}'
+    info = os.stat(path)
+    return f'{info.st_size}:{info.st_mtime_ns}'
+
+
+class DicomIndex:
+    """SQLite index of the DICOM headers in a project's downloads.
+
+    One row per instance in the instances table, plus a series view
+    grouping them. sources records each indexed zip or directory with its
+    size and modification time, so only new or changed downloads are read.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        columns = ', '.join(f'{name} {"INTEGER" if vr in ("IS", "US") else "TEXT"}' for name, tag, vr in DICOM_TAGS)
+        self._conn.executescript(f'''
+            CREATE TABLE IF NOT EXISTS sources (
+                path TEXT PRIMARY KEY, subject TEXT, experiment TEXT, signature TEXT,
+                members INTEGER, instances INTEGER, errors INTEGER, indexed TEXT);
+            CREATE TABLE IF NOT EXISTS instances (
+                source TEXT, subject TEXT, experiment TEXT, scan TEXT, member TEXT, transfer_syntax TEXT,
+                {columns});
+            CREATE INDEX IF NOT EXISTS instances_source ON instances (source);
+            CREATE INDEX IF NOT EXISTS instances_series ON instances (series_instance_uid);
+            CREATE VIEW IF NOT EXISTS series AS
+                SELECT subject, experiment, scan, series_instance_uid, series_number, modality,
+                       series_description, protocol_name, COUNT(*) AS instances, source
+                FROM instances GROUP BY source, series_instance_uid;
+        ''')
+        self._conn.commit()
+
+    def is_current(self, path, signature):
+        with self._lock:
+            row = self._conn.execute('SELECT signature FROM sources WHERE path = ?', (path,)).fetchone()
+        return row is not None and row[0] == signature
+
+    def add(self, result, subject, experiment, signature):
+        """Replace the rows of result['source'] with the headers just read"""
+        columns = ('source', 'subject', 'experiment', 'scan', 'member', 'transfer_syntax') + DICOM_COLUMNS
+        rows = [(result['source'], subject, experiment) + tuple(r.get(c) for c in columns[3:])
+                for r in result['rows']]
+        with self._lock:
+            self._conn.execute('DELETE FROM instances WHERE source = ?', (result['source'],))
+            self._conn.executemany(f'INSERT INTO instances ({", ".join(columns)}) '
+                                   f'VALUES ({", ".join("?" * len(columns))})', rows)
+            self._conn.execute('INSERT OR REPLACE INTO sources VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                               (result['source'], subject, experiment, signature, result['members'], len(rows),
+                                result['errors'], datetime.datetime.now().isoformat(timespec='seconds')))
+            self._conn.commit()
+
+    def drop_missing(self):
+        """Forget sources that are no longer on disk; returns how many"""
+        with self._lock:
+            gone = [p for (p,) in self._conn.execute('SELECT path FROM sources') if not os.path.exists(p)]
+            for path in gone:
+                self._conn.execute('DELETE FROM instances WHERE source = ?', (path,))
+                self._conn.execute('DELETE FROM sources WHERE path = ?', (path,))
+            self._conn.commit()
+        return len(gone)
+
+    def counts(self):
+        with self._lock:
+            sources, instances = self._conn.execute(
+                'SELECT COUNT(*), COALESCE(SUM(instances), 0) FROM sources').fetchone()
+            series = self._conn.execute('SELECT COUNT(*) FROM series').fetchone()[0]
+        return {'sources': sources, 'instances': instances, 'series': series}
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class DicomIndexer:
+    """Reads DICOM headers of finished downloads in a process pool while the run goes on.
+
+    submit() is called with each zip or directory as it lands; headers are
+    read in worker processes and written to the project's DicomIndex from
+    the pool's callbacks. Sources unchanged since they were last indexed
+    are skipped.
+    """
+
+    def __init__(self, projDir, suffix='', workers=None):
+        self.projDir = projDir
+        self.index = DicomIndex(os.path.join(projDir, f'.dicom_index{suffix}.sqlite'))
+        self.pool = process_pool(workers)
+        self.started = time.time()
+        self.submitted = 0
+        self.unchanged = 0
+        self.failed = 0
+        self._pending = set()
+        self._lock = threading.Lock()
+
+    def submit(self, path):
+        if not os.path.exists(path):
+            return
+        signature = source_signature(path)
+        with self._lock:
+            if path in self._pending:
+                return
+            if self.index.is_current(path, signature):
+                self.unchanged += 1
+                return
+            self._pending.add(path)
+            self.submitted += 1
+        # ProjectID/SubjectID/Label(.zip)
+        subject = os.path.basename(os.path.dirname(path))
+        label = os.path.basename(path)
+        experiment = label[:-len('.zip')] if label.endswith('.zip') else label
+        future = self.pool.submit(dicom_headers, path)
+        future.add_done_callback(lambda f: self._store(f, path, subject, experiment, signature))
+
+    def _store(self, future, path, subject, experiment, signature):
+        try:
+            result = future.result()
+            if 'error' in result:
+                raise OSError(result['error'])
+            self.index.add(result, subject, experiment, signature)
+        except Exception as e:
+            with self._lock:
+                self.failed += 1
+            print(f'✗ Could not index DICOM headers of {os.path.relpath(path, self.projDir)}: {e}')
+        finally:
+            with self._lock:
+                self._pending.discard(path)
+
+    def close(self, prefix=''):
+        """Wait for the pending sources, print a summary and return the index counts"""
+        self.pool.shutdown(wait=True)
+        dropped = self.index.drop_missing()
+        counts = self.index.counts()
+        self.index.close()
+        print(f"{prefix}[DICOM index] Read: {self.submitted}, unchanged: {self.unchanged}, failed: {self.failed}, "
+              f"removed: {dropped} in {time.time() - self.started:.1f}s; "
+              f"{counts['instances']} instances in {counts['series']} series from {counts['sources']} downloads "
+              f"-> {os.path.relpath(self.index.path)}")
+        return counts
+
+
+def index_tree(myWorkingDirectory, myProjectID, workers=None):
+    """Index the DICOM headers of every download under output/project (--index-only)"""
+    projDir = os.path.join(os.path.abspath(myWorkingDirectory), myProjectID)
+    if not os.path.isdir(projDir):
+        print(f'Error: {projDir} does not exist')
+        return None
+    print('Indexing DICOM headers ... ' + projDir)
+    indexer = DicomIndexer(projDir, workers=workers)
+    for subject_dir in sorted(glob.glob(os.path.join(projDir, '*', ''))):
+        if os.path.basename(os.path.dirname(subject_dir)).startswith('.'):
+            continue
+        for name in sorted(os.listdir(subject_dir)):
+            path = os.path.join(subject_dir, name)
+            # Finished downloads only: Label.zip or an extracted Label/ directory
+            if name.endswith('.zip') or (os.path.isdir(path) and not name.endswith('.part')):
+                indexer.submit(path)
+    return indexer.close()
+
+
+# Parts of a multipart upload; S3 needs at least 5 MiB for all but the last
+S3_PART_SIZE = 8 * 1024 * 1024
+# S3 allows at most 10000 parts, the part size doubles every this many
+S3_PARTS_PER_SIZE = 1000
+
+
+def sigv4_headers(method, url, headers, payload_hash, access_key, secret_key, region, service='s3',
+                  session_token=None, now=None):
+    """Headers for an AWS Signature Version 4 signed request.
+
+    headers are signed together with host, x-amz-date and
+    x-amz-content-sha256. url must already be percent-encoded.
+    """
+    now = now or datetime.datetime.now(datetime.timezone.utc)
+    amz_date = now.strftime('%Y%m%dT%H%M%SZ')
+    parts = urllib.parse.urlsplit(url)
+    signed = {name.lower(): str(value).strip() for name, value in headers.items()}
+    signed.update({'host': parts.netloc, 'x-amz-date': amz_date, 'x-amz-content-sha256': payload_hash})
+    if session_token:
+        signed['x-amz-security-token'] = session_token
+    query = sorted(urllib.parse.parse_qsl(parts.query, keep_blank_values=True))
+    canonical_query = '&'.join(urllib.parse.quote(k, safe='-_.~') + '=' + urllib.parse.quote(v, safe='-_.~')
+                               for k, v in query)
+    names = sorted(signed)
+    canonical = '\n'.join([method, parts.path or '/', canonical_query,
+                           ''.join(f'{name}:{signed[name]}\n' for name in names), ';'.join(names), payload_hash])
+    scope = f'{amz_date[:8]}/{region}/{service}/aws4_request'
+    to_sign = '\n'.join(['AWS4-HMAC-SHA256', amz_date, scope, hashlib.sha256(canonical.encode('utf-8')).hexdigest()])
+    key = ('AWS4' + secret_key).encode('utf-8')
+    for part in (amz_date[:8], region, service, 'aws4_request'):
+        key = hmac.new(key, part.encode('utf-8'), hashlib.sha256).digest()
+    signature = hmac.new(key, to_sign.encode('utf-8'), hashlib.sha256).hexdigest()
+    signed['authorization'] = (f'AWS4-HMAC-SHA256 Credential={access_key}/{scope}, '
+                               f'SignedHeaders={";".join(names)}, Signature={signature}')
+    del signed['host']
+    return signed
+
+
+def _xml_children(element, name):
+    # S3 answers in its 2006-03-01 namespace, some stand-ins without one
+    return [child for child in element.iter() if child.tag.rsplit('}', 1)[-1] == name]
+
+
+def _xml_text(element, name):
+    found = _xml_children(element, name)
+    return found[0].text if found else None
+
+
+def _parse_xml(content):
+    import xml.etree.ElementTree as ET
+    return ET.fromstring(content)
+
+
+class S3Client:
+    """The few S3 API calls the S3 output needs, signed with SigV4 over requests.
+
+    Path-style addressing (endpoint/bucket/key), which MinIO, Ceph and
+    other S3-compatible stores support; 500/503 answers are retried.
+    """
+
+    def __init__(self, endpoint, bucket, access_key, secret_key, region='us-east-1', session_token=None,
+                 pool_size=10):
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        self.endpoint = endpoint.rstrip('/')
+        self.bucket = bucket
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.region = region
+        self.session_token = session_token
+        self.http = requests.Session()
+        self.http.mount('http://', HTTPAdapter(pool_connections=2, pool_maxsize=pool_size))
+        self.http.mount('https://', HTTPAdapter(pool_connections=2, pool_maxsize=pool_size))
+
+    def request(self, method, key='', query=None, body=b'', headers=None, ok=(200,)):
+        url = f'{self.endpoint}/{self.bucket}/' + urllib.parse.quote(key, safe='/-_.~')
+        if query:
+            url += '?' + urllib.parse.urlencode(sorted(query.items()), quote_via=urllib.parse.quote, safe='-_.~')
+        payload_hash = hashlib.sha256(body).hexdigest()
+        for attempt in range(4):
+            signed = sigv4_headers(method, url, headers or {}, payload_hash, self.access_key, self.secret_key,
+                                   self.region, session_token=self.session_token)
+            response = self.http.request(method, url, data=body, headers=signed, timeout=DOWNLOAD_TIMEOUT)
+            if response.status_code in ok:
+                return response
+            if response.status_code not in (500, 503) or attempt == 3:
+                break
+            delay = parse_retry_after(response.headers.get('Retry-After'))
+            if delay is not None and delay > RETRY_MAX_DELAY:
+                # Fails as transient, the end-of-run retries take it from there
+                break
+            time.sleep(delay if delay is not None else 2 ** attempt)
+        detail = _xml_text(_parse_xml(response.content), 'Code') if response.content.startswith(b'<') else None
+        error = HttpStatusError(url.split('?')[0], response)
+        if detail:
+            error.args = (f'{error} {detail}',)
+        raise error
+
+    def list(self, prefix):
+        """{key: size} of every object under prefix"""
+        objects = {}
+        token = None
+        while True:
+            query = {'list-type': '2', 'prefix': prefix}
+            if token:
+                query['continuation-token'] = token
+            root = _parse_xml(self.request('GET', query=query).content)
+            for item in _xml_children(root, 'Contents'):
+                objects[_xml_text(item, 'Key')] = int(_xml_text(item, 'Size') or 0)
+            token = _xml_text(root, 'NextContinuationToken')
+            if _xml_text(root, 'IsTruncated') != 'true' or not token:
+                return objects
+
+    def put(self, key, body):
+        return self.request('PUT', key, body=body).headers.get('ETag')
+
+    def create_multipart(self, key):
+        response = self.request('POST', key, query={'uploads': ''}, headers={'Content-Type': 'application/zip'})
+        return _xml_text(_parse_xml(response.content), 'UploadId')
+
+    def upload_part(self, key, upload_id, number, body):
+        return self.request('PUT', key, query={'partNumber': str(number), 'uploadId': upload_id},
+                            body=body).headers.get('ETag')
+
+    def complete_multipart(self, key, upload_id, etags):
+        body = ('<CompleteMultipartUpload>' + ''.join(
+            f'<Part><PartNumber>{n}</PartNumber><ETag>{etag}</ETag></Part>' for n, etag in enumerate(etags, 1))
+            + '</CompleteMultipartUpload>').encode('utf-8')
+        response = self.request('POST', key, query={'uploadId': upload_id}, body=body)
+        # S3 can report a failed completion in a 200 response
+        root = _parse_xml(response.content)
+        if root.tag.rsplit('}', 1)[-1] == 'Error':
+            raise Exception(f'Completing the upload of {key} failed: {_xml_text(root, "Code")}')
+        return _xml_text(root, 'ETag')
+
+    def abort_multipart(self, key, upload_id):
+        self.request('DELETE', key, query={'uploadId': upload_id}, ok=(200, 204, 404))
+
+    def close(self):
+        self.http.close()
+
+
+class S3UploadWriter:
+    """File-like sink streaming a download into one S3 object.
+
+    Data is uploaded part by part as it arrives, so at most one part is
+    held in memory. The object only appears once close() completes the
+    upload; abort() discards the parts. Objects smaller than one part are
+    sent with a single PUT.
+    """
+
+    def __init__(self, client, key, part_size=S3_PART_SIZE):
+        self.client = client
+        self.key = key
+        self.part_size = part_size
+        self.buffer = bytearray()
+        self.upload_id = None
+        self.etags = []
+
+    def write(self, data):
+        self.buffer += data
+        while len(self.buffer) >= self.part_size:
+            self._upload(bytes(self.buffer[:self.part_size]))
+            del self.buffer[:self.part_size]
+            if len(self.etags) % S3_PARTS_PER_SIZE == 0:
+                self.part_size *= 2
+
+    def _upload(self, body):
+        if self.upload_id is None:
+            self.upload_id = self.client.create_multipart(self.key)
+        self.etags.append(self.client.upload_part(self.key, self.upload_id, len(self.etags) + 1, body))
+
+    def close(self):
+        if self.upload_id is None:
+            return self.client.put(self.key, bytes(self.buffer))
+        if self.buffer:
+            self._upload(bytes(self.buffer))
+            self.buffer = bytearray()
+        return self.client.complete_multipart(self.key, self.upload_id, self.etags)
+
+    def abort(self):
+        self.buffer = bytearray()
+        if self.upload_id is not None:
+            try:
+                self.client.abort_multipart(self.key, self.upload_id)
+            except Exception as e:
+                print(f'Note: could not abort the upload of {self.key}: {e}')
+            self.upload_id = None
+
+
+class LocalOutput:
+    """The output/project/subject/label.zip tree on the local filesystem"""
+
+    remote = False
+
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+
+    def describe(self):
+        return self.root
+
+    def names(self, directory):
+        """Names of the downloads present in directory"""
+        return set(os.listdir(directory)) if os.path.exists(directory) else set()
+
+    def prepare(self, directory):
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+    def close(self):
+        pass
+
+
+class S3Output:
+    """The output/project/subject/label.zip layout in an S3-compatible bucket.
+
+    Downloads stream into multipart uploads without touching local disk.
+    The sync index, progress and throughput files stay in a local state
+    directory laid out like the bucket; a path below it maps onto the
+    object key of the same relative name. Skip checks use one object
+    listing per project.
+    """
+
+    remote = True
+
+    def __init__(self, client, prefix, state_root, part_size=S3_PART_SIZE):
+        self.client = client
+        self.prefix = prefix.strip('/') + '/' if prefix.strip('/') else ''
+        self.root = os.path.abspath(state_root)
+        self.part_size = part_size
+        self._listings = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_url(cls, url, endpoint=None, region=None, state_root=None, pool_size=10):
+        """S3Output for s3://bucket/prefix, credentials from the AWS_* environment variables"""
+        bucket, _, prefix = url[len('s3://'):].partition('/')
+        if not bucket:
+            raise ValueError(f'no bucket in {url}')
+        access_key = os.environ.get('AWS_ACCESS_KEY_ID')
+        secret_key = os.environ.get('AWS_SECRET_ACCESS_KEY')
+        if not access_key or not secret_key:
+            raise ValueError('set AWS_ACCESS_KEY_ID and AWS_SECRET_ACCESS_KEY for an s3:// output')
+        region = region or os.environ.get('AWS_REGION') or os.environ.get('AWS_DEFAULT_REGION') or 'us-east-1'
+        endpoint = (endpoint or os.environ.get('AWS_ENDPOINT_URL_S3') or os.environ.get('AWS_ENDPOINT_URL')
+                    or f'https://s3.{region}.amazonaws.com')
+        if state_root is None:
+            cache_root = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+            state_root = os.path.join(cache_root, 'xnat_download', 's3', bucket, *prefix.strip('/').split('/'))
+        client = S3Client(endpoint, bucket, access_key, secret_key, region, os.environ.get('AWS_SESSION_TOKEN'),
+                          pool_size)
+        return cls(client, prefix, state_root)
+
+    def describe(self):
+        return f's3://{self.client.bucket}/{self.prefix}'
+
+    def key(self, path):
+        return self.prefix + os.path.relpath(path, self.root).replace(os.sep, '/')
+
+    def names(self, directory):
+        """Names under directory, from a listing of its project made on first use"""
+        relative = os.path.relpath(directory, self.root).replace(os.sep, '/')
+        project = relative.split('/')[0]
+        with self._lock:
+            if project not in self._listings:
+                listing = {}
+                for key in self.client.list(self.prefix + project + '/'):
+                    parent, _, name = key[len(self.prefix):].rpartition('/')
+                    listing.setdefault(parent, set()).add(name)
+                self._listings[project] = listing
+            return set(self._listings[project].get(relative, ()))
+
+    def prepare(self, directory):
+        pass
+
+    def writer(self, path):
+        return S3UploadWriter(self.client, self.key(path), self.part_size)
+
+    def close(self):
+        self.client.close()
+
+
+def open_output(location, endpoint=None, region=None, state_dir=None, pool_size=10):
+    """Output backend for --output: an s3:// URL or a local directory"""
+    if location.startswith('s3://'):
+        return S3Output.from_url(location, endpoint, region, state_dir, pool_size)
+    return LocalOutput(location)
+
+
+def content_range_start(response):
+    """First byte offset of a 206 response's Content-Range ("bytes 100-199/200"), or None"""
+    unit, _, spec = response.headers.get('Content-Range', '').strip().partition(' ')
+    start = spec.partition('-')[0]
+    return int(start) if unit == 'bytes' and start.isdigit() else None
+
+
+def stream_download(mySession, url, path, chunk_size=1024 * 1024, inspect_zip=False, bandwidth=None, sink=None):
+    """Stream url to path via path + '.part', resuming with a Range request.
+
+    Bytes already in the .part file are kept when the server answers 206;
+    a plain 200 (XNAT builds most zips on the fly and can't seek) restarts
+    from zero. The .part file is renamed onto path only once the whole
+    body has arrived, so path never holds a truncated download.
+
+    The MD5 of the file is computed as the data arrives and, with
+    inspect_zip, the zip members are decoded on the fly as well. Returns a
+    dict with size, md5, members (None if the zip could not be decoded) and
+    ttfb, the seconds until the response headers arrived. bandwidth is an
+    optional shared TokenBucket.
+
+    With a sink (e.g. S3UploadWriter) the body is written there instead of
+    to path: no .part file, no resume, sink.close() on success and
+    sink.abort() on failure.
+    """
+    part_path = path + '.part'
+    offset = os.path.getsize(part_path) if sink is None and os.path.exists(part_path) else 0
+    headers = {'Range': f'bytes={offset}-'} if offset else {}
+    md5 = hashlib.md5()
+    reader = ZipStreamReader() if inspect_zip else None
+
+    def consume(chunk):
+        nonlocal reader
+        md5.update(chunk)
+        if reader is not None:
+            try:
+                reader.feed(chunk)
+            except ValueError:
+                reader = None
+
+    def consume_existing():
+        # Resumed bytes were hashed by the interrupted run but that state is gone
+        with open(part_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                consume(chunk)
+
+    def finish(size, ttfb=None):
+        members = None
+        if reader is not None:
+            try:
+                reader.close()
+                members = reader.members
+            except ValueError:
+                pass
+        if sink is not None:
+            sink.close()
+        else:
+            os.replace(part_path, path)
+        return {'size': size, 'md5': md5.hexdigest(), 'members': members, 'ttfb': ttfb}
+
+    if sink is not None:
+        try:
+            return _stream_to_sink(mySession, url, sink, consume, finish, chunk_size, bandwidth)
+        except BaseException:
+            sink.abort()
+            raise
+
+    started = time.time()
+    response = mySession.get(url, stream=True, headers=headers, timeout=DOWNLOAD_TIMEOUT)
+    ttfb = time.time() - started
+    try:
+        if response.status_code == 416 and offset:
+            # Range not satisfiable: the .part file already holds the whole body
+            total = response.headers.get('Content-Range', '').rpartition('/')[2]
+            if total.isdigit() and int(total) == offset:
+                consume_existing()
+                return finish(offset)
+        if (response.status_code == 416 and offset) or (
+                response.status_code == 206 and content_range_start(response) != offset):
+            # Not the bytes the .part file lacks: start over
+            offset = 0
+            response.close()
+            started = time.time()
+            response = mySession.get(url, stream=True, timeout=DOWNLOAD_TIMEOUT)
+            ttfb = time.time() - started
+        if response.status_code == 206 and offset:
+            mode = 'ab'
+            # After ttfb, which must not include re-reading a large .part file
+            consume_existing()
+        elif response.status_code == 200:
+            mode = 'wb'
+            offset = 0
+        else:
+            raise HttpStatusError(url, response)
+
+        expected = response.headers.get('Content-Length')
+        received = 0
+        with open(part_path, mode) as f:
+            for chunk in response.iter_content(chunk_size):
+                f.write(chunk)
+                consume(chunk)
+                received += len(chunk)
+                METRICS.add_bytes(len(chunk))
+                if bandwidth is not None:
+                    bandwidth.consume(len(chunk))
+            f.flush()
+            os.fsync(f.fileno())
+        if expected is not None and received != int(expected):
+            raise IncompleteDownload(url, received, expected)
+    finally:
+        response.close()
+
+    return finish(offset + received, ttfb)
+
+
+def _stream_to_sink(mySession, url, sink, consume, finish, chunk_size, bandwidth):
+    started = time.time()
+    response = mySession.get(url, stream=True, timeout=DOWNLOAD_TIMEOUT)
+    try:
+        if response.status_code != 200:
+            raise HttpStatusError(url, response)
+        ttfb = time.time() - started
+        expected = response.headers.get('Content-Length')
+        received = 0
+        for chunk in response.iter_content(chunk_size):
+            sink.write(chunk)
+            consume(chunk)
+            received += len(chunk)
+            METRICS.add_bytes(len(chunk))
+            if bandwidth is not None:
+                bandwidth.consume(len(chunk))
+        if expected is not None and received != int(expected):
+            raise IncompleteDownload(url, received, expected)
+    finally:
+        response.close()
+    return finish(received, ttfb)
+
+
+class ExtractWriter:
+    """ZipStreamReader handler that writes each member below root.
+
+    A leading directory equal to strip_prefix (XNAT puts the experiment
+    label there) is dropped, and names escaping root are refused.
+    """
+
+    def __init__(self, root, strip_prefix=None):
+        self.root = root
+        self.strip_prefix = strip_prefix
+        self._file = None
+
+    def _target(self, name):
+        parts = [p for p in name.replace('\\', '/').split('/') if p not in ('', '.')]
+        if self.strip_prefix and len(parts) > 1 and parts[0] == self.strip_prefix:
+            parts = parts[1:]
+        if not parts or '..' in parts or ':' in parts[0]:
+            raise ValueError(f'Refusing to extract unsafe member name {name!r}')
+        return os.path.join(self.root, *parts)
+
+    def start(self, name):
+        target = self._target(name)
+        if name.endswith('/'):
+            os.makedirs(target, exist_ok=True)
+            return
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        self._file = open(target, 'wb')
+
+    def data(self, data):
+        if self._file is not None:
+            self._file.write(data)
+
+    def end(self, member):
+        self.close()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def stream_extract(mySession, url, target_dir, strip_prefix=None, chunk_size=1024 * 1024, bandwidth=None):
+    """Unpack the zip at url into target_dir while it downloads.
+
+    Members are written below target_dir + '.part', which replaces
+    target_dir only after the whole archive decoded cleanly; an
+    interrupted run starts that object over. Returns the same dict as
+    stream_download (size and md5 refer to the zip stream).
+    """
+    part_dir = target_dir + '.part'
+    if os.path.exists(part_dir):
+        shutil.rmtree(part_dir)
+    os.makedirs(part_dir)
+    writer = ExtractWriter(part_dir, strip_prefix)
+    reader = ZipStreamReader(writer)
+    md5 = hashlib.md5()
+    received = 0
+
+    started = time.time()
+    response = mySession.get(url, stream=True, timeout=DOWNLOAD_TIMEOUT)
+    try:
+        if response.status_code != 200:
+            raise HttpStatusError(url, response)
+        ttfb = time.time() - started
+        expected = response.headers.get('Content-Length')
+        for chunk in response.iter_content(chunk_size):
+            md5.update(chunk)
+            reader.feed(chunk)
+            received += len(chunk)
+            METRICS.add_bytes(len(chunk))
+            if bandwidth is not None:
+                bandwidth.consume(len(chunk))
+        reader.close()
+        if expected is not None and received != int(expected):
+            raise IncompleteDownload(url, received, expected)
+    finally:
+        response.close()
+        writer.close()
+
+    if os.path.exists(target_dir):
+        # Older version of a changed object
+        shutil.rmtree(target_dir)
+    os.replace(part_dir, target_dir)
+    return {'size': received, 'md5': md5.hexdigest(), 'members': reader.members, 'ttfb': ttfb}
+
+
+def extract_local(path, target_dir, strip_prefix=None, chunk_size=1024 * 1024):
+    """Unpack a zip on disk into target_dir the way stream_extract does"""
+    part_dir = target_dir + '.part'
+    if os.path.exists(part_dir):
+        shutil.rmtree(part_dir)
+    os.makedirs(part_dir)
+    writer = ExtractWriter(part_dir, strip_prefix)
+    reader = ZipStreamReader(writer)
+    try:
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                reader.feed(chunk)
+        reader.close()
+    finally:
+        writer.close()
+    if os.path.exists(target_dir):
+        shutil.rmtree(target_dir)
+    os.replace(part_dir, target_dir)
+
+
+def from_cache(cache, key, task):
+    """Materialize task from the cache: (md5, size, method), or None to download it"""
+    try:
+        if task.extract:
+            hit = cache.lookup(key)
+            if hit is None:
+                return None
+            path, md5, size = hit
+            extract_local(path, task.path, task.entry.experiment)
+            return md5, size, 'extract'
+        return cache.materialize(key, task.path)
+    except Exception as e:
+        # Evicted by another run meanwhile, or not a zip we can unpack
+        print(f'Note: cached copy of {task.entry.label} unusable, downloading it ({e})')
+        return None
+
+
+def remove_if_empty(directory):
+    try:
+        os.rmdir(directory)
+    except OSError:
+        pass
+
+
+def discard_partial(path):
+    """Drop a .part file left by an earlier run; it belongs to an older version"""
+    if os.path.exists(path + '.part'):
+        os.remove(path + '.part')
+
+
+class Selection:
+    """Scan type and resource label filters applied inside each experiment/assessor.
+
+    Scan patterns are matched case-insensitively (shell wildcards allowed)
+    against the scan type and the series description.
+    """
+
+    def __init__(self, scan_types=None, resources=None):
+        self.scan_types = [p.strip() for p in scan_types.split(',') if p.strip()] if scan_types else []
+        self.resources = [r.strip() for r in resources.split(',') if r.strip()] if resources else []
+
+    def active(self):
+        return bool(self.scan_types or self.resources)
+
+    def key(self):
+        """Stable description stored in the sync index, None for whole objects"""
+        if not self.active():
+            return None
+        return f"scans={','.join(self.scan_types)};resources={','.join(self.resources)}"
+
+    def matches_scan(self, row):
+        for field in (row_value(row, 'type'), row_value(row, 'series_description')):
+            if field and any(fnmatch.fnmatch(field.lower(), p.lower()) for p in self.scan_types):
+                return True
+        return False
+
+    def uri(self, mySession, entry):
+        """Files URI restricted to the selection, or None when nothing matches"""
+        resource_part = '/resources/' + ','.join(self.resources) if self.resources else ''
+        if entry.kind == 'assessor':
+            base = entry.uri[:-len('/files')]
+            return base + resource_part + '/files'
+        scans = 'ALL'
+        if self.scan_types:
+            result = mySession.get_json('/data/experiments/' + entry.id + '/scans',
+                                        query={'columns': 'ID,type,series_description'})
+            scan_ids = [row_value(r, 'ID') for r in result.get('ResultSet', {}).get('Result', [])
+                        if self.matches_scan(r)]
+            if not scan_ids:
+                return None
+            scans = ','.join(scan_ids)
+        return '/data/experiments/' + entry.id + '/scans/' + scans + resource_part + '/files'
+
+
+def fetch_sizes(shared, tasks, workers=1, index=None):
+    """Fill in entry.size for tasks, from the sync index or the XNAT file listing.
+
+    Objects downloaded before keep the size recorded in the index; the
+    others cost one file listing each, spread over the worker pool. The
+    listing is kept on the entry and reused for the integrity check.
+    """
+    api_calls = [0]
+    calls_lock = threading.Lock()
+
+    def size_of(task):
+        entry = task.entry
+        if entry.size is not None:
+            return
+        row = index.get(entry.id) if index is not None else None
+        if row is not None and row['size'] is not None and row['status'] == 'complete':
+            entry.size = int(row['size'])
+            return
+        mySession = shared.session
+        for attempt in range(2):
+            try:
+                with calls_lock:
+                    api_calls[0] += 1
+                rows = mySession.get_json(entry.uri).get('ResultSet', {}).get('Result', [])
+                entry.file_catalog = rows
+                entry.size = sum(int(row_value(r, 'Size') or 0) for r in rows)
+                return
+            except Exception as e:
+                if attempt == 0 and session_expired(e):
+                    mySession = shared.refresh(mySession)
+                else:
+                    # Unknown size, scheduled after the known ones
+                    return
+
+    started = time.time()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        list(pool.map(size_of, tasks))
+    known = sum(1 for t in tasks if t.entry.size is not None)
+    print(f'Sizes: {known}/{len(tasks)} known, {api_calls[0]} API calls in {time.time() - started:.1f}s')
+
+
+def order_tasks(tasks, order='catalog', priority_subjects=None):
+    """Return tasks sorted for the given --order policy.
+
+    Ties (and unknown sizes or dates, which go last) keep catalog order.
+    """
+    if order == 'smallest':
+        return sorted(tasks, key=lambda t: (t.entry.size is None, t.entry.size or 0))
+    if order == 'largest':
+        return sorted(tasks, key=lambda t: (t.entry.size is None, -(t.entry.size or 0)))
+    if order == 'oldest':
+        return sorted(tasks, key=lambda t: (t.entry.last_modified is None, t.entry.last_modified or ''))
+    if order == 'subjects':
+        rank = {s: i for i, s in enumerate(priority_subjects or [])}
+        return sorted(tasks, key=lambda t: rank.get(t.entry.subject, len(rank)))
+    return list(tasks)
+
+
+def read_subject_list(value):
+    """Subject labels from 'S1,S2' or '@file' (one label per line)"""
+    if not value:
+        return None
+    if value.startswith('@'):
+        with open(value[1:]) as f:
+            return [line.strip() for line in f if line.strip() and not line.startswith('#')]
+    return [s.strip() for s in value.split(',') if s.strip()]
+
+
+def format_duration(seconds):
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return f'{seconds // 3600}h{seconds % 3600 // 60:02d}m'
+    if seconds >= 60:
+        return f'{seconds // 60}m{seconds % 60:02d}s'
+    return f'{seconds}s'
+
+
+class DownloadTask:
+    """A catalog entry waiting to be transferred to path"""
+
+    def __init__(self, entry, path, selection=None, extract=False, job=None):
+        self.entry = entry
+        self.path = path
+        self.selection = selection
+        # path is a directory to unpack into rather than a zip file
+        self.extract = extract
+        # BatchEntry the task was queued for
+        self.job = job
+        # Belongs to another --shard, only taken when that node leaves it
+        self.foreign = False
+        # 'new' or 'changed' against the sync index
+        self.sync_state = 'new'
+        # Output backend path maps into (None: local files)
+        self.output = None
+        # Failed attempts so far, and how the last one failed
+        self.attempts = 0
+        self.error = None
+        self.transient = False
+
+
+# Retries of a transfer the server answered with 429/503
+MAX_BUSY_RETRIES = 5
+# End-of-run retry rounds for transfers that failed on a transient error
+RETRY_ROUNDS = 3
+# Backoff before retry round n: RETRY_BASE_DELAY * 2**(n-1) seconds, capped and jittered
+RETRY_BASE_DELAY = 10
+RETRY_MAX_DELAY = 5 * 60
+
+
+def transient_error(error):
+    """Whether a failed transfer may work later: timeouts, dropped connections, 408/429/5xx"""
+    if isinstance(error, HttpStatusError):
+        return error.status in (408, 429) or error.status >= 500
+    import requests
+    return isinstance(error, (requests.exceptions.Timeout, requests.exceptions.ConnectionError,
+                              requests.exceptions.ChunkedEncodingError, ConnectionError, socket.timeout))
+
+
+class RetryQueue:
+    """Transfers that failed on a transient error, tried again at the end of the run.
+
+    Each retry waits out an exponential backoff with jitter counted from
+    its failure, so healthy transfers never wait for a failing one and
+    objects that failed together don't all come back at the same moment.
+    """
+
+    def __init__(self, rounds=RETRY_ROUNDS, base_delay=None, max_delay=None):
+        self.rounds = rounds
+        self.base_delay = RETRY_BASE_DELAY if base_delay is None else base_delay
+        self.max_delay = RETRY_MAX_DELAY if max_delay is None else max_delay
+        self.scheduled = 0
+        self._lock = threading.Lock()
+        self._queue = []
+
+    def delay(self, attempt):
+        # Half the backoff is fixed, half random
+        backoff = min(self.max_delay, self.base_delay * 2 ** (attempt - 1))
+        return backoff / 2 + random.uniform(0, backoff / 2)
+
+    def add(self, task):
+        """Queue task for another try; returns the delay, or None once it has used up its rounds"""
+        if not task.transient or task.attempts > self.rounds:
+            return None
+        delay = self.delay(task.attempts)
+        with self._lock:
+            self._queue.append((time.time() + delay, task))
+            self.scheduled += 1
+        return delay
+
+    def take(self):
+        """The queued (due time, task) pairs, earliest first, emptying the queue"""
+        with self._lock:
+            queued, self._queue = self._queue, []
+        return sorted(queued, key=lambda item: item[0])
+
+
+def download_task(shared, task, stats, index=None, check_catalog=True, controller=None, bandwidth=None,
+                  cache=None):
+    """Download a single task, refreshing the shared session on 401.
+
+    controller (AdaptiveLimiter) gates the transfer and is fed its outcome;
+    429/503 answers are retried after their Retry-After delay, unless it is
+    longer than RETRY_MAX_DELAY: then the task fails as transient and is
+    left to the end-of-run retries. With a cache
+    (ObjectCache) a cached copy is used instead of the network when there
+    is one, and new zip downloads are added to it.
+    """
+    entry = task.entry
+    filename = os.path.basename(task.path)
+    selection_key = task.selection.key() if task.selection is not None else None
+    auth_retries = 0
+    busy_retries = 0
+    started = time.time()
+    error = None
+    try:
+        mySession = shared.session
+
+        while True:
+            try:
+                # A cached copy saves the selection lookup as well as the transfer
+                cache_key = None
+                if cache is not None and (task.output is None or not task.output.remote):
+                    cache_key = ObjectCache.key(shared.collectionURL, entry, selection_key)
+                hit = from_cache(cache, cache_key, task) if cache_key is not None else None
+                if hit is not None:
+                    md5, size, method = hit
+                    stats.record_download(0)
+                    if index is not None:
+                        index.mark(entry, task.path, 'complete', size=None if task.extract else size, md5=md5,
+                                   verified='cached', selection=selection_key)
+                    print(f'✓ From cache: {filename} ({method})')
+                    METRICS.inc('xnat_downloads_total', kind=entry.kind, status='cached')
+                    METRICS.event('download', id=entry.id, label=entry.label, kind=entry.kind, status='cached',
+                                  bytes=size, method=method, seconds=round(time.time() - started, 3))
+                    return True
+                uri = entry.uri
+                if selection_key is not None:
+                    uri = task.selection.uri(mySession, entry)
+                    if uri is None:
+                        print(f'(skip) {entry.label} - no scans match {", ".join(task.selection.scan_types)}')
+                        if index is not None:
+                            index.mark(entry, task.path, 'empty', selection=selection_key)
+                        remove_if_empty(os.path.dirname(task.path))
+                        METRICS.inc('xnat_downloads_total', kind=entry.kind, status='empty')
+                        return True
+                url = shared.collectionURL.rstrip('/') + uri + '?format=zip'
+                if controller is not None:
+                    controller.acquire()
+                try:
+                    if task.extract:
+                        result = stream_extract(mySession, url, task.path, strip_prefix=entry.experiment,
+                                                bandwidth=bandwidth)
+                    else:
+                        sink = task.output.writer(task.path) if task.output is not None and task.output.remote else None
+                        result = stream_download(mySession, url, task.path, inspect_zip=check_catalog,
+                                                 bandwidth=bandwidth, sink=sink)
+                finally:
+                    if controller is not None:
+                        controller.release()
+                if controller is not None:
+                    controller.record('ok', result['ttfb'])
+                verified = None
+                if check_catalog:
+                    cached = entry.file_catalog if uri == entry.uri else None
+                    verified, detail = check_download(mySession, uri, result['members'], cached)
+                    if verified == 'mismatch':
+                        print(f'✗ Integrity check failed for {filename}: {detail}')
+                        task.error = f'integrity check failed: {detail}'
+                        task.transient = False
+                        METRICS.inc('xnat_downloads_total', kind=entry.kind, status='corrupt')
+                        METRICS.event('download', id=entry.id, label=entry.label, kind=entry.kind, status='corrupt',
+                                      bytes=result['size'], seconds=round(time.time() - started, 3), detail=detail)
+                        stats.record_failure()
+                        if index is not None:
+                            index.mark(entry, task.path, 'corrupt', size=result['size'], md5=result['md5'],
+                                       verified=verified, selection=selection_key)
+                        return False
+                stats.record_download(result['size'])
+                if index is not None:
+                    index.mark(entry, task.path, 'complete', size=result['size'], md5=result['md5'],
+                               verified=verified, selection=selection_key)
+                if cache_key is not None and not task.extract:
+                    try:
+                        cache.store(cache_key, task.path, result['md5'], result['size'])
+                    except Exception as e:
+                        print(f'Note: could not add {filename} to the cache: {e}')
+                print(f'✓ Downloaded: {filename}' + (' (verified)' if verified == 'ok' else ''))
+                METRICS.inc('xnat_downloads_total', kind=entry.kind, status='complete')
+                METRICS.event('download', id=entry.id, label=entry.label, kind=entry.kind, status='complete',
+                              bytes=result['size'], seconds=round(time.time() - started, 3),
+                              ttfb=round(result['ttfb'], 3) if result['ttfb'] is not None else None,
+                              verified=verified, retries=auth_retries + busy_retries)
+                return True
+            except Exception as e:
+                outcome = transfer_outcome(e)
+                if controller is not None and outcome is not None:
+                    controller.record(outcome)
+                error = e
+                if session_expired(e):
+                    auth_retries += 1
+                    METRICS.inc('xnat_retries_total', reason='unauthorized')
+                    METRICS.event('retry', id=entry.id, label=entry.label, reason='unauthorized', attempt=auth_retries)
+                    print(f'✗ Session expired, refreshing and retrying (attempt {auth_retries}/3)...')
+                    if auth_retries >= 3:
+                        break
+                    mySession = shared.refresh(mySession)
+                    # Retry download on next loop iteration
+                elif outcome == 'throttled' and busy_retries < MAX_BUSY_RETRIES:
+                    delay = e.retry_after if e.retry_after is not None else min(60, 2 ** (busy_retries + 1))
+                    if delay > RETRY_MAX_DELAY:
+                        # Too long to hold a worker; the task fails as transient and is retried at the end
+                        print(f'✗ Server busy (status {e.status}), asks to wait {delay:.0f}s; '
+                              f'leaving {filename} for the end-of-run retries')
+                        break
+                    busy_retries += 1
+                    METRICS.inc('xnat_retries_total', reason='throttled')
+                    METRICS.event('retry', id=entry.id, label=entry.label, reason='throttled', attempt=busy_retries,
+                                  status=e.status, delay=delay)
+                    print(f'✗ Server busy (status {e.status}), retrying {filename} in {delay:.0f}s '
+                          f'({busy_retries}/{MAX_BUSY_RETRIES})...')
+                    time.sleep(delay)
+                else:
+                    # Log the failed download and continue with the rest
+                    print(f'✗ Failed to download {entry.kind} "{entry.label}": {e}')
+                    print(f'  Continuing with remaining downloads...')
+                    break  # Don't retry other errors
+    except Exception as e:
+        error = e
+        print(f'✗ Failed to download {entry.kind} "{entry.label}": {e}')
+        print(f'  Continuing with remaining downloads...')
+    task.error = str(error)
+    task.transient = error is not None and transient_error(error)
+    METRICS.inc('xnat_downloads_total', kind=entry.kind, status='failed')
+    METRICS.event('download', id=entry.id, label=entry.label, kind=entry.kind, status='failed',
+                  seconds=round(time.time() - started, 3), error=str(error),
+                  retries=auth_retries + busy_retries)
+    stats.record_failure()
+    if index is not None:
+        index.mark(entry, task.path, 'failed', selection=selection_key)
+    return False
+
+
+class Shard:
+    """Deterministic i/N partition of a project, for spreading it over several nodes.
+
+    Objects are assigned by a hash of their subject or session, so every
+    node computes the same split from the catalog alone; assessors go with
+    their session.
+    """
+
+    KEYS = ('subject', 'experiment')
+
+    def __init__(self, index, count, by='subject'):
+        if count < 1 or not 0 <= index < count:
+            raise ValueError(f'shard {index}/{count} is out of range, use i/N with 0 <= i < N')
+        if by not in self.KEYS:
+            raise ValueError(f'can only shard by {" or ".join(self.KEYS)}')
+        self.index = index
+        self.count = count
+        self.by = by
+
+    @classmethod
+    def parse(cls, value, by='subject'):
+        """Shard from an 'i/N' string"""
+        try:
+            index, count = (int(part) for part in value.split('/'))
+        except ValueError:
+            raise ValueError(f'invalid shard "{value}", use i/N (e.g. 0/4)')
+        return cls(index, count, by)
+
+    def shard_of(self, entry):
+        key = entry.subject if self.by == 'subject' else entry.experiment_id
+        return int(hashlib.sha1(str(key).encode('utf-8')).hexdigest()[:8], 16) % self.count
+
+    def owns(self, entry):
+        return self.shard_of(entry) == self.index
+
+    def suffix(self):
+        return f'.shard-{self.index}of{self.count}'
+
+
+# A lease not renewed for this long belongs to a dead node and may be stolen
+LEASE_TTL = 10 * 60
+
+
+class LeaseManager:
+    """Lock files on the shared output tree that let nodes claim objects.
+
+    A lease is created with O_EXCL, which is atomic on local filesystems,
+    NFSv3+ and Lustre. Held leases are renewed (mtime) by a heartbeat
+    thread; a lease left stale by a crashed node is taken over by renaming
+    it away first, so only one node can win it. Finished objects keep a
+    'done' lease for the version (last-modified and selection) they were
+    downloaded at.
+    """
+
+    def __init__(self, directory, ttl=LEASE_TTL):
+        self.directory = directory
+        self.ttl = ttl
+        self.owner = f'{socket.gethostname()}:{os.getpid()}'
+        self.stolen = 0
+        self._held = set()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        if not os.path.exists(directory):
+            os.makedirs(directory, exist_ok=True)
+        self._heartbeat = threading.Thread(target=self._renew, daemon=True)
+        self._heartbeat.start()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + '.lease')
+
+    def _read(self, path):
+        try:
+            with open(path) as f:
+                return json.load(f), os.path.getmtime(path)
+        except (OSError, ValueError):
+            # Missing, or being written by its owner right now
+            return None, None
+
+    def done_version(self, key):
+        """Version of key a node recorded when it finished the download, or None"""
+        info, _ = self._read(self._path(key))
+        return info.get('version') if info is not None and info.get('state') == 'done' else None
+
+    def _create(self, path, version):
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'owner': self.owner, 'version': version, 'state': 'active',
+                       'time': datetime.datetime.now().isoformat(timespec='seconds')}, f)
+        return True
+
+    def claim(self, key, version=None, present=None):
+        """Try to take the lease on key: returns 'claimed', 'done' or 'busy'.
+
+        present (callable) tells whether the finished object is still in
+        the output; a 'done' lease for an object that was deleted, or set
+        aside by --verify, is taken over so it gets downloaded again.
+        """
+        path = self._path(key)
+        for attempt in range(2):
+            if self._create(path, version):
+                with self._lock:
+                    self._held.add(key)
+                return 'claimed'
+            info, mtime = self._read(path)
+            if info is None:
+                if os.path.exists(path):
+                    return 'busy'
+                continue
+            if info.get('state') == 'done' and info.get('version') == version:
+                if present is None or present():
+                    return 'done'
+                print(f'Taking over done lease on {key}, the download is missing')
+            if info.get('state') == 'active' and time.time() - mtime < self.ttl:
+                return 'busy'
+            # Stale, done for an older version or missing: move it aside so only one node takes over
+            aside = f'{path}.{self.owner}'
+            try:
+                os.rename(path, aside)
+            except OSError:
+                return 'busy'
+            taken, taken_mtime = self._read(aside)
+            if taken is not None and taken.get('state') == 'active' and time.time() - taken_mtime < self.ttl:
+                # Another node took it over between our read and the rename, put it back
+                try:
+                    os.link(aside, path)
+                except OSError:
+                    pass
+                os.remove(aside)
+                return 'busy'
+            os.remove(aside)
+            if info.get('state') == 'active':
+                self.stolen += 1
+                print(f'Taking over stale lease on {key} from {info.get("owner")}')
+        return 'busy'
+
+    def release(self, key, version=None, done=True):
+        """Give up the lease; a finished object keeps a 'done' marker"""
+        path = self._path(key)
+        with self._lock:
+            self._held.discard(key)
+        info, mtime = self._read(path)
+        if info is not None and info.get('owner') != self.owner:
+            # Taken over by another node while we looked stale
+            return
+        try:
+            if done:
+                # Replace the active lease in one step so no other node sees it free
+                tmp = f'{path}.{self.owner}.tmp'
+                with open(tmp, 'w') as f:
+                    json.dump({'owner': self.owner, 'version': version, 'state': 'done',
+                               'time': datetime.datetime.now().isoformat(timespec='seconds')}, f)
+                os.replace(tmp, path)
+            else:
+                os.remove(path)
+        except OSError:
+            pass
+
+    def _renew(self):
+        while not self._stop.wait(self.ttl / 3):
+            with self._lock:
+                held = list(self._held)
+            for key in held:
+                info, mtime = self._read(self._path(key))
+                if info is None or info.get('owner') != self.owner:
+                    continue
+                try:
+                    os.utime(self._path(key))
+                except OSError:
+                    pass
+
+    def close(self):
+        self._stop.set()
+        with self._lock:
+            held = list(self._held)
+        for key in held:
+            self.release(key, done=False)
+
+
+def lease_version(entry, selection=None):
+    selection_key = selection.key() if selection is not None else None
+    return f'{entry.last_modified}|{selection_key}'
+
+
+def leased_download(leases, shared, task, stats, index=None, check_catalog=True, controller=None, bandwidth=None,
+                    cache=None):
+    """download_task under a lease, for nodes sharing an output tree.
+
+    Returns None without downloading when another node has the object
+    leased or already downloaded it.
+    """
+    key = task.entry.id
+    version = lease_version(task.entry, task.selection)
+    claim = leases.claim(key, version, present=lambda: os.path.exists(task.path))
+    if claim != 'claimed':
+        reason = 'downloaded' if claim == 'done' else 'being downloaded'
+        print(f'(skip) {task.entry.label} - {reason} by another node')
+        return None
+    ok = False
+    try:
+        ok = download_task(shared, task, stats, index, check_catalog, controller, bandwidth, cache)
+    finally:
+        leases.release(key, version, done=ok)
+    return ok
+
+
+# Columns of a --manifest file; only project is required
+MANIFEST_FIELDS = ('project', 'subject', 'session', 'download', 'experiment_type', 'assessor_type',
+                   'scan_type', 'resource')
+
+
+class BatchEntry:
+    """One project (or subject/session within it) to download in a batch run.
+
+    The selectors mirror the single-project options (--session,
+    --download, --experiment-type, ...). Counters and status are filled
+    in while the batch runs.
+    """
+
+    def __init__(self, project, subject=None, session=None, download='both', experiment_type=None,
+                 assessor_type=None, selection=None):
+        self.project = project
+        self.subject = subject
+        self.session = session
+        self.download = download or 'both'
+        self.experiment_type = experiment_type
+        self.assessor_type = assessor_type
+        self.selection = selection
+        # Line of the --manifest entry, when the entry comes from one
+        self.row = None
+        self.status = 'pending'
+        self.error = None
+        # elsewhere: queued here but fetched by another node (--lease)
+        self.counts = {'queued': 0, 'skipped': 0, 'downloaded': 0, 'failed': 0, 'elsewhere': 0}
+        self._lock = threading.Lock()
+
+    def name(self):
+        return '/'.join(p for p in (self.project, self.subject, self.session) if p)
+
+    def describe(self):
+        """name(), with the manifest line it came from"""
+        return f'manifest entry {self.row} ({self.name()})' if self.row is not None else self.name()
+
+    def copy(self):
+        """The same entry with fresh counters, for another run"""
+        entry = BatchEntry(self.project, self.subject, self.session, self.download, self.experiment_type,
+                           self.assessor_type, self.selection)
+        entry.row = self.row
+        return entry
+
+    def record(self, key):
+        with self._lock:
+            self.counts[key] += 1
+            return self.finished()
+
+    def finished(self):
+        c = self.counts
+        return c['downloaded'] + c['failed'] + c['elsewhere'] >= c['queued']
+
+    def finish(self):
+        """Set the final status from the counters"""
+        if self.status == 'failed':
+            return
+        if self.counts['failed'] == 0:
+            self.status = 'complete' if self.counts['queued'] or self.counts['skipped'] else 'no match'
+        elif self.counts['downloaded'] == 0:
+            self.status = 'failed'
+        else:
+            self.status = 'partial'
+
+    def report(self):
+        return {'entry': self.name(), 'project': self.project, 'subject': self.subject,
+                'session': self.session, 'status': self.status, 'error': self.error, **self.counts}
+
+
+def read_manifest(path):
+    """BatchEntry list from a CSV (header row) or JSON (list of objects) manifest"""
+    with open(path, newline='') as f:
+        if path.lower().endswith('.json'):
+            rows = json.load(f)
+            if isinstance(rows, dict):
+                rows = rows.get('entries', [])
+        else:
+            rows = [r for r in csv.DictReader(f) if not (r.get('project') or '').startswith('#')]
+    entries = []
+    for line, row in enumerate(rows, 1):
+        row = {k.strip().lower().replace('-', '_'): (v.strip() if isinstance(v, str) else v)
+               for k, v in row.items() if k}
+        unknown = set(row) - set(MANIFEST_FIELDS)
+        if unknown:
+            raise ValueError(f'{path} entry {line}: unknown column(s) {", ".join(sorted(unknown))}')
+        if not row.get('project'):
+            raise ValueError(f'{path} entry {line}: project is required')
+        if row.get('download') and row['download'] not in ('experiments', 'assessors', 'both'):
+            raise ValueError(f'{path} entry {line}: download must be experiments, assessors or both')
+        entry = BatchEntry(row['project'], subject=row.get('subject') or None,
+                           session=row.get('session') or None, download=row.get('download'),
+                           experiment_type=row.get('experiment_type') or None,
+                           assessor_type=row.get('assessor_type') or None,
+                           selection=Selection(row.get('scan_type') or None, row.get('resource') or None))
+        entry.row = line
+        entries.append(entry)
+    return entries
+
+
+class DeadLetters:
+    """JSON lines file of the objects a project's runs kept failing to download.
+
+    Each line has the catalog entry (and for an assessor its session), the
+    output path, the last error and the number of attempts, so that
+    --retry-failed can queue the objects again without listing the project.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def load(self):
+        records = []
+        try:
+            with open(self.path) as f:
+                for line in f:
+                    if line.strip():
+                        records.append(json.loads(line))
+        except FileNotFoundError:
+            pass
+        return records
+
+    def update(self, failed, catalog, index, root):
+        """Add the objects that failed for good, drop the ones the sync index now has complete"""
+        records = {record['entry']['id']: record for record in self.load()}
+        experiments = {e.id: e for e in catalog.experiments} if catalog is not None else {}
+        for task in failed:
+            entry = task.entry
+            parent = experiments.get(entry.experiment_id) if entry.kind == 'assessor' else None
+            records[entry.id] = {
+                'project': task.job.project,
+                'entry': {f: getattr(entry, f) for f in ProjectCatalog.FIELDS},
+                'session': {f: getattr(parent, f) for f in ProjectCatalog.FIELDS} if parent else None,
+                'path': os.path.relpath(task.path, root),
+                'error': task.error,
+                'transient': task.transient,
+                'attempts': task.attempts,
+                'time': datetime.datetime.now().isoformat(timespec='seconds')}
+        for xnat_id in list(records):
+            row = index.get(xnat_id)
+            if row is not None and row['status'] in ('complete', 'empty'):
+                del records[xnat_id]
+        if not records:
+            if os.path.exists(self.path):
+                os.remove(self.path)
+            return 0
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            for record in records.values():
+                f.write(json.dumps(record) + '\n')
+        os.replace(tmp, self.path)
+        return len(records)
+
+    def catalog(self, project):
+        """ProjectCatalog of the dead-lettered objects, with the sessions of their assessors"""
+        catalog = ProjectCatalog(project)
+        experiments = {}
+        assessors = []
+        for record in self.load():
+            entry = CatalogEntry(*(record['entry'][f] for f in ProjectCatalog.FIELDS))
+            if entry.kind == 'assessor':
+                assessors.append(entry)
+                if record.get('session'):
+                    session = CatalogEntry(*(record['session'][f] for f in ProjectCatalog.FIELDS))
+                    experiments.setdefault(session.id, session)
+            else:
+                experiments[entry.id] = entry
+        catalog.experiments = sorted(experiments.values(), key=lambda x: (x.subject or '', x.label or ''))
+        catalog.assessors = assessors
+        return catalog
+
+
+class ProjectRun:
+    """Output directory, progress file, sync index and counters of one project in a run"""
+
+    def __init__(self, myWorkingDirectory, myProjectID, parent_stats=None, shard=None, leases=False,
+                 dry_run=False, dicom_index=False, output=None):
+        self.project = myProjectID
+        self.projDir = os.path.join(myWorkingDirectory, myProjectID)
+        # Where downloads go; with S3 projDir only holds the run's state
+        self.output = output or LocalOutput(myWorkingDirectory)
+        # A dry run reads the existing state but writes nothing
+        self.dry_run = dry_run
+        if not os.path.exists(self.projDir) and not dry_run:
+            os.makedirs(self.projDir)
+        print(('Planning project ... ' if dry_run else 'Downloading project ... ') + myProjectID)
+
+        # Track progress
+        # Nodes of a sharded run keep their own progress and index files,
+        # SQLite must not be written from several hosts over NFS
+        suffix = shard.suffix() if shard is not None else ''
+        self.progress_file = os.path.join(self.projDir, f'.download_progress{suffix}.json')
+        self.stats = DownloadStats(parent=parent_stats)
+        if os.path.exists(self.progress_file):
+            try:
+                with open(self.progress_file, 'r') as f:
+                    self.stats = DownloadStats(json.load(f), parent=parent_stats)
+                previous = self.stats.snapshot()
+                print(f"Resuming from subject: {previous['last_subject']}")
+                print(f"Previously: {previous['subjects_processed']} subjects, {previous['files_downloaded']} downloaded, {previous['files_skipped']} skipped")
+            except:
+                pass
+
+        # Per-object sync state, used to skip unchanged objects on re-runs
+        index_path = os.path.join(self.projDir, f'.sync_index{suffix}.sqlite')
+        self.index = SyncIndex.snapshot(index_path) if dry_run else SyncIndex(index_path)
+        self.sync_counts = {'new': 0, 'changed': 0, 'unchanged': 0}
+        self.leases = LeaseManager(os.path.join(self.projDir, '.leases')) if leases else None
+        # DICOM headers of downloads are indexed while the run goes on
+        self.indexer = DicomIndexer(self.projDir, suffix) if dicom_index and not dry_run else None
+        # Objects that kept failing, for --retry-failed
+        self.dead_letters = DeadLetters(os.path.join(self.projDir, f'.dead_letter{suffix}.jsonl'))
+
+    def finish(self, workers, prefixed=False):
+        # Final progress save
+        self.stats.save(self.progress_file)
+        progress = self.stats.snapshot()
+        sync_counts = self.sync_counts
+        prefix = f'[{self.project}] ' if prefixed else ''
+        print(f"\n{prefix}[Complete] Total subjects: {progress['subjects_processed']}, Downloaded: {progress['files_downloaded']}, Skipped: {progress['files_skipped']}")
+        print(f"{prefix}[Sync] New: {sync_counts['new']}, Changed: {sync_counts['changed']}, Unchanged: {sync_counts['unchanged']}")
+
+        # Append this run's throughput so runs with different --workers can be compared
+        report = self.stats.throughput(workers)
+        print(f"{prefix}[Throughput] workers={report['workers']}, files={report['files']}, failed={report['failed']}, "
+              f"{report['bytes'] / 1e6:.1f} MB in {report['elapsed_s']}s "
+              f"({report['files_per_s']} files/s, {report['mb_per_s']} MB/s)")
+        with open(os.path.join(self.projDir, '.download_throughput.jsonl'), 'a') as f:
+            f.write(json.dumps(report) + '\n')
+
+
+def plan_entry(catalog, run, job, myWorkingDirectory, extract=False, queued_paths=None, shard=None):
+    """Walk the catalog for one batch entry and return the tasks to download.
+
+    Unchanged objects are skipped via the sync index. queued_paths maps the
+    paths already queued by earlier entries of the batch to those entries,
+    so overlapping entries don't download an object twice; the first entry
+    wins, with a warning when the later one asked for another selection. With a shard only its objects
+    are queued, unless the run uses leases: then the other shards' objects
+    are queued as foreign tasks to steal once the node's own work is done.
+    """
+    planned = []
+    queued_paths = queued_paths if queued_paths is not None else {}
+    stats = run.stats
+    index = run.index
+    selection = job.selection
+    selection_key = selection.key() if selection is not None else None
+    assessors_by_experiment = catalog.assessors_by_experiment()
+    for mySubjectID, myExperimentsList in catalog.subjects():
+        if job.subject and mySubjectID != job.subject:
+            continue
+        print('\nEntering subject ...' + mySubjectID)
+
+        # Build list of experiments/assessors already on disk
+        subject_dir = os.path.join(myWorkingDirectory, job.project, mySubjectID)
+        existing_files = run.output.names(subject_dir)
+
+        subject_has_data = False
+
+        # Objects of this subject that pass the entry's filters
+        wanted = []
+        for e in myExperimentsList:
+            # Filter by session label if specified
+            if job.session and e.label != job.session:
+                continue
+            # Filter by experiment type if specified
+            if job.download in ['experiments', 'both'] and not (
+                    job.experiment_type and e.xsi_type != job.experiment_type):
+                wanted.append((e, job.experiment_type))
+            if job.download in ['assessors', 'both']:
+                for a in assessors_by_experiment.get(e.id, []):
+                    # Filter by assessor type if specified
+                    if job.assessor_type and a.xsi_type != job.assessor_type:
+                        continue
+                    wanted.append((a, job.assessor_type))
+
+        for obj, type_filter in wanted:
+            foreign = shard is not None and not shard.owns(obj)
+            if foreign and run.leases is None:
+                continue
+            try:
+                # --extract unpacks into a directory named after the label
+                filename = obj.label if extract else obj.label + '.zip'
+                myzip = os.path.join(subject_dir, filename)
+                if myzip in queued_paths:
+                    first = queued_paths[myzip]
+                    first_key = first.selection.key() if first.selection is not None else None
+                    if first_key != selection_key:
+                        print(f'⚠ {obj.label}: {job.describe()} asks for {selection_key or "all files"}, but '
+                              f'{first.describe()} already queued it with {first_key or "all files"}; '
+                              f'keeping the first')
+                    continue
+                on_disk = filename in existing_files
+                # A file another node finished is only known to be current if its done lease says so
+                adopt = (run.leases is None or not on_disk
+                         or run.leases.done_version(obj.id) == lease_version(obj, selection))
+                state = index.state(obj, myzip, on_disk, selection_key, record=not run.dry_run, adopt=adopt)
+                run.sync_counts[state] += 1
+                if state == 'unchanged':
+                    stats.add('files_skipped')
+                    job.record('skipped')
+                    if run.indexer is not None:
+                        run.indexer.submit(myzip)
+                    print(f'(skip) {obj.label} - already downloaded')
+                    subject_has_data = True
+                    continue
+                if state == 'changed':
+                    print(f'(update) {obj.label} - changed since last download')
+                    if not run.dry_run:
+                        discard_partial(myzip)
+                if type_filter:
+                    print(f'✓ Match found: {obj.label} - type {obj.xsi_type} matches filter {type_filter}')
+                print(f'Queued {obj.kind}: ' + obj.label + ' (type: ' + obj.xsi_type + ')')
+
+                # Create subject directory only when we have data to download
+                if not subject_has_data:
+                    if not run.dry_run:
+                        run.output.prepare(subject_dir)
+                    subject_has_data = True
+
+                queued_paths[myzip] = job
+                job.counts['queued'] += 1
+                task = DownloadTask(obj, myzip, selection, extract, job=job)
+                task.foreign = foreign
+                task.sync_state = state
+                task.output = run.output
+                planned.append(task)
+            except Exception as exp_error:
+                # Catch any unexpected error for this object and continue to the next
+                print(f'✗ Failed to process {obj.kind} "{obj.label}": {exp_error}')
+                print(f'  Continuing with remaining downloads...')
+                continue
+
+        # Update progress after each subject
+        stats.add('subjects_processed')
+        stats.set('last_subject', mySubjectID)
+
+        # Save progress checkpoint every 10 subjects
+        progress = stats.snapshot()
+        if progress['subjects_processed'] % 10 == 0 and not run.dry_run:
+            stats.save(run.progress_file)
+            print(f"\n[Progress] Subjects: {progress['subjects_processed']}, Downloaded: {progress['files_downloaded']}, Skipped: {progress['files_skipped']}")
+    return planned
+
+
+# Transfer rate assumed by --dry-run when a project has no throughput history
+DRY_RUN_ASSUMED_MB_PER_S = 10.0
+
+
+def estimate_duration(projDirs, workers, files, total_bytes):
+    """(seconds, basis) for transferring files/total_bytes, from earlier runs' throughput.
+
+    Uses the last few runs recorded in .download_throughput.jsonl, those
+    with the same --workers when there are any. Without history an
+    assumed DRY_RUN_ASSUMED_MB_PER_S is used.
+    """
+    history = []
+    for projDir in projDirs:
+        try:
+            with open(os.path.join(projDir, '.download_throughput.jsonl')) as f:
+                for line in f:
+                    try:
+                        report = json.loads(line)
+                    except ValueError:
+                        continue
+                    if report.get('files') and report.get('mb_per_s'):
+                        history.append(report)
+        except OSError:
+            continue
+    same_workers = [r for r in history if r.get('workers') == workers]
+    recent = (same_workers or history)[-5:]
+    if recent:
+        mb_per_s = sum(r['mb_per_s'] for r in recent) / len(recent)
+        files_per_s = sum(r['files_per_s'] for r in recent) / len(recent)
+        seconds = files / files_per_s if files_per_s else 0.0
+        if total_bytes is not None:
+            seconds = max(seconds, total_bytes / (mb_per_s * 1e6))
+        basis = (f'{len(recent)} earlier run(s) at {mb_per_s:.1f} MB/s, {files_per_s:.2f} files/s'
+                 + ('' if same_workers else f' (other --workers than {workers})'))
+        return seconds, basis
+    if total_bytes is None:
+        return None, 'no throughput history and unknown sizes'
+    return total_bytes / (DRY_RUN_ASSUMED_MB_PER_S * 1e6), f'no throughput history, assuming {DRY_RUN_ASSUMED_MB_PER_S:g} MB/s'
+
+
+def report_plan(planned, runs, workers):
+    """Print what a run would transfer, per type, and return it as a dict"""
+    by_type = {}
+    for task in planned:
+        row = by_type.setdefault((task.entry.kind, task.entry.xsi_type),
+                                 {'new': 0, 'changed': 0, 'bytes': 0, 'unknown_sizes': 0})
+        row[task.sync_state] = row.get(task.sync_state, 0) + 1
+        if task.entry.size is None:
+            row['unknown_sizes'] += 1
+        else:
+            row['bytes'] += task.entry.size
+    unknown = sum(row['unknown_sizes'] for row in by_type.values())
+    total_bytes = sum(row['bytes'] for row in by_type.values()) if not unknown else None
+    unchanged = sum(run.sync_counts['unchanged'] for run in runs.values())
+
+    print('\n[Dry run] Would download:')
+    if by_type:
+        print(f"  {'Kind':<10} {'Type':<32} {'New':>6} {'Changed':>8} {'Size':>10}")
+        for (kind, xsi_type), row in sorted(by_type.items(), key=lambda item: (item[0][0], str(item[0][1]))):
+            size = format_bytes(row['bytes']) + ('+?' if row['unknown_sizes'] else '')
+            print(f"  {kind:<10} {str(xsi_type):<32} {row['new']:>6} {row['changed']:>8} {size:>10}")
+    seconds, basis = estimate_duration([run.projDir for run in runs.values()], workers, len(planned), total_bytes)
+    print(f'  {len(planned)} objects, '
+          + (format_bytes(total_bytes) if total_bytes is not None else f'{unknown} of unknown size')
+          + f', {unchanged} unchanged and skipped')
+    print('  Estimated duration: ' + (format_duration(seconds) if seconds is not None else 'unknown') + f' ({basis})')
+    return {'downloads': len(planned), 'bytes': total_bytes, 'unknown_sizes': unknown, 'unchanged': unchanged,
+            'estimated_s': round(seconds, 1) if seconds is not None else None,
+            'by_type': [{'kind': kind, 'type': xsi_type, **row} for (kind, xsi_type), row in by_type.items()]}
+
+
+def project_entry(myProjectID, selection=None, session=None, download='both', experiment_type=None,
+                  assessor_type=None):
+    """BatchEntry for one project and the --session/--download/--*-type options"""
+    return BatchEntry(myProjectID, session=session, download=download, experiment_type=experiment_type,
+                      assessor_type=assessor_type, selection=selection)
+
+
+def progress_event(task, status, stats):
+    """What a progress callback gets for a finished transfer"""
+    return {'project': task.job.project, 'entry': task.job.name(), 'kind': task.entry.kind,
+            'subject': task.entry.subject, 'label': task.entry.label, 'path': task.path,
+            'size': task.entry.size, 'status': status, 'done': stats.done_count(),
+            'planned': stats.planned_files}
+
+
+# Download data from XNAT in .zip format
+def xnat_collection(myWorkingDirectory,collectionURL,myProjectID,workers=1,check_catalog=True,selection=None,
+                    extract=False,adaptive=False,max_bandwidth=None,order='catalog',priority_subjects=None,
+                    shard=None,leases=False,cache=None,dry_run=False,sizes=False,catalog_max_age=None,
+                    dicom_index=False,output=None,session=None,download='both',experiment_type=None,
+                    assessor_type=None,retries=RETRY_ROUNDS,username=None,password=None):
+    """Download one project, filtered like the --session/--download/--*-type options"""
+    job = project_entry(myProjectID, selection, session, download, experiment_type, assessor_type)
+    return xnat_batch(myWorkingDirectory, collectionURL, [job], workers=workers, check_catalog=check_catalog,
+                      extract=extract, adaptive=adaptive, max_bandwidth=max_bandwidth, order=order,
+                      priority_subjects=priority_subjects, shard=shard, leases=leases, cache=cache,
+                      dry_run=dry_run, sizes=sizes, catalog_max_age=catalog_max_age, dicom_index=dicom_index,
+                      output=output, retries=retries, username=username, password=password)
+
+
+def xnat_batch(myWorkingDirectory, collectionURL, jobs, workers=1, check_catalog=True, extract=False,
+               adaptive=False, max_bandwidth=None, order='catalog', priority_subjects=None, status_file=None,
+               shard=None, leases=False, cache=None, dry_run=False, sizes=False, catalog_max_age=None,
+               dicom_index=False, output=None, shared=None, catalogs=None, progress=None, retries=RETRY_ROUNDS,
+               username=None, password=None):
+    """Download every BatchEntry in jobs over one session and one worker pool.
+
+    Each project is listed once however many entries refer to it; all
+    queued tasks are ordered together. shard (Shard) limits the run to one
+    node's part of the tree; leases makes nodes claim each object through
+    lock files and steal what other nodes leave over. cache (ObjectCache)
+    supplies objects downloaded before into any output. dicom_index reads
+    the DICOM headers of every finished (or already present) download into
+    the project's .dicom_index.sqlite in a process pool. output (e.g.
+    S3Output) receives the downloads instead of the local tree, which then
+    only holds the run's state. The run logs in with username and password
+    unless shared (SharedSession) is given, which is used instead and left
+    open; catalogs ({project:
+    ProjectCatalog}) replace listing those projects. progress is called
+    from the worker threads with a dict per finished transfer (see
+    progress_event). Transfers that fail on a transient error (timeout,
+    dropped connection, 5xx) get up to retries more tries once the rest of
+    the run is done, after an exponential backoff; whatever still fails is
+    written to the project's dead-letter file (see DeadLetters). Returns the
+    entries with their final status, which is also written to status_file
+    (relative to myWorkingDirectory) when given.
+
+    dry_run plans the batch without writing to the tree and returns the
+    plan (see report_plan) instead. It lists the projects again, like a
+    download would, unless catalog_max_age is given: then a catalog an
+    earlier dry run cached within that many seconds is reused. Its catalog
+    cache is kept in the user cache directory, apart from the one
+    downloads keep in the output tree. With sizes it lists the files of
+    queued objects whose size isn't known yet.
+    """
+    if output is not None and output.remote:
+        # Leases are lock files next to the downloads; in the state directory they would exclude nobody
+        if leases:
+            raise ValueError('leases are lock files in the local tree and give no exclusion on a remote output')
+        local_only = [name for name, used in (('extract', extract), ('cache', cache is not None),
+                                              ('dicom_index', dicom_index)) if used]
+        if local_only:
+            raise ValueError(f"{', '.join(local_only)} can't be used with a remote output")
+    # All paths are absolute, runs in one process must not depend on (or change) the working directory
+    myWorkingDirectory = os.path.abspath(myWorkingDirectory)
+    # Create output directory if it doesn't exist
+    if not os.path.exists(myWorkingDirectory) and not dry_run:
+        os.makedirs(myWorkingDirectory)
+        print(f'Created output directory: {myWorkingDirectory}')
+    if output is not None and output.remote:
+        print(f'Writing to {output.describe()}, state in {myWorkingDirectory}')
+    if len(jobs) > 1:
+        print(f'Batch of {len(jobs)} entries')
+    if workers > 1:
+        print(f'Using {workers} download workers')
+    if shard is not None:
+        print(f'Shard {shard.index}/{shard.count} by {shard.by}' + (', stealing leftover work' if leases else ''))
+    elif leases:
+        print('Claiming objects through leases shared with other nodes')
+
+    with METRICS._lock:
+        phases_before = dict(METRICS.phases)
+    METRICS.event('run_start', version=VERSION, entries=[job.name() for job in jobs], workers=workers,
+                  order=order, shard=f'{shard.index}/{shard.count}' if shard is not None else None)
+
+    # Combined counters of all projects, used for the ETA
+    batch_stats = DownloadStats()
+    runs = {}
+    for job in jobs:
+        if job.project not in runs:
+            runs[job.project] = ProjectRun(myWorkingDirectory, job.project, batch_stats, shard,
+                                           leases and not dry_run, dry_run, dicom_index, output)
+        if job.selection is not None and job.selection.key() is not None:
+            print(f'Selecting {job.selection.key()}' + (f' for {job.name()}' if len(jobs) > 1 else ''))
+
+    # Server-health driven concurrency (up to workers) and a shared bandwidth cap
+    controller = None
+    if adaptive:
+        log_dir = runs[jobs[0].project].projDir if len(runs) == 1 else myWorkingDirectory
+        controller = AdaptiveLimiter(workers, log_path=os.path.join(log_dir, '.controller_log.jsonl'))
+        print(f'Adaptive concurrency: starting at {int(controller.limit)} of {workers} workers')
+    bandwidth = None
+    if max_bandwidth:
+        bandwidth = TokenBucket(max_bandwidth * 1e6)
+        print(f'Bandwidth capped at {max_bandwidth} MB/s')
+
+    # The catalog walk only queues tasks; they are ordered and then run on
+    # the pool. The semaphore keeps at most two tasks per worker submitted.
+    own_session = shared is None
+    if own_session:
+        shared = SharedSession(collectionURL, username, password, pool_size=workers)
+    pool = ThreadPoolExecutor(max_workers=workers)
+    in_flight = threading.BoundedSemaphore(workers * 2)
+    planned = []
+    queue = {'waiting': 0, 'running': 0}
+    queue_changed = threading.Condition()
+    retry_queue = RetryQueue(retries)
+    failed = []
+
+    def update_queue(waiting=0, running=0):
+        with queue_changed:
+            queue['waiting'] += waiting
+            queue['running'] += running
+            METRICS.set('xnat_queue_depth', queue['waiting'])
+            METRICS.set('xnat_transfers_in_flight', queue['running'])
+            queue_changed.notify_all()
+
+    def drain():
+        with queue_changed:
+            queue_changed.wait_for(lambda: queue['running'] == 0)
+
+    def on_done(task, future):
+        try:
+            finish_task(task, future)
+        finally:
+            # Only now, so drain() never misses a retry queued above
+            in_flight.release()
+            update_queue(running=-1)
+
+    def finish_task(task, future):
+        try:
+            ok = future.result()
+        except Exception as e:
+            ok = False
+            task.error, task.transient = str(e), transient_error(e)
+        if ok is False:
+            task.attempts += 1
+            delay = retry_queue.add(task)
+            if delay is not None:
+                # Counted again when the retry ends
+                runs[task.job.project].stats.record_retry()
+                METRICS.inc('xnat_retries_total', reason='transient')
+                METRICS.event('retry', id=task.entry.id, label=task.entry.label, reason='transient',
+                              attempt=task.attempts, delay=round(delay, 1), error=task.error)
+                print(f'↻ Retrying {task.entry.label} at the end of the run, in {delay:.0f}s or later '
+                      f'({task.attempts}/{retry_queue.rounds})')
+                return
+            failed.append(task)
+        status = 'elsewhere' if ok is None else 'downloaded' if ok else 'failed'
+        if ok is None:
+            # Another node has it
+            batch_stats.unplan(task.entry.size)
+        else:
+            indexer = runs[task.job.project].indexer
+            if ok and indexer is not None:
+                indexer.submit(task.path)
+        entry_finished = task.job.record(status)
+        if progress is not None:
+            try:
+                progress(progress_event(task, status, batch_stats))
+            except Exception as e:
+                print(f'✗ Progress callback failed: {e}')
+        if batch_stats.done_count() % 10 == 0:
+            line = batch_stats.eta()
+            if len(jobs) > 1:
+                line += f' [Batch] {sum(1 for j in jobs if j.finished())}/{len(jobs)} entries finished'
+            print(line)
+        elif entry_finished and len(jobs) > 1:
+            print(f'[Batch] {task.job.name()} finished')
+
+    def submit(task):
+        run = runs[task.job.project]
+        in_flight.acquire()
+        update_queue(waiting=-1, running=1)
+        if run.leases is not None:
+            future = pool.submit(leased_download, run.leases, shared, task, run.stats, run.index, check_catalog,
+                                 controller, bandwidth, cache)
+        else:
+            future = pool.submit(download_task, shared, task, run.stats, run.index, check_catalog, controller,
+                                 bandwidth, cache)
+        future.add_done_callback(lambda f: on_done(task, f))
+
+    try:
+        catalogs = dict(catalogs or {})
+        queued_paths = {}
+        for job in jobs:
+            if len(jobs) > 1:
+                print(f'\n[Batch] Entry {job.name()}')
+            try:
+                if job.project not in catalogs:
+                    with METRICS.phase('listing'):
+                        if dry_run:
+                            catalogs[job.project] = project_catalog(shared, job.project, max_age=catalog_max_age)
+                        else:
+                            catalogs[job.project] = project_catalog(shared, job.project, runs[job.project].projDir)
+                with METRICS.phase('planning'):
+                    planned.extend(plan_entry(catalogs[job.project], runs[job.project], job, myWorkingDirectory,
+                                              extract, queued_paths, shard))
+            except Exception as e:
+                if len(jobs) == 1:
+                    # Nothing else to continue with (bad credentials, no such project, ...)
+                    raise
+                job.status = 'failed'
+                job.error = str(e)
+                print(f'✗ Failed to list {job.name()}: {e}')
+                print(f'  Continuing with remaining entries...')
+
+        # Sizes are only worth a listing per object for the size-based orders
+        for run in runs.values():
+            project_tasks = [t for t in planned if t.job.project == run.project]
+            if order in ('smallest', 'largest') or (dry_run and sizes):
+                with METRICS.phase('sizing'):
+                    fetch_sizes(shared, project_tasks, workers, run.index)
+            else:
+                for task in project_tasks:
+                    row = run.index.get(task.entry.id)
+                    if task.entry.size is None and row is not None and row['size'] is not None:
+                        task.entry.size = int(row['size'])
+            if run.project in catalogs:
+                update_cached_catalog(shared, catalogs[run.project])
+        planned = order_tasks(planned, order, priority_subjects)
+        # Own shard first; other shards' work is stolen from the back of their queues
+        foreign = [t for t in planned if t.foreign]
+        if foreign:
+            planned = [t for t in planned if not t.foreign] + foreign[::-1]
+            print(f'{len(planned) - len(foreign)} downloads in this shard, {len(foreign)} to steal from other shards')
+        if dry_run:
+            return report_plan(planned, runs, workers)
+        planned_sizes = [t.entry.size for t in planned]
+        total_bytes = sum(planned_sizes) if planned and None not in planned_sizes else None
+        batch_stats.plan(len(planned), total_bytes)
+        print(f"\n[Plan] {len(planned)} downloads in {order} order"
+              + (f", {total_bytes / 1e9:.1f} GB" if total_bytes is not None else ''))
+        update_queue(waiting=len(planned))
+        METRICS.event('plan', downloads=len(planned), bytes=total_bytes, order=order)
+        with METRICS.phase('download'):
+            for task in planned:
+                submit(task)
+            # Transient failures go round again once everything else is done
+            drain()
+            while True:
+                retrying = retry_queue.take()
+                if not retrying:
+                    break
+                print(f'\n[Retry] {len(retrying)} transfers failed on transient errors, trying again')
+                update_queue(waiting=len(retrying))
+                for due, task in retrying:
+                    if due > time.time():
+                        time.sleep(due - time.time())
+                    submit(task)
+                drain()
+            pool.shutdown(wait=True)
+        for run in runs.values():
+            prefix = f'[{run.project}] ' if len(runs) > 1 else ''
+            try:
+                dead = run.dead_letters.update([t for t in failed if t.job.project == run.project],
+                                               catalogs.get(run.project), run.index, myWorkingDirectory)
+            except OSError as e:
+                print(f'{prefix}Note: could not update {run.dead_letters.path}: {e}')
+                continue
+            if dead:
+                print(f'\n{prefix}[Dead letter] {dead} objects still failing, listed in {run.dead_letters.path}; '
+                      f'download them again with --retry-failed')
+                METRICS.event('dead_letter', project=run.project, objects=dead, path=run.dead_letters.path)
+    finally:
+        # Let queued transfers finish before the sessions they use are closed
+        pool.shutdown(wait=True)
+        if own_session:
+            shared.close()
+        for run in runs.values():
+            run.index.close()
+            if run.leases is not None:
+                run.leases.close()
+            if run.indexer is not None:
+                # Headers of the last downloads are still being read
+                with METRICS.phase('indexing'):
+                    run.indexer.close(prefix=f'[{run.project}] ' if len(runs) > 1 else '')
+
+    for run in runs.values():
+        run.finish(workers, prefixed=len(runs) > 1)
+
+    if cache is not None:
+        print(f'[Cache] Hits: {cache.hits} ({cache.saved_bytes / 1e6:.1f} MB not downloaded), '
+              f'stored: {cache.stored}, evicted: {cache.evicted}, size: {cache.total_bytes() / 1e9:.2f} GB')
+
+    # Time spent in each phase of this run
+    with METRICS._lock:
+        phases = {name: seconds - phases_before.get(name, 0.0) for name, seconds in METRICS.phases.items()}
+    print('[Phases] ' + ', '.join(f'{name} {seconds:.1f}s' for name, seconds in phases.items()))
+
+    for job in jobs:
+        job.finish()
+        METRICS.event('entry', **job.report())
+    if len(jobs) > 1:
+        print('\n[Batch] Entry status:')
+        for job in jobs:
+            c = job.counts
+            print(f"  {job.status:<9} {job.name()}: {c['downloaded']} downloaded, {c['skipped']} skipped, "
+                  f"{c['failed']} failed" + (f' ({job.error})' if job.error else ''))
+    METRICS.event('run_end', phases={k: round(v, 3) for k, v in phases.items()}, **batch_stats.throughput(workers))
+    if status_file:
+        with open(os.path.join(myWorkingDirectory, status_file), 'w') as f:
+            json.dump({'finished': datetime.datetime.now().isoformat(timespec='seconds'),
+                       'entries': [job.report() for job in jobs]}, f, indent=2)
+    return jobs
+
+def xnat_retry_failed(myWorkingDirectory, collectionURL, jobs, shard=None, **options):
+    """Download again only the objects in the dead-letter files of the jobs' projects.
+
+    The dead-letter entries stand in for the project listings, so nothing
+    is enumerated; the entries' filters still apply. options are passed
+    on to xnat_batch. Returns the entries with their status, or [] when
+    nothing is left to retry.
+    """
+    myWorkingDirectory = os.path.abspath(myWorkingDirectory)
+    suffix = shard.suffix() if shard is not None else ''
+    catalogs = {}
+    for project in dict.fromkeys(job.project for job in jobs):
+        letters = DeadLetters(os.path.join(myWorkingDirectory, project, f'.dead_letter{suffix}.jsonl'))
+        catalog = letters.catalog(project)
+        if catalog.entries():
+            print(f'[Retry] {len(letters.load())} failed objects of {project} from {letters.path}')
+            catalogs[project] = catalog
+        else:
+            print(f'[Retry] Nothing to retry for {project}')
+    jobs = [job for job in jobs if job.project in catalogs]
+    if not jobs:
+        return []
+    return xnat_batch(myWorkingDirectory, collectionURL, jobs, shard=shard, catalogs=catalogs, **options)
+
+
+# Polls look back this far before the newest date seen, for changes committed late
+WATCH_OVERLAP = 5 * 60
+
+
+def shift_date(value, seconds):
+    """XNAT date string moved by seconds, unchanged if it can't be parsed"""
+    try:
+        when = datetime.datetime.fromisoformat(value.strip())
+    except ValueError:
+        return value
+    return (when + datetime.timedelta(seconds=seconds)).strftime('%Y-%m-%d %H:%M:%S')
+
+
+def xnat_watch(myWorkingDirectory, collectionURL, jobs, poll_min=WATCH_POLL_MIN, poll_max=WATCH_POLL_MAX,
+               max_polls=None, stop=None, shared=None, username=None, password=None, **options):
+    """Mirror the projects of jobs, then keep polling for new and modified objects.
+
+    The first pass is a normal batch run. After that each poll lists only
+    the objects modified since the newest date seen, with two date-filtered
+    queries per project, and downloads just those, so a poll costs the
+    same however large the projects are. The interval drops to poll_min
+    after a poll that found changes and doubles up to poll_max while
+    nothing changes. One session, logged in with username and password, is
+    kept for the whole watch (shared, when given, is used and left open). Runs until stop (threading.Event) is
+    set or after max_polls polls; options are passed on to xnat_batch.
+    Returns the number of polls.
+    """
+    stop = stop or threading.Event()
+    myWorkingDirectory = os.path.abspath(myWorkingDirectory)
+    own_session = shared is None
+    if own_session:
+        shared = SharedSession(collectionURL, username, password, pool_size=options.get('workers', 1))
+    projects = list(dict.fromkeys(job.project for job in jobs))
+    polls = 0
+    interval = poll_min
+    try:
+        catalogs = {}
+        for project in projects:
+            with METRICS.phase('listing'):
+                catalogs[project] = project_catalog(shared, project, os.path.join(myWorkingDirectory, project))
+        xnat_batch(myWorkingDirectory, collectionURL, [job.copy() for job in jobs], shared=shared,
+                   catalogs=catalogs, **options)
+        watermarks = {project: catalogs[project].latest_modified() for project in projects}
+
+        while max_polls is None or polls < max_polls:
+            METRICS.set('xnat_watch_interval_seconds', interval)
+            print(f'\n[Watch] Next poll in {format_duration(interval)}')
+            if stop.wait(interval):
+                break
+            polls += 1
+            METRICS.inc('xnat_watch_polls_total')
+            try:
+                deltas = {}
+                for project in projects:
+                    base = catalogs[project]
+                    since = shift_date(watermarks[project], -WATCH_OVERLAP) if watermarks[project] else None
+                    with METRICS.phase('listing'):
+                        listed = fetch_catalog(shared, project, since, {e.id: e for e in base.experiments})
+                    delta = base.changes(listed)
+                    if delta.entries():
+                        deltas[project] = delta
+                        base.merge(delta)
+                        watermarks[project] = max(filter(None, (watermarks[project], listed.latest_modified())))
+                        if getattr(base, 'cache_path', None):
+                            save_cached_catalog(base.cache_path, collectionURL, base)
+            except Exception as e:
+                print(f'✗ Poll failed: {e}')
+                interval = min(interval * 2, poll_max)
+                continue
+            changed = sum(len(d.entries()) for d in deltas.values())
+            METRICS.event('poll', poll=polls, changed=changed, interval=interval)
+            if not deltas:
+                print(f'[Watch] Poll {polls}: no new or modified objects')
+                interval = min(interval * 2, poll_max)
+                continue
+            print(f'[Watch] Poll {polls}: {changed} new or modified objects in {", ".join(deltas)}')
+            xnat_batch(myWorkingDirectory, collectionURL, [job.copy() for job in jobs if job.project in deltas],
+                       shared=shared, catalogs=deltas, **options)
+            interval = poll_min
+    finally:
+        if own_session:
+            shared.close()
+    return polls
+
+
+
+# BatchEntry options download() and watch() accept for a single project
+ENTRY_OPTIONS = ('subject', 'session', 'download', 'experiment_type', 'assessor_type')
+
+
+class Downloader:
+    """XNAT downloads for programs that run many jobs in one process.
+
+    Logs in once and keeps one connection pool for all jobs, so only the
+    first job pays for the login and the connection set-up. Jobs run in
+    the calling thread with download(), in the background with submit()
+    (a concurrent.futures.Future) or from asyncio with download_async().
+    on_progress(event) is called from the worker threads after every
+    transfer (see progress_event); on_complete(result, error) once a job
+    has finished, with error None if it ran to the end. Jobs writing into
+    the same project directory must not run at the same time.
+
+    options are defaults for every job; download() and watch() take the
+    same keywords as xnat_batch, plus scan_type and resource and, for a
+    single project, the ENTRY_OPTIONS.
+    """
+
+    def __init__(self, host, username, password, workers=1, max_jobs=1, on_progress=None, on_complete=None,
+                 **options):
+        self.host = host
+        self.workers = workers
+        self.options = options
+        self.on_progress = on_progress
+        self.on_complete = on_complete
+        # Enough pooled connections for every job running at once
+        self.shared = SharedSession(host, username, password, pool_size=workers * max_jobs)
+        self._jobs = ThreadPoolExecutor(max_workers=max_jobs)
+
+    def _entries(self, project, entries, options):
+        scan_type = options.pop('scan_type', None)
+        resource = options.pop('resource', None)
+        filters = {name: options.pop(name) for name in ENTRY_OPTIONS if name in options}
+        if entries is not None:
+            if scan_type or resource or filters:
+                raise ValueError('scan_type, resource and ' + ', '.join(ENTRY_OPTIONS)
+                                 + ' only apply to a single project; set them on the entries instead')
+            return entries
+        if not project:
+            raise ValueError('a project or a list of entries is required')
+        return [BatchEntry(project, selection=Selection(scan_type, resource), **filters)]
+
+    def _run(self, function, output, project, entries, options):
+        """Call function (xnat_batch or a wrapper of it) for one job and report its completion"""
+        options = dict(self.options, **options)
+        if 'shared' in options or 'output' in options:
+            raise ValueError('shared and output are set by the Downloader; pass the output location instead')
+        # Per-job workers and progress override the Downloader's
+        options.setdefault('workers', self.workers)
+        options.setdefault('progress', self.on_progress)
+        jobs = self._entries(project, entries, options)
+        s3_options = [options.pop(name, None) for name in ('s3_endpoint', 's3_region', 'state_dir')]
+        remote = None
+        if str(output).startswith('s3://'):
+            remote = open_output(output, *s3_options, pool_size=options['workers'] + 1)
+        result = error = None
+        try:
+            result = function(remote.root if remote else output, self.host, jobs, shared=self.shared,
+                              output=remote, **options)
+            return result
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            if remote is not None:
+                remote.close()
+            if self.on_complete is not None:
+                self.on_complete(result, error)
+
+    def download(self, output, project=None, entries=None, **options):
+        """Download project (or the BatchEntry list entries) into output.
+
+        Returns the entries with their final status, or the plan with
+        dry_run=True. output is a directory or an s3://bucket/prefix url.
+        """
+        return self._run(xnat_batch, output, project, entries, options)
+
+    def retry_failed(self, output, project=None, entries=None, **options):
+        """Download again what earlier jobs into output left in their dead-letter files"""
+        return self._run(xnat_retry_failed, output, project, entries, options)
+
+    def submit(self, output, project=None, entries=None, **options):
+        """Run download() in the background; returns a concurrent.futures.Future"""
+        return self._jobs.submit(self.download, output, project, entries, **options)
+
+    async def download_async(self, output, project=None, entries=None, **options):
+        """download() for asyncio code, without blocking the event loop.
+
+        on_progress still runs in worker threads; use
+        loop.call_soon_threadsafe to hand events over to the loop.
+        """
+        import asyncio
+        return await asyncio.wrap_future(self.submit(output, project, entries, **options))
+
+    def watch(self, output, project=None, entries=None, stop=None, **options):
+        """Download, then poll for changes until stop is set (see xnat_watch); returns the number of polls"""
+        return self._run(xnat_watch, output, project, entries, dict(options, stop=stop))
+
+    def close(self):
+        """Wait for the submitted jobs, then log out"""
+        self._jobs.shutdown(wait=True)
+        self.shared.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def build_parser():
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--output',required = False,dest='output',help='Path to the output directory, or s3://bucket/prefix to stream downloads into S3-compatible storage')
+    parser.add_argument('--s3-endpoint', required=False, type=str, dest='s3_endpoint', help='Endpoint URL of the S3-compatible store, e.g. http://minio:9000 (default: AWS_ENDPOINT_URL or AWS S3)')
+    parser.add_argument('--s3-region', required=False, type=str, dest='s3_region', help='Region used to sign S3 requests (default: AWS_REGION or us-east-1)')
+    parser.add_argument('--state-dir', required=False, type=str, dest='state_dir', help='Local directory for the sync index, progress and logs of an s3:// output (default: ~/.cache/xnat_download/s3/BUCKET/PREFIX)')
+    parser.add_argument('--user', required=True,type=str,dest='xnat_user', help='XNAT username')
+    parser.add_argument('--pass',type=str,dest='xnat_pass', help='XNAT password')
+    parser.add_argument('--host',  required=True,type=str,dest='xnat_host', help='XNAT hostname')
+    parser.add_argument('--project', required=False, type=str,dest='xnat_project', help='XNAT project ID (required unless --manifest is given)')
+    parser.add_argument('--manifest', required=False, type=str, dest='manifest', help='CSV or JSON file of project, subject, session, download, experiment_type, assessor_type, scan_type and resource entries to download in one run')
+    parser.add_argument('--session', required=False, type=str,dest='xnat_session', help='XNAT session/experiment label to download')
+    parser.add_argument('--download', required=False, type=str, default='both', choices=['experiments', 'assessors', 'both'], dest='download_mode', help='What to download: experiments, assessors, or both (default: both)')
+    parser.add_argument('--experiment-type', required=False, type=str,dest='xnat_experiment_type', help='XNAT experiment type filter (e.g., xnat:mrSessionData, xnat:petSessionData)')
+    parser.add_argument('--assessor-type', required=False, type=str,dest='xnat_assessor_type', help='XNAT assessor type filter (e.g., icr:RoiCollection)')
+    parser.add_argument('--list-types', required=False, action='store_true', dest='list_types', help='List the experiment and assessor types of the project with counts, sizes and (with --output) how much is already downloaded, then exit')
+    parser.add_argument('--dry-run', required=False, action='store_true', dest='dry_run', help='Report what a download with these options would transfer and how long it would take, without downloading')
+    parser.add_argument('--sizes', required=False, action='store_true', dest='sizes', help='With --list-types and --dry-run, list the files of each object whose size is not known yet (one request per object)')
+    parser.add_argument('--catalog-max-age', required=False, type=float, dest='catalog_max_age', help=f'Seconds a cached catalog is reused by --list-types (default: {CATALOG_MAX_AGE}) and --dry-run (default: list again)')
+    parser.add_argument('--refresh-catalog', required=False, action='store_true', dest='refresh_catalog', help='List the project again instead of using the cached catalog')
+    parser.add_argument('--scan-type', required=False, type=str, dest='scan_type', help='Only download scans whose type or series description matches (comma-separated, wildcards allowed, e.g. T1*,FLAIR)')
+    parser.add_argument('--resource', required=False, type=str, dest='resource', help='Only download these resource labels (comma-separated, e.g. DICOM)')
+    parser.add_argument('--extract', required=False, action='store_true', dest='extract', help='Unpack each download on the fly into SubjectID/Label/ instead of writing Label.zip')
+    parser.add_argument('--order', required=False, type=str, default='catalog', choices=SCHEDULING_ORDERS, dest='order', help='Download order: catalog (default), smallest or largest first, subjects (--priority-subjects first) or oldest modified first')
+    parser.add_argument('--priority-subjects', required=False, type=str, dest='priority_subjects', help='Comma-separated subject labels, or @file with one per line, downloaded first with --order subjects')
+    parser.add_argument('--shard', required=False, type=str, dest='shard', help='Download only part i of N of the project (e.g. 0/4), for spreading it over several nodes sharing the output directory')
+    parser.add_argument('--shard-by', required=False, type=str, default='subject', choices=['subject', 'experiment'], dest='shard_by', help='Partition --shard by subject (default) or by session')
+    parser.add_argument('--lease', required=False, action='store_true', dest='lease', help='Claim each object through a lock file under the output directory so several nodes never fetch the same one; with --shard, idle nodes take over work left by the others')
+    parser.add_argument('--event-log', required=False, type=str, dest='event_log', help='Append a JSON line per download, retry, session refresh and phase to this file')
+    parser.add_argument('--metrics-file', required=False, type=str, dest='metrics_file', help='Write Prometheus metrics to this file every 15s and at the end (for the node_exporter textfile collector)')
+    parser.add_argument('--metrics-port', required=False, type=int, dest='metrics_port', help='Serve Prometheus metrics on http://127.0.0.1:PORT/metrics while the run lasts')
+    parser.add_argument('--metrics-bind', required=False, type=str, default='127.0.0.1', dest='metrics_bind', help='Address the --metrics-port endpoint listens on, e.g. 0.0.0.0 for a scraper on another host (default: 127.0.0.1)')
+    parser.add_argument('--cache', required=False, type=str, dest='cache', help='Cache directory shared by runs into any --output; objects found there are linked into place instead of downloaded')
+    parser.add_argument('--cache-size', required=False, type=float, dest='cache_size', help='Evict the least recently used cache entries beyond this many GB')
+    parser.add_argument('--cache-link', required=False, type=str, default='auto', choices=['auto', 'reflink', 'hardlink', 'copy'], dest='cache_link', help='How cache hits are placed in the output: auto (reflink, else hardlink, else copy) or one method')
+    parser.add_argument('--index-dicom', required=False, action='store_true', dest='index_dicom', help='Read the DICOM headers of each download (without pixel data) into ProjectID/.dicom_index.sqlite in a process pool while the run goes on')
+    parser.add_argument('--index-only', required=False, action='store_true', dest='index_only', help='Update the DICOM header index of the downloads already under --output, then exit')
+    parser.add_argument('--watch', required=False, action='store_true', dest='watch', help='After the download keep running and poll XNAT for new or modified sessions and assessors, downloading only those')
+    parser.add_argument('--poll-min', required=False, type=float, default=WATCH_POLL_MIN, dest='poll_min', help=f'Shortest --watch poll interval in seconds, used while the project is changing (default: {WATCH_POLL_MIN})')
+    parser.add_argument('--poll-max', required=False, type=float, default=WATCH_POLL_MAX, dest='poll_max', help=f'Longest --watch poll interval in seconds, reached while nothing changes (default: {WATCH_POLL_MAX})')
+    parser.add_argument('--retries', required=False, type=int, default=RETRY_ROUNDS, dest='retries', help=f'Times a download that failed on a timeout, dropped connection or 5xx is tried again at the end of the run (default: {RETRY_ROUNDS})')
+    parser.add_argument('--retry-failed', required=False, action='store_true', dest='retry_failed', help='Download only the objects earlier runs left in ProjectID/.dead_letter.jsonl, without listing the project')
+    parser.add_argument('--workers', required=False, type=int, default=1, dest='workers', help='Number of parallel download workers (default: 1)')
+    parser.add_argument('--adaptive', required=False, action='store_true', dest='adaptive', help='Adjust the number of concurrent transfers (up to --workers) to server latency, 429/5xx responses and timeouts')
+    parser.add_argument('--max-bandwidth', required=False, type=float, dest='max_bandwidth', help='Cap the combined download rate in MB/s')
+    parser.add_argument('--no-catalog-check', required=False, action='store_false', dest='check_catalog', help='Skip comparing each download with the XNAT file catalog')
+    parser.add_argument('--verify', required=False, action='store_true', dest='verify', help='Check the existing zips under --output in parallel and flag bad ones for re-download, then exit')
+    return parser
+
+
+def main(argv=None):
+    """Command line entry point; argv defaults to sys.argv[1:]. Returns the exit code"""
+    args = build_parser().parse_args(argv)
+    myWorkingDirectory = args.output
+    collectionURL = args.xnat_host
+    myProjectID = args.xnat_project
+    username = args.xnat_user
+    password = args.xnat_pass
+    # --verify and --index-only only read the local tree
+    if password is None and not (args.verify or args.index_only):
+        import getpass
+        password = getpass.getpass("Enter your password: ")
+
+    print(VERSION)
+    #
+    #
+    if (args.list_types or args.verify or args.index_only) and not myProjectID:
+        print("Error: --project is required with --list-types, --verify and --index-only")
+        exit(1)
+    remote = bool(args.output) and args.output.startswith('s3://')
+    if remote and (args.verify or args.index_only):
+        print("Error: --verify and --index-only need a local --output")
+        exit(1)
+    if args.list_types:
+        list_types(collectionURL,myProjectID,None if remote else myWorkingDirectory,workers=args.workers,sizes=args.sizes,
+                   max_age=0 if args.refresh_catalog else CATALOG_MAX_AGE if args.catalog_max_age is None
+                   else args.catalog_max_age,username=username,password=password)
+    elif args.verify:
+        if not args.output:
+            print("Error: --output is required with --verify")
+            exit(1)
+        verify_tree(myWorkingDirectory, myProjectID, workers=args.workers if args.workers > 1 else None)
+    elif args.index_only:
+        if not args.output:
+            print("Error: --output is required with --index-only")
+            exit(1)
+        index_tree(myWorkingDirectory, myProjectID, workers=args.workers if args.workers > 1 else None)
+    else:
+        if not args.output:
+            print("Error: --output is required when downloading data")
+            exit(1)
+        if args.workers < 1:
+            print("Error: --workers must be at least 1")
+            exit(1)
+        shard = None
+        if args.shard:
+            try:
+                shard = Shard.parse(args.shard, args.shard_by)
+            except ValueError as e:
+                print(f"Error: {e}")
+                exit(1)
+        if args.watch and (args.dry_run or args.retry_failed):
+            print("Error: --watch can't be combined with --dry-run or --retry-failed")
+            exit(1)
+        if args.retries < 0:
+            print("Error: --retries can't be negative")
+            exit(1)
+        jobs = None
+        if args.manifest:
+            try:
+                jobs = read_manifest(args.manifest)
+            except (OSError, ValueError) as e:
+                print(f"Error: can't read manifest: {e}")
+                exit(1)
+            if not jobs:
+                print("Error: the manifest has no entries")
+                exit(1)
+        elif not myProjectID:
+            print("Error: --project or --manifest is required")
+            exit(1)
+        # A manifest brings its own filters, a single project takes them from the command line
+        status_file = f'.batch_status{shard.suffix() if shard else ""}.json' if jobs else None
+        project = {} if jobs else dict(project=myProjectID, scan_type=args.scan_type, resource=args.resource,
+                                       session=args.xnat_session, download=args.download_mode,
+                                       experiment_type=args.xnat_experiment_type,
+                                       assessor_type=args.xnat_assessor_type)
+        cache = None
+        if args.cache and not args.dry_run:
+            cache = ObjectCache(args.cache, args.cache_size * 1e9 if args.cache_size else None, args.cache_link)
+        METRICS.start(event_log=args.event_log, metrics_file=args.metrics_file, port=args.metrics_port,
+                      bind=args.metrics_bind)
+        result = None
+        try:
+            with Downloader(collectionURL, username, password, workers=args.workers,
+                            check_catalog=args.check_catalog, extract=args.extract, adaptive=args.adaptive,
+                            max_bandwidth=args.max_bandwidth, order=args.order,
+                            priority_subjects=read_subject_list(args.priority_subjects), shard=shard,
+                            leases=args.lease, cache=cache, dicom_index=args.index_dicom, retries=args.retries,
+                            s3_endpoint=args.s3_endpoint, s3_region=args.s3_region,
+                            state_dir=args.state_dir) as downloader:
+                if args.watch:
+                    # SIGTERM (e.g. systemctl stop) ends the watch after the current poll
+                    stop = threading.Event()
+                    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+                    try:
+                        downloader.watch(args.output, entries=jobs, stop=stop, poll_min=args.poll_min,
+                                         poll_max=args.poll_max, **project)
+                    except KeyboardInterrupt:
+                        print('\n[Watch] Stopped')
+                elif args.retry_failed:
+                    result = downloader.retry_failed(args.output, entries=jobs, **project)
+                else:
+                    result = downloader.download(args.output, entries=jobs, dry_run=args.dry_run, sizes=args.sizes,
+                                                 catalog_max_age=None if args.refresh_catalog else args.catalog_max_age,
+                                                 status_file=status_file, **project)
+        except ValueError as e:
+            # Options the output can't take, e.g. --extract or --lease with an s3:// output
+            print(f"Error: {e}")
+            exit(1)
+        finally:
+            METRICS.stop(args.metrics_file)
+            if cache is not None:
+                cache.close()
+        # Entries come back as a list; a dry run returns its plan
+        if isinstance(result, list) and any(job.status == 'failed' for job in result):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())